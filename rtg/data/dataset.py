@@ -1,8 +1,16 @@
+import collections
+import itertools
+import json
 import math
+import multiprocessing as mp
 import os
 import pickle
+import queue
 import random
+import shutil
 import sqlite3
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from itertools import zip_longest
 from pathlib import Path
 from typing import List, Iterator, Tuple, Union, Iterable, Dict, Any, Optional
@@ -10,9 +18,9 @@ import torch
 from tqdm import tqdm
 import numpy as np
 
-from rtg import log, device, cpu_device
+from rtg import log, device, cpu_device, cpu_count
 from rtg.data.codec import Field
-from rtg.utils import IO, line_count, get_my_args, max_RSS, maybe_compress
+from rtg.utils import IO, line_count, get_my_args, max_RSS
 
 
 Array = np.ndarray
@@ -174,9 +182,16 @@ class TSVData(Iterable[IdExample]):
     @staticmethod
     def read_raw_parallel_recs(src_path: Union[str, Path], tgt_path: Union[str, Path],
                                truncate: bool, src_len: int, tgt_len: int, src_tokenizer,
-                               tgt_tokenizer) \
+                               tgt_tokenizer, workers: int = 1) \
             -> Iterator[ParallelSeqRecord]:
+        """
+        :param workers: number of worker processes for tokenization; see tokenize_parallel()
+        """
         recs = TSVData.read_raw_parallel_lines(src_path, tgt_path)
+        if workers > 1:
+            task = TokenizerTask([src_tokenizer, tgt_tokenizer], lengths=[src_len, tgt_len],
+                                 truncate=truncate)
+            return tokenize_parallel(recs, task, workers=workers)
 
         recs = ((src_tokenizer(x), tgt_tokenizer(y)) for x, y in recs)
         if truncate:
@@ -215,48 +230,168 @@ class TokenizerTask:
                 record = None
         return record
 
+_worker_task: Optional[TokenizerTask] = None
+
+
+def _init_tokenizer_worker(task: TokenizerTask):
+    global _worker_task
+    _worker_task = task
+    random.seed()  # forked workers would otherwise make the same random splits
+    np.random.seed()
+
+
+def _tokenize_in_worker(records: List[Tuple]) -> List[Optional[List]]:
+    return [_worker_task(rec) for rec in records]
+
+
+def tokenize_parallel(records: Iterator[Tuple], task: TokenizerTask, workers: int = cpu_count,
+                      chunk_size: int = 10_000) -> Iterator[List]:
+    """
+    Tokenizes records in chunks using a pool of worker processes, which are forked, so the
+    tokenizers need not be pickled. Records are read as needed, upto a few chunks ahead.
+    :param records: stream of records e.g. (src, tgt) lines
+    :param task: tokenizer and length filter of records
+    :param workers: number of worker processes
+    :param chunk_size: number of records sent to a worker at a time
+    :return: stream of tokenized records in the same order as input; filtered records are dropped
+    """
+    log.info(f"Tokenizing with {workers} worker processes")
+    ctx = mp.get_context('fork')
+    with ctx.Pool(workers, initializer=_init_tokenizer_worker, initargs=(task,)) as pool:
+        pending = collections.deque()  # bounded, so that records are read as needed
+        records = iter(records)
+        for chunk in iter(lambda: list(itertools.islice(records, chunk_size)), []):
+            pending.append(pool.apply_async(_tokenize_in_worker, (chunk,)))
+            if len(pending) >= 2 * workers:
+                yield from (rec for rec in pending.popleft().get() if rec is not None)
+        while pending:
+            yield from (rec for rec in pending.popleft().get() if rec is not None)
+
+
+def sort_rows(arrays: Dict[str, Array], sort: str) -> Array:
+    """
+    :param arrays: columns of equal length
+    :param sort: similar to SQL ORDER BY clause, e.g. 'y_len desc, random() desc'
+    :return: order of rows
+    """
+    keys = []
+    for part in sort.split(','):
+        col, direction = part.strip().split()
+        assert direction.lower() in ('asc', 'desc'), f'{direction} in {sort} is unknown'
+        key = np.random.rand(len(arrays['id'])) if col == 'random()' else arrays[col]
+        keys.append(-key if direction.lower() == 'desc' else key)
+    return np.lexsort(keys[::-1])  # lexsort's primary key is the last
+
+
 class InMemoryData:
+    """
+    Columnar in-memory dataset: token ids of all x and y sequences are concatenated into flat
+    arrays, along with arrays of offsets, lengths, and ids. Saved as .npz file, see save() and load()
+    """
+    COLS = ('x', 'x_off', 'x_len', 'y', 'y_off', 'y_len', 'ids')
 
-    def __init__(self, stream: Iterator[IdExample]):
-        self.data = []
-        self.ids: Dict[Any, int] = {}
-        log.info("Loading data to memory")
+    def __init__(self, stream: Optional[Iterator[IdExample]] = None, **cols: Array):
+        """
+        :param stream: examples to load; or,
+        :param cols: arrays of COLS, e.g. from load(); and optionally, x_raw and y_raw
+        """
+        if stream is not None:
+            assert not cols
+            cols = self._read(stream)
+        for name in self.COLS:
+            setattr(self, name, cols[name])
+        # raw sentences, optional; for logging and validation BLEU
+        self.x_raw: Optional[Array] = cols.get('x_raw')
+        self.y_raw: Optional[Array] = cols.get('y_raw')
+        self.id_order = np.argsort(self.ids, kind='stable')
+        sorted_ids = self.ids[self.id_order]
+        assert len(sorted_ids) < 2 or np.all(sorted_ids[1:] != sorted_ids[:-1]), 'duplicate ids'
 
+    @staticmethod
+    def _read(stream: Iterator[IdExample]) -> Dict[str, Array]:
+        log.info("Loading data to memory")
+        xs, ys, ids = [], [], []
         with tqdm(stream, mininterval=1, unit='recs') as data_bar:
             for idx, rec in enumerate(data_bar):
                 assert isinstance(rec, IdExample)
-                assert rec.id not in self.ids, f'Record with id {id} is a duplicate record'
-                self.ids[rec.id] = len(self.data)
-                self.data.append(rec)
-
+                xs.append(np.asarray(rec.x, dtype=np.int32))
+                ys.append(rec.y if rec.y is None else np.asarray(rec.y, dtype=np.int32))
+                ids.append(rec.id)
                 if idx % 1000 == 0:
                     mem = max_RSS()[1]
                     data_bar.set_postfix(mem=mem, refresh=False)
-        log.info(f"Total={len(self.data)} records; Total memory used={max_RSS()[1]}")
-        assert len(self.data) == len(self.ids)
+        cols = dict(ids=np.array(ids, dtype=np.int64))
+        for side, seqs in [('x', xs), ('y', ys)]:
+            lens = np.array([-1 if seq is None else len(seq) for seq in seqs], dtype=np.int64)
+            seqs = [seq for seq in seqs if seq is not None]
+            cols[side] = np.concatenate(seqs) if seqs else np.zeros(0, dtype=np.int32)
+            cols[f'{side}_len'] = lens
+            cols[f'{side}_off'] = np.cumsum(np.maximum(lens, 0)) - np.maximum(lens, 0)
+        log.info(f"Total={len(ids)} records; Total memory used={max_RSS()[1]}")
+        return cols
+
+    def save(self, path: Union[str, Path]):
+        cols = {name: getattr(self, name) for name in self.COLS}
+        for name in ('x_raw', 'y_raw'):
+            if getattr(self, name) is not None:
+                cols[name] = np.asarray(getattr(self, name), dtype=str)
+        with open(path, 'wb') as out:
+            np.savez(out, **cols)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> 'InMemoryData':
+        with np.load(str(path)) as cols:
+            return cls(**{name: cols[name] for name in cols.files})
+
+    def _example(self, row: int) -> IdExample:
+        x = self.x[self.x_off[row]: self.x_off[row] + self.x_len[row]]
+        y_len = self.y_len[row]
+        y = self.y[self.y_off[row]: self.y_off[row] + y_len] if y_len >= 0 else None
+        ex = IdExample(x=x, y=y, id=int(self.ids[row]))
+        if self.x_raw is not None:
+            ex.x_raw = str(self.x_raw[row])
+        if self.y_raw is not None:
+            ex.y_raw = str(self.y_raw[row])
+        return ex
 
     def get_all(self, cols, sort):
+        """
+        :param cols: columns among id, x_len, y_len
+        :param sort: similar to SQL ORDER BY clause, e.g. 'y_len desc, random() desc'
+        :return: rows as dictionaries
+        """
         assert cols
-        data = self.data
+        arrays = dict(id=self.ids, x_len=self.x_len, y_len=self.y_len)
+        assert all(col in arrays for col in cols), f'{cols} not supported; known: {arrays.keys()}'
         if sort:
-            sort_col, sort_order = sort.split()
-            assert sort_col in {'x_len', 'y_len'}
-            assert sort_order in {'asc', 'desc'}
-            reverse = sort_order == 'desc'
-            data = sorted(data, key=lambda x: x[sort_col], reverse=reverse)
-        recs = ({cn: ex[cn] for cn in cols} for ex in data)
-        return recs
+            order = sort_rows(arrays, sort)
+            arrays = {name: arr[order] for name, arr in arrays.items()}
+        for row in zip(*[arrays[col] for col in cols]):
+            yield dict(zip(cols, map(int, row)))
+
+    def get_lengths(self) -> Tuple[Array, Array, Array]:
+        """
+        :return: ids, x_len, and y_len columns
+        """
+        return self.ids, self.x_len, self.y_len
 
     def get_all_ids(self, ids):
-        idxs = (self.ids[id] for id in ids)
-        examples = (self.data[ix] for ix in idxs)
-        return examples
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) and not len(self.ids):
+            raise KeyError(f'Unknown ids: {ids[:10].tolist()}')
+        pos = np.searchsorted(self.ids[self.id_order], ids)
+        rows = self.id_order[np.minimum(pos, len(self.ids) - 1)]
+        unknown = self.ids[rows] != ids  # searchsorted gives a neighbour for unknown ids
+        if np.any(unknown):
+            raise KeyError(f'Unknown ids: {ids[unknown][:10].tolist()}')
+        return (self._example(row) for row in rows)
 
     def __len__(self):
-        return len(self.data)
+        return len(self.ids)
 
     def __iter__(self) -> Iterator[IdExample]:
-        yield from self.data
+        for row in range(len(self)):
+            yield self._example(row)
 
 
 class SqliteFile(Iterable[IdExample]):
@@ -308,7 +443,8 @@ class SqliteFile(Iterable[IdExample]):
         self.select_qry = self.make_query(sort_by, len_rand=len_rand)
         self.max_src_len, self.max_tgt_len = max_src_len, max_tgt_len
         self.truncate = truncate
-        self.db = sqlite3.connect(str(path))
+        # read only; may be read from a background thread, see PrefetchIterable
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
         self.db_version = self.db.execute('PRAGMA user_version;').fetchone()[0]
 
         def dict_factory(cursor, row):  # map tuples to dictionary with column names
@@ -353,6 +489,23 @@ class SqliteFile(Iterable[IdExample]):
             qry += f' ORDER BY {sort}'
         return self.db.execute(qry)
 
+    def get_lengths(self, chunk_size=1_000_000) -> Tuple[Array, Array, Array]:
+        """
+        :return: ids, x_len, and y_len columns
+        """
+        cur = self.db.cursor()
+        cur.row_factory = None  # plain tuples
+        cur.execute("SELECT id, x_len, y_len FROM data")
+        chunks = []
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            chunks.append(np.array(rows, dtype=np.int64))
+        cur.close()
+        cols = np.concatenate(chunks) if chunks else np.zeros((0, 3), dtype=np.int64)
+        return cols[:, 0], cols[:, 1], cols[:, 2]
+
     def get_all_ids(self, ids):
         ids_str = ",".join(map(str, ids))
         qry = f"SELECT * FROM  data WHERE id IN ({ids_str})"
@@ -360,7 +513,12 @@ class SqliteFile(Iterable[IdExample]):
         return recs
 
     @classmethod
-    def write(cls, path, records: Iterator[ParallelSeqRecord]):
+    def write(cls, path, records: Iterator[ParallelSeqRecord], insert_size: int = 10_000):
+        """
+        :param path: path to sqlite file
+        :param records: parallel sequences
+        :param insert_size: number of rows inserted at once
+        """
         if path.exists():
             log.warning(f"Overwriting {path} with new records")
             os.remove(str(path))
@@ -374,17 +532,23 @@ class SqliteFile(Iterable[IdExample]):
         cur.execute(f"PRAGMA user_version = {cls.CUR_VERSION};")
 
         count = 0
+        rows = []
         for x_seq, y_seq in records:
             # use numpy. its a lot efficient
             if not isinstance(x_seq, np.ndarray):
                 x_seq = np.array(x_seq, dtype=np.int32)
             if y_seq is not None and not isinstance(y_seq, np.ndarray):
                 y_seq = np.array(y_seq, dtype=np.int32)
-            values = (x_seq.tobytes(),
-                      None if y_seq is None else y_seq.tobytes(),
-                      len(x_seq), len(y_seq) if y_seq is not None else -1)
-            cur.execute(cls.INSERT_STMT, values)
-            count += 1
+            rows.append((x_seq.tobytes(),
+                         None if y_seq is None else y_seq.tobytes(),
+                         len(x_seq), len(y_seq) if y_seq is not None else -1))
+            if len(rows) >= insert_size:
+                cur.executemany(cls.INSERT_STMT, rows)
+                count += len(rows)
+                rows.clear()
+        if rows:
+            cur.executemany(cls.INSERT_STMT, rows)
+            count += len(rows)
         cur.close()
         conn.commit()
         if maybe_tmp != path:
@@ -393,6 +557,140 @@ class SqliteFile(Iterable[IdExample]):
         log.info(f"stored {count} rows in {path}")
 
 
+class MemmapFile(Iterable[IdExample]):
+    """
+    Flat binary format of parallel sequences, read via memory maps. It is a directory having:
+        x.bin, y.bin : token ids of all x and y sequences concatenated;
+                       uint16 if vocabulary is small enough, else int32
+        index.npy    : [N x 4] int64 array of (x_offset, x_len, y_offset, y_len); y_len=-1 if no y
+        meta.json    : version, dtype, count
+    Record ids are the row numbers of index. Sequences are slices of the memory maps, hence no copy
+    (except when uint16 ids are widened to int32).
+    """
+    CUR_VERSION = 1
+    INDEX_COLS = ('x_off', 'x_len', 'y_off', 'y_len')
+
+    def __init__(self, path: Path, sort_by='random', len_rand=2,
+                 max_src_len: int = 512, max_tgt_len: int = 512, truncate: bool = False):
+        log.info(f"{type(self)} Args: {get_my_args()}")
+        self.path = path = Path(path)
+        assert path.is_dir()
+        meta = json.loads((path / 'meta.json').read_text())
+        assert meta['version'] <= self.CUR_VERSION
+        self.dtype = np.dtype(meta['dtype'])
+        self.index = np.load(str(path / 'index.npy'), mmap_mode='r')
+        assert len(self.index) == meta['count']
+        self.x = self._memmap(path / 'x.bin')
+        self.y = self._memmap(path / 'y.bin')
+        assert sort_by in (None, 'none', 'random', 'eq_len_rand_batch', 'x_len_asc', 'x_len_desc',
+                           'y_len_asc', 'y_len_desc'), f'sort_by={sort_by} is not supported'
+        assert len_rand >= 1
+        self.sort_by, self.len_rand = sort_by, len_rand
+        self.max_src_len, self.max_tgt_len = max_src_len, max_tgt_len
+        self.truncate = truncate
+
+    def _memmap(self, path: Path) -> Array:
+        if path.stat().st_size == 0:  # mmap of empty file is an error
+            return np.zeros(0, dtype=self.dtype)
+        return np.memmap(str(path), dtype=self.dtype, mode='r')
+
+    def __len__(self):
+        return len(self.index)
+
+    def _col(self, name) -> Array:
+        return self.index[:, self.INDEX_COLS.index(name)]
+
+    def _order(self) -> Array:
+        if self.sort_by in (None, 'none'):
+            return np.arange(len(self))
+        if self.sort_by == 'random':
+            return np.random.permutation(len(self))
+        # same as SqliteFile: ORDER BY <len> + (RANDOM() % len_rand)
+        col, order = ('y_len', 'desc') if self.sort_by == 'eq_len_rand_batch' \
+            else self.sort_by.rsplit('_', maxsplit=1)
+        key = self._col(col) + np.random.randint(0, self.len_rand, size=len(self))
+        return np.argsort(-key if order == 'desc' else key, kind='stable')
+
+    def _example(self, id: int) -> IdExample:
+        x_off, x_len, y_off, y_len = self.index[id]
+        x = self.x[x_off: x_off + x_len]
+        y = self.y[y_off: y_off + y_len] if y_len >= 0 else None
+        if self.dtype != np.int32:
+            x = x.astype(np.int32)
+            y = y if y is None else y.astype(np.int32)
+        return IdExample(x=x, y=y, id=int(id))
+
+    def __iter__(self) -> Iterator[IdExample]:
+        for id in self._order():
+            ex = self._example(id)
+            x, y = ex.x, ex.y
+            if y is None or len(x) == 0 or len(y) == 0:
+                log.warning(f"Ignoring an empty record   x:{len(x)}    y:{y is not None and len(y)}")
+                continue
+            if len(x) > self.max_src_len or len(y) > self.max_tgt_len:
+                if self.truncate:
+                    ex.x, ex.y = x[:self.max_src_len], y[:self.max_tgt_len]
+                else:  # skip this record
+                    continue
+            yield ex
+
+    def get_all(self, cols, sort=None):
+        """
+        :param cols: columns among id, x_len, y_len
+        :param sort: similar to SQL ORDER BY clause, e.g. 'y_len desc, random() desc'
+        :return: rows as dictionaries
+        """
+        assert cols
+        arrays = dict(id=np.arange(len(self)), x_len=self._col('x_len'), y_len=self._col('y_len'))
+        assert all(col in arrays for col in cols), f'{cols} not supported; known: {arrays.keys()}'
+        if sort:
+            order = sort_rows(arrays, sort)
+            arrays = {name: arr[order] for name, arr in arrays.items()}
+        for row in zip(*[arrays[col] for col in cols]):
+            yield dict(zip(cols, map(int, row)))
+
+    def get_lengths(self) -> Tuple[Array, Array, Array]:
+        """
+        :return: ids, x_len, and y_len columns
+        """
+        return np.arange(len(self)), self._col('x_len'), self._col('y_len')
+
+    def get_all_ids(self, ids):
+        return (self._example(id) for id in ids)
+
+    @classmethod
+    def write(cls, path: Path, records: Iterator[ParallelSeqRecord], vocab_size: int = -1):
+        """
+        :param path: path to directory
+        :param records: parallel sequences
+        :param vocab_size: size of vocabulary, which decides the dtype. -1 if unknown
+        """
+        path = Path(path)
+        if path.exists():
+            log.warning(f"Overwriting {path} with new records")
+            shutil.rmtree(path)
+        path.mkdir(parents=True)
+        dtype = np.uint16 if 0 < vocab_size <= np.iinfo(np.uint16).max + 1 else np.int32
+        index = []
+        x_off, y_off = 0, 0
+        with open(path / 'x.bin', 'wb') as x_out, open(path / 'y.bin', 'wb') as y_out:
+            for x_seq, y_seq in records:
+                x_seq = np.asarray(x_seq, dtype=dtype)
+                x_out.write(x_seq.tobytes())
+                y_len = -1
+                if y_seq is not None:
+                    y_seq = np.asarray(y_seq, dtype=dtype)
+                    y_out.write(y_seq.tobytes())
+                    y_len = len(y_seq)
+                index.append((x_off, len(x_seq), y_off, y_len))
+                x_off, y_off = x_off + len(x_seq), y_off + max(y_len, 0)
+        index = np.array(index, dtype=np.int64).reshape(-1, len(cls.INDEX_COLS))
+        np.save(str(path / 'index.npy'), index)
+        meta = dict(version=cls.CUR_VERSION, dtype=np.dtype(dtype).name, count=len(index))
+        (path / 'meta.json').write_text(json.dumps(meta))
+        log.info(f"stored {len(index)} rows in {path}")
+
+
 def read_tsv(path: str):
     assert os.path.exists(path)
     with IO.reader(path) as f:
@@ -433,6 +731,65 @@ def padded_sequence_mask(lengths, max_len=None, device=device):
     return seq_range_expand < seq_length_expand  # 0 if padding, 1 otherwise
 
 
+def plan_eq_len_batches(ids: Array, x_lens: Array, y_lens: Array, max_toks: int,
+                        max_sents: int, rng: np.random.Generator, rank: int = 0,
+                        world_size: int = 1, jitter: float = 0.) -> List[Array]:
+    """
+    Plans batches of similar lengths: sequences are sorted by length plus uniform noise in
+    [0, 1 + jitter) (longest first) and packed greedily, across lengths, upto max_toks
+    (including padding) and max_sents. With jitter=0, the noise only breaks ties randomly;
+    with jitter>0, sequences whose lengths differ by upto jitter can swap places, so batches
+    differ more between epochs at the cost of some padding.
+    For distributed training, batches are sharded across ranks: batches of similar sizes are
+    grouped, one batch per rank, so that all ranks take similar time at each step. All ranks must
+    use the same rng state (i.e. seed) to get disjoint shards
+    :param ids: ids of records
+    :param x_lens: x lengths
+    :param y_lens: y lengths; -1 if there is no y
+    :param max_toks: maximum tokens in batch, including padding, on either side
+    :param max_sents: maximum sequences in batch
+    :param rng: random number generator
+    :param rank: rank of this process
+    :param world_size: number of processes; the last (len(batches) % world_size) are dropped
+    :param jitter: noise added to lengths for sorting, in tokens
+    :return: ids of records in each batch (of this rank); batches are in random order
+    """
+    assert 0 <= rank < world_size
+    assert jitter >= 0
+    lens = np.where(y_lens < 0, x_lens, np.maximum(x_lens, y_lens))
+    valid = (x_lens > 0) & (y_lens != 0)
+    if not valid.all():
+        log.warning(f"Skipping {np.sum(~valid)} records, either source or target is empty")
+        ids, lens = ids[valid], lens[valid]
+    if len(lens) and lens.max() > max_toks:
+        raise Exception(f'Unable to make a batch of {max_toks} toks with a seq of len:{lens.max()}')
+    order = np.argsort(-(lens + rng.uniform(0, 1 + jitter, len(lens))), kind='stable')
+    ids, lens = ids[order], lens[order]
+    starts = []
+    i, n = 0, len(lens)
+    while i < n:
+        if jitter == 0:  # lens are in descending order; the first one is the longest
+            size = min(max_sents, max_toks // int(lens[i]), n - i)
+        else:
+            window = lens[i:i + max_sents]
+            size = int(np.sum(np.maximum.accumulate(window) * np.arange(1, len(window) + 1)
+                              <= max_toks))
+        starts.append(i)
+        i += size
+    if not starts:
+        return []
+    starts = np.array(starts)
+    batches = np.split(ids, starts[1:])
+    if world_size > 1:
+        # padded size of a batch = its length x its longest sequence's length
+        sizes = np.diff(np.append(starts, n)) * np.maximum.reduceat(lens, starts)
+        steps = len(batches) // world_size
+        groups = np.argsort(-sizes, kind='stable')[:steps * world_size].reshape(steps, world_size)
+        groups = rng.permuted(groups[rng.permutation(steps)], axis=1)
+        return [batches[j] for j in groups[:, rank]]
+    return [batches[j] for j in rng.permutation(len(batches))]
+
+
 class Batch:
     """
     An object of this class holds a batch of examples
@@ -473,22 +830,18 @@ class Batch:
         self.bos_x = add_bos_x
         self.bos_y = add_bos_y
         self.y_is_cls = y_is_cls
+        self.corpus: Optional[str] = None  # name of corpus, if drawn from many
         self.batch_first = batch_first
 
-        self.bos_eos_check(batch, 'x', add_bos_x, add_eos_x)
         if sort_dec:
             batch = sorted(batch, key=lambda _: len(_.x), reverse=True)
         self._len = len(batch)
-        self.x_len = torch.tensor([len(e.x) for e in batch], device=device)
+        # create x_seqs on CPU RAM and move to GPU at once
+        x_seqs, x_len = self.pad_seqs([ex.x for ex in batch], add_bos_x, add_eos_x)
+        self.x_len = x_len.to(device)
         self.x_toks = self.x_len.sum().float().item()
         self.max_x_len = self.x_len.max()
-
-        # create x_seqs on CPU RAM and move to GPU at once
-        self.x_seqs = torch.full(size=(self._len, self.max_x_len), fill_value=self.pad_val,
-                                 dtype=torch.long, device=device)
-        for i, ex in enumerate(batch):
-            self.x_seqs[i, :len(ex.x)] = torch.tensor(ex.x, dtype=torch.long, device=device)
-        self.x_seqs = self.x_seqs.to(device)
+        self.x_seqs = x_seqs.to(device)
         if not batch_first:  # transpose
             self.x_seqs = self.x_seqs.t()
         self.x_raw = None
@@ -509,14 +862,10 @@ class Batch:
                     ys[i] = y
                 self.ys = ys.to(device)
             else:
-                self.bos_eos_check(batch, 'y', add_bos_y, add_eos_y)
-                self.y_len = torch.tensor([len(e.y) for e in batch], device=device)
+                y_seqs, y_len = self.pad_seqs([ex.y for ex in batch], add_bos_y, add_eos_y)
+                self.y_len = y_len.to(device)
                 self.y_toks = self.y_len.sum().float().item()
                 self.max_y_len = self.y_len.max().item()
-                y_seqs = torch.full(size=(self._len, self.max_y_len), fill_value=self.pad_val,
-                                    dtype=torch.long, device=device)
-                for i, ex in enumerate(batch):
-                    y_seqs[i, :len(ex.y)] = torch.tensor(ex.y, dtype=torch.long)
                 self.y_seqs = y_seqs.to(device)
                 if not batch_first:  # transpose
                     self.y_seqs = self.y_seqs.t()
@@ -524,27 +873,59 @@ class Batch:
                 if batch[0].y_raw:
                     self.y_raw = [ex.y_raw for ex in batch]
 
-    def bos_eos_check(self, batch: List[IdExample], side: str, bos: bool, eos: bool):
+    def pad_seqs(self, seqs: List[Array], bos: bool, eos: bool) -> Tuple[torch.Tensor, torch.Tensor]:
         """
-        ensures and inserts (if needed) EOS and BOS tokens
-        :param batch:
-        :param side: which side? choices: {'x', 'y'}
+        Makes a padded matrix of sequences; BOS and EOS are inserted if needed, without modifying
+        the sequences. The sequences are concatenated once, and the padded matrix is filled with a
+        single fancy-index assignment.
+        :param seqs: sequences of ids
         :param bos: True if should have BOS, False if should not have BOS
         :param eos: True if should have EOS, False if should not have EOS
-        :return: None, all modifications are inplace of batch
+        :return: [Batch x MaxLen] padded sequences, [Batch] lengths
         """
-        for ex in batch:
-            ex.val_exists_at(side, pos=0, exist=bos, val=self.bos_val)
-            ex.val_exists_at(side, pos=-1, exist=eos, val=self.eos_val)
+        n = len(seqs)
+        lens = np.fromiter((len(seq) for seq in seqs), dtype=np.int64, count=n)
+        flat = np.concatenate(seqs).astype(np.int64, copy=False)
+        ends = np.cumsum(lens)
+        starts = ends - lens
+        ext = np.append(flat, -1)  # -1 is for the first and last of empty sequences
+        firsts = np.where(lens > 0, ext[starts], -1)
+        lasts = np.where(lens > 0, ext[ends - 1], -1)
+        if bos:
+            add_bos = (firsts != self.bos_val).astype(np.int64)
+        else:
+            assert not np.any(firsts == self.bos_val)
+            add_bos = np.zeros(n, dtype=np.int64)
+        if eos:
+            add_eos = (lasts != self.eos_val).astype(np.int64)
+        else:
+            assert not np.any(lasts == self.eos_val)
+            add_eos = np.zeros(n, dtype=np.int64)
+        new_lens = lens + add_bos + add_eos
+
+        padded = np.full((n, new_lens.max() if n else 0), fill_value=self.pad_val, dtype=np.int64)
+        rows = np.repeat(np.arange(n), lens)
+        cols = np.arange(len(flat)) - np.repeat(starts - add_bos, lens)
+        padded[rows, cols] = flat
+        padded[add_bos.astype(bool), 0] = self.bos_val
+        padded[add_eos.astype(bool), (new_lens - 1)[add_eos.astype(bool)]] = self.eos_val
+        return torch.from_numpy(padded), torch.from_numpy(new_lens)
 
     def __len__(self):
         return self._len
 
-    def to(self, device):
+    def to(self, device, non_blocking=False):
         """Move this batch to given device"""
         for name in self._all_attrs:
             if hasattr(self, name):
-                setattr(self, name, getattr(self, name).to(device))
+                setattr(self, name, getattr(self, name).to(device, non_blocking=non_blocking))
+        return self
+
+    def pin_memory(self):
+        """Pin the tensors of this batch in (page locked) host memory, for async copies to GPU"""
+        for name in self._all_attrs:
+            if hasattr(self, name):
+                setattr(self, name, getattr(self, name).pin_memory())
         return self
 
     def make_autoreg_mask(self, tgt):
@@ -579,7 +960,8 @@ class BatchIterable(Iterable[Batch]):
                  sort_desc: bool = False, batch_first: bool = True, shuffle: bool = False,
                  sort_by: str = None, keep_in_mem=False, raw_path: Tuple[Path]=None,
                  rank: int=None, world_size=None,
-                 device=cpu_device, y_is_cls=False, **kwargs):
+                 device=cpu_device, y_is_cls=False, seed: Optional[int] = None,
+                 len_jitter: float = 0., **kwargs):
         """
         Iterator for reading training data in batches
         :param data_path: path to TSV file
@@ -588,6 +970,11 @@ class BatchIterable(Iterable[Batch]):
                required: keep_mem=true, shuffle=False, sort_by=None
         :param keep_in_mem: keep the dataset in-memory
         :param sort_desc: should the batch be sorted by src sequence len (useful for RNN api)
+        :param seed: seed for the random order of eq_len_rand_batch plans; default is random.
+          For distributed training, it should be the same on all ranks
+        :param rank: rank of this process in distributed training
+        :param world_size: number of processes in distributed training
+        :param len_jitter: noise in lengths for sorting eq_len_rand_batch; see plan_eq_len_batches
         """
         self.field = field
         self.sort_desc = sort_desc
@@ -602,6 +989,14 @@ class BatchIterable(Iterable[Batch]):
         self.keep_in_mem = keep_in_mem
         self.y_is_cls = y_is_cls
         self.device = device
+        self.seed = random.randrange(2 ** 31) if seed is None else seed
+        self.len_jitter = len_jitter
+        self.rank, self.world_size = (rank, world_size) if world_size and world_size > 1 else (0, 1)
+        self.epoch = 0
+        self.position = 0  # batches of the current epoch that are already read
+        self._lengths = None  # (ids, x_len, y_len) columns
+        self._plans: Dict[Tuple, Future] = {}  # (max_toks, max_sents, seed, epoch) -> batch plan
+        self._planner = None
         if not isinstance(data_path, Path):
             data_path = Path(data_path)
 
@@ -616,7 +1011,10 @@ class BatchIterable(Iterable[Batch]):
             self.n_batches = -1
         elif any([data_path.name.endswith(suf) for suf in ('.db', '.db.tmp')]):
             self.data = SqliteFile(data_path, sort_by=sort_by, **kwargs)
-            self.n_batches = len(self._make_eq_len_batch_ids())
+            self.n_batches = None  # planned below, from the lengths of final data
+        elif data_path.name.endswith('.mmap'):
+            self.data = MemmapFile(data_path, sort_by=sort_by, **kwargs)
+            self.n_batches = None
         else:
             if sort_by:
                 raise Exception(f'sort_by={sort_by} not supported for TSV data')
@@ -631,11 +1029,10 @@ class BatchIterable(Iterable[Batch]):
             assert keep_in_mem
             assert len(raw_path) == 2, 'both src and tgt should be given'
         if self.keep_in_mem:
-            in_mem_file = data_path.with_suffix(".memdb.pkl")
+            in_mem_file = data_path.with_suffix(".memdb.npz")
             if in_mem_file.exists():
                 log.info(f"Loading from {in_mem_file}")
-                with in_mem_file.open('rb') as rdr:
-                    self.data = pickle.load(rdr)
+                self.data = InMemoryData.load(in_mem_file)
             else:
                 self.data = InMemoryData(self.data)
                 if raw_path:         # raw data for logging
@@ -643,16 +1040,17 @@ class BatchIterable(Iterable[Batch]):
                     log.info(f"Reading raw from src:{src_raw} tgt:{tgt_raw}")
                     raw_data = list(TSVData.read_raw_parallel_lines(src_raw, tgt_raw))
                     if len(raw_data) == len(self.data):
-                        for idx, (src, tgt) in enumerate(raw_data):
-                            self.data.data[idx].x_raw = src
-                            self.data.data[idx].y_raw = tgt
+                        self.data.x_raw = [src for src, tgt in raw_data]
+                        self.data.y_raw = [tgt for src, tgt in raw_data]
                     else:
                         log.warning(f'Raw={len(raw_data)}, but bin={len(self.data)} segs '
                             f'Try setting prep.truncate=true to truncate instead of skip of recs.')
                         log.warning("This disables BLEU logging on validation")
                 log.info(f"saving in-memory to {in_mem_file}")
-                with in_mem_file.open('wb') as wrt:
-                    pickle.dump(self.data, wrt)
+                self.data.save(in_mem_file)
+        if self.n_batches is None:
+            # after keep_in_mem, so that the records dropped by the length filter are not planned
+            self.n_batches = len(self._plan(self.epoch))
         log.info(f'Batch Size = {batch_size} toks, sort_by={sort_by}')
 
     def read_all(self):
@@ -686,50 +1084,72 @@ class BatchIterable(Iterable[Batch]):
 
         self.n_batches = len(self.data)
 
-    def _make_eq_len_batch_ids(self):
-        sort = 'y_len desc'
-        if isinstance(self.data, SqliteFile):  # only sqlite supports multiple sorts as of now
-            sort += ', random() desc'
-        rows = self.data.get_all(cols=['id', 'x_len', 'y_len'], sort=sort)
-        batches = []
-        batch = []
-        max_len = 0
-
-        for row in rows:
-            id, x_len, y_len = row['id'], row['x_len'], row['y_len']
-            if min(x_len, y_len) == 0:
-                log.warn("Skipping a record, either source or target is empty")
-                continue
-
-            this_len = max(x_len, y_len)
-            if len(batch) < self.max_sents and (len(batch) + 1) * max(max_len, this_len) <= self.max_toks:
-                batch.append(id)  # this one can go in
-                max_len = max(max_len, this_len)
-            else:
-                if this_len > self.max_toks:
-                    raise Exception(f'Unable to make a batch of {self.max_toks} toks'
-                                    f' with a seq of x_len:{x_len} y_len:{y_len}')
-                batches.append(maybe_compress(batch))
-                batch = [id]  # new batch
-                max_len = this_len
-        if batch:
-            batches.append(maybe_compress(batch))
-        return batches
+    def _plan_async(self, epoch: int) -> Future:
+        key = (self.max_toks, self.max_sents, self.seed, epoch)
+        if key not in self._plans:
+            if self._lengths is None:
+                self._lengths = self.data.get_lengths()
+            if self._planner is None:
+                self._planner = ThreadPoolExecutor(max_workers=1, thread_name_prefix='BatchPlanner')
+            rng = np.random.default_rng([self.seed, epoch])
+            self._plans[key] = self._planner.submit(
+                plan_eq_len_batches, *self._lengths, max_toks=self.max_toks,
+                max_sents=self.max_sents, rng=rng, rank=self.rank, world_size=self.world_size,
+                jitter=self.len_jitter)
+        return self._plans[key]
+
+    def _plan(self, epoch: int) -> List[Array]:
+        """
+        :param epoch: epoch number
+        :return: ids in each batch of eq_len_rand_batch for the given epoch; see plan_eq_len_batches
+        """
+        plan = self._plan_async(epoch).result()
+        for key in [key for key in self._plans if key[-1] < epoch]:  # not needed anymore
+            del self._plans[key]
+        return plan
 
     def make_eq_len_ran_batches(self):
-        # every pass introduces some randomness
-        batches = self._make_eq_len_batch_ids()
+        # every epoch has its own random plan; the next one is made in background
+        epoch, start = self.epoch, self.position
+        batches = self._plan(epoch)
         self.n_batches = len(batches)
-        log.info(f"length sorted random batches = {len(batches)}. Shuffling🔀...")
+        log.info(f"length sorted random batches = {len(batches)}; epoch={epoch}"
+                 + (f"; resuming from batch {start}" if start else ""))
         if not batches:
             raise Exception(f'Found no training data. Please check config and {self.data_path}')
-        random.shuffle(batches)
+        self._plan_async(epoch + 1)
 
-        for batch_ids in batches:
-            batch = list(self.data.get_all_ids(batch_ids))
-            # batch = [Example(r['x'], r.get('y')) for r in batch]
+        for i in range(start, len(batches)):
+            batch = list(self.data.get_all_ids(batches[i]))
+            self.position = i + 1
             yield Batch(batch, sort_dec=self.sort_desc, batch_first=self.batch_first,
                         field=self.field, device=self.device, y_is_cls=self.y_is_cls)
+        self.epoch, self.position = epoch + 1, 0
+
+    def state_dict(self) -> Dict[str, Any]:
+        """
+        :return: position of this iterator, which can be restored via load_state_dict()
+        """
+        return dict(epoch=self.epoch, position=self.position, seed=self.seed,
+                    batch_size=[self.max_toks, self.max_sents])
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        """
+        Restores the position of this iterator, so that the next iteration resumes from the batch
+        after the last one read before state_dict(). Only the batches of eq_len_rand_batch can be
+        skipped without reading them; for other orders, the state is ignored.
+        :param state: state from state_dict()
+        """
+        if self.sort_by != 'eq_len_rand_batch':
+            log.warning(f"Cannot resume data position for sort_by={self.sort_by}; starting over")
+            return
+        self.seed, self.epoch, self.position = state['seed'], state['epoch'], state['position']
+        self._plans.clear()  # planned with another seed
+        if list(state['batch_size']) != [self.max_toks, self.max_sents]:
+            log.warning(f"Batch size changed from {state['batch_size']}; batches of epoch"
+                        f" {self.epoch} are planned again, and read from the start")
+            self.position = 0
+        log.info(f"Data position restored: epoch={self.epoch} batch={self.position}")
 
     def __iter__(self) -> Iterator[Batch]:
         if self.sort_by == 'eq_len_rand_batch':
@@ -764,42 +1184,264 @@ class LoopingIterable(Iterable[Batch]):
                 if self.count >= self.total:
                     break
 
+    def state_dict(self) -> Optional[Dict[str, Any]]:
+        """
+        :return: state of the inner iterable, if it has any; the count of batches is not included
+          since the number of batches is decided by the caller on resume
+        """
+        return self.itr.state_dict() if hasattr(self.itr, 'state_dict') else None
 
-class GenerativeBatchIterable(Iterable[Batch]):
+    def load_state_dict(self, state: Dict[str, Any]):
+        if hasattr(self.itr, 'load_state_dict'):
+            self.itr.load_state_dict(state)
 
-    def __init__(self, file_creator: callable, batches: int, batch_size: int, field: Field,
-                 dynamic_epoch: bool = False, batch_first: bool = True, shuffle: bool = True,
-                 sort_by: str = 'eq_len_rand_batch', **kwargs):
-        self.file_creator = file_creator
-        self.total = batches
-        self.batch_size = batch_size
-        self.field = field
-        self.dynamic_epoch = dynamic_epoch
-        self.batch_first = batch_first
-        self.shuffle = shuffle
-        self.sort_by = sort_by
-        self.kwargs = kwargs
-        self.count = 0
-        self.feed = True
 
-    def generate_data(self) -> Iterable[Batch]:
-        file_name = self.file_creator()
-        data = BatchIterable(
-            file_name, batch_size=self.batch_size, field=self.field, sort_by=self.sort_by,
-            batch_first=self.batch_first, shuffle=self.shuffle, **self.kwargs
-        )
-        return data
+class PrefetchIterable(Iterable):
+    """
+    Reads batches (or tuples of batches) from an iterable in a background thread, upto a bounded
+    number of batches ahead of the consumer. When a device is given, batches are pinned in host
+    memory by the background thread, and the copy of the next batch to device is issued
+    (non-blocking) before yielding the current one, so that the copy overlaps with the computation.
+    """
+    _END = object()
 
-    def __iter__(self) -> Iterator[Batch]:
-        data = self.generate_data()
+    def __init__(self, iterable: Iterable, size: int = 2, device=None):
+        """
+        :param iterable: iterable of batches, or tuples of batches e.g. zip(train_data, mono_data)
+        :param size: maximum number of batches to read ahead
+        :param device: device to move the batches to; None to leave them as they are
+        """
+        assert size > 0
+        self.itr = iterable
+        self.size = size
+        self.device = device
+        self.pin = device is not None and torch.device(device).type == 'cuda'
+        self._state = self._itr_state()
+
+    def _itr_state(self):
+        return self.itr.state_dict() if hasattr(self.itr, 'state_dict') else None
 
-        while self.feed:
-            for batch in data:
+    def state_dict(self) -> Optional[Dict[str, Any]]:
+        """
+        :return: state of the inner iterable as of the last batch yielded to the consumer (rather
+          than the batch last read ahead by the background thread)
+        """
+        return self._state
+
+    def _map(self, item, func):
+        if isinstance(item, tuple):
+            return tuple(func(it) for it in item)
+        return func(item)
+
+    def _produce(self, buffer: queue.Queue, stop: threading.Event):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+        try:
+            for item in self.itr:
+                if self.pin:
+                    item = self._map(item, lambda b: b.pin_memory())
+                put((item, self._itr_state()))
+                if stop.is_set():
+                    return
+            put(self._END)
+        except Exception as e:
+            log.exception("Error while reading batches")
+            put(e)
+
+    def __iter__(self):
+        buffer = queue.Queue(maxsize=self.size)
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(buffer, stop), daemon=True,
+                                    name='BatchPrefetcher')
+        producer.start()
+
+        def _next():
+            item = buffer.get()
+            if isinstance(item, Exception):
+                raise item
+            if item is not self._END and self.device is not None:
+                item = (self._map(item[0], lambda b: b.to(self.device, non_blocking=self.pin)),
+                        item[1])
+            return item
+        try:
+            item = _next()
+            while item is not self._END:
+                next_item = _next()  # its copy to device overlaps with the use of item
+                item, self._state = item
+                yield item
+                item = next_item
+        finally:
+            stop.set()
+
+
+class MultiCorpusBatchIterable(Iterable[Batch]):
+    """
+    Draws batches from several corpora, each of which has its own iterable (and hence its own batch
+    plans). At each step, a corpus is sampled with probability proportional to w^(1/T), where w is
+    the weight of corpus (default: number of examples) and T is the temperature; T=1 samples as per
+    the weights, and higher T flattens the distribution towards uniform.
+    Corpora are repeated as needed, so iteration does not end; use LoopingIterable to stop.
+    The name of corpus is set to Batch.corpus.
+    """
+
+    def __init__(self, corpora: Dict[str, BatchIterable], weights: Optional[Dict[str, float]] = None,
+                 temperature: float = 1., seed: Optional[int] = None):
+        """
+        :param corpora: name -> iterable of batches
+        :param weights: name -> weight; default is the number of examples in corpus
+        :param temperature: temperature for sampling; see above
+        :param seed: seed for sampling the corpora; must be the same on all ranks of distributed
+          training, so that all ranks draw from the same corpus at each step
+        """
+        assert corpora, 'need atleast one corpus'
+        assert temperature > 0
+        weights = weights or {}
+        assert not set(weights) - set(corpora), f'weights of unknown corpora: {weights}'
+        self.corpora = corpora
+        self.names = list(corpora)
+        self.weights = np.array([weights.get(name, corpora[name].num_items) for name in self.names],
+                                dtype=np.float64)
+        assert (self.weights > 0).all(), f'corpus weights must be positive; {self.weights}'
+        probs = self.weights ** (1 / temperature)
+        self.probs = probs / probs.sum()
+        self.seed = random.randrange(2 ** 31) if seed is None else seed
+        self.rng = np.random.default_rng(self.seed)
+        self.draws = 0
+        self.n_batches = -1  # unknown
+        log.info("Sampling probabilities of corpora: "
+                 + ", ".join(f'{n}={p:.4f}' for n, p in zip(self.names, self.probs)))
+
+    def _cycle(self, name: str) -> Iterator[Batch]:
+        while True:
+            for batch in self.corpora[name]:
+                batch.corpus = name
                 yield batch
-                self.count += 1
-                if self.count >= self.total:
-                    self.feed = False
-                    break
 
-            if self.dynamic_epoch:
-                data = self.generate_data()
+    def __iter__(self) -> Iterator[Batch]:
+        itrs = [self._cycle(name) for name in self.names]
+        while True:
+            idx = self.rng.choice(len(itrs), p=self.probs)
+            self.draws += 1
+            yield next(itrs[idx])
+
+    def state_dict(self) -> Dict[str, Any]:
+        """
+        :return: number of draws and the state of each corpus; see BatchIterable.state_dict()
+        """
+        return dict(seed=self.seed, draws=self.draws,
+                    corpora={name: data.state_dict() for name, data in self.corpora.items()
+                             if hasattr(data, 'state_dict')})
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        self.seed, self.draws = state['seed'], state['draws']
+        self.rng = np.random.default_rng(self.seed)
+        self.rng.choice(len(self.names), p=self.probs, size=self.draws)  # replay the past draws
+        for name, data_state in state['corpora'].items():
+            if name in self.corpora and hasattr(self.corpora[name], 'load_state_dict'):
+                self.corpora[name].load_state_dict(data_state)
+
+    @property
+    def num_items(self) -> int:
+        return sum(data.num_items for data in self.corpora.values())
+
+    @property
+    def num_batches(self) -> int:
+        return self.n_batches
+
+
+class SubwordRegBatchIterable(Iterable[Batch]):
+    """
+    Batches of a raw parallel corpus, segmented on the fly with a stochastic tokenizer (e.g.
+    subword regularization), so that every pass over the corpus has a new segmentation.
+    Raw lines are read in chunks, which are tokenized by a pool of worker processes, upto a bounded
+    number of chunks ahead of the consumer. Each chunk is packed into batches of similar lengths
+    (see plan_eq_len_batches) that are yielded in random order; chunks are in corpus order, so the
+    corpus should be shuffled beforehand. Iteration does not stop at the end of the corpus; the
+    passes go on until the consumer stops, e.g. via LoopingIterable.
+    The workers are spawned, not forked: iteration may run in a background thread (see
+    PrefetchIterable) of a process that uses CUDA, which is not safe to fork. So the task is
+    pickled to the workers.
+    """
+
+    def __init__(self, src_path: Union[str, Path], tgt_path: Union[str, Path],
+                 task: TokenizerTask, batch_size: Union[int, Tuple[int, int]], field: Field,
+                 batch_first: bool = True, workers: int = 0, chunk_size: int = 20_000,
+                 prefetch: int = 0, rank: int = None, world_size: int = None,
+                 seed: Optional[int] = None, device=cpu_device, y_is_cls=False):
+        """
+        :param src_path: path to raw source text
+        :param tgt_path: path to raw target text
+        :param task: tokenizer of (src, tgt) records; its tokenizers are called in the workers,
+          so they should be picklable
+        :param batch_size: maximum tokens (or a tuple of maximum tokens, sentences) in a batch
+        :param workers: number of worker processes; default is half of rtg.cpu_count
+        :param chunk_size: number of lines in a chunk
+        :param prefetch: number of chunks to tokenize ahead; default is twice the workers
+        :param rank: rank of this process in distributed training; chunks are sharded across ranks
+        :param world_size: number of processes in distributed training
+        :param seed: seed for the random order of batches
+        """
+        self.src_path, self.tgt_path = src_path, tgt_path
+        self.task = task
+        if isinstance(batch_size, int):
+            self.max_toks, self.max_sents = batch_size, batch_size
+        else:
+            self.max_toks, self.max_sents = batch_size
+        self.field = field
+        self.batch_first = batch_first
+        self.workers = workers if workers > 0 else max(1, cpu_count // 2)
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch if prefetch > 0 else 2 * self.workers
+        self.rank, self.world_size = (rank, world_size) if world_size and world_size > 1 else (0, 1)
+        self.rng = np.random.default_rng(seed)
+        self.device = device
+        self.y_is_cls = y_is_cls
+        self.epoch = 0  # of the chunk being consumed
+        self.n_batches = -1  # unknown
+
+    def _chunks(self) -> Iterator[Tuple[int, List[RawRecord]]]:
+        for epoch in itertools.count(self.epoch):
+            recs = TSVData.read_raw_parallel_lines(self.src_path, self.tgt_path)
+            n_chunks = 0
+            for i, chunk in enumerate(iter(lambda: list(itertools.islice(recs, self.chunk_size)),
+                                           [])):
+                if i % self.world_size == self.rank:
+                    n_chunks += 1
+                    yield epoch, chunk
+            if not n_chunks:
+                raise Exception(f'Found no training data in {self.src_path}, {self.tgt_path}')
+
+    def _batches(self, recs: List[Optional[List]]) -> Iterator[Batch]:
+        recs = [rec for rec in recs if rec is not None]
+        if not recs:
+            return
+        x_lens = np.array([len(x) for x, y in recs])
+        y_lens = np.array([len(y) for x, y in recs])
+        plan = plan_eq_len_batches(np.arange(len(recs)), x_lens, y_lens, max_toks=self.max_toks,
+                                   max_sents=self.max_sents, rng=self.rng)
+        for batch_idxs in plan:
+            batch = [IdExample(x=recs[i][0], y=recs[i][1], id=i) for i in batch_idxs]
+            yield Batch(batch, batch_first=self.batch_first, field=self.field, device=self.device,
+                        y_is_cls=self.y_is_cls)
+
+    def __iter__(self) -> Iterator[Batch]:
+        log.info(f"Tokenizing {self.src_path}, {self.tgt_path} on the fly with {self.workers}"
+                 f" workers; chunk_size={self.chunk_size} prefetch={self.prefetch}")
+        ctx = mp.get_context('spawn')
+        with ctx.Pool(self.workers, initializer=_init_tokenizer_worker,
+                      initargs=(self.task,)) as pool:
+            pending = collections.deque()  # bounded, so that lines are read as needed
+            for epoch, chunk in self._chunks():
+                pending.append((epoch, pool.apply_async(_tokenize_in_worker, (chunk,))))
+                if len(pending) >= self.prefetch:
+                    self.epoch, recs = pending.popleft()
+                    yield from self._batches(recs.get())
+
+    @property
+    def num_batches(self) -> int:
+        return self.n_batches
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#
+# Created: 10/17/26
+
+"""
+Lexical shortlist: restricts the target vocabulary at decoding time to the likely translations of
+the source pieces, plus the frequent target pieces.
+"""
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, List, Tuple, Union
+
+import numpy as np
+import torch
+
+from rtg import log
+from rtg.data.dataset import IdExample
+
+
+@dataclass
+class Shortlist:
+    candidates: torch.Tensor  # [SrcVocab x TopK] target ids for each source id; -1 for none
+    always: torch.Tensor  # [N] target ids that are always in the shortlist
+
+    @classmethod
+    def build(cls, data: Iterable[IdExample], src_vocab: int, tgt_vocab: int, top_k: int = 50,
+              frequent: int = 100, always: List[int] = (), max_examples: int = 0,
+              chunk_size: int = 50_000) -> 'Shortlist':
+        """
+        Builds a shortlist from co-occurrences of source and target pieces in parallel data.
+        The candidates of a source piece are the target pieces of top Dice coefficients:
+          dice(s, t) = 2 * count(s, t) / (count(s) + count(t))
+        where count is the number of sentence pairs having the pieces
+        :param data: parallel sequences of ids
+        :param src_vocab: size of source vocabulary
+        :param tgt_vocab: size of target vocabulary
+        :param top_k: number of candidates for each source piece
+        :param frequent: number of most frequent target pieces that are always in the shortlist
+        :param always: additional target ids that are always in the shortlist (e.g. reserved ids)
+        :param max_examples: build from at most these many examples; 0 for all
+        :param chunk_size: number of examples counted at a time
+        :return: shortlist
+        """
+        src_counts = np.zeros(src_vocab, dtype=np.int64)
+        tgt_counts = np.zeros(tgt_vocab, dtype=np.int64)
+        # pair (s, t) is coded as s * tgt_vocab + t
+        # (pairs, counts) of chunks are merged like a binary counter: a level is merged with the
+        # one below when the one below is not much larger; so each pair is merged O(log n) times
+        levels: List[Tuple[np.ndarray, np.ndarray]] = []
+
+        def _merge(a: Tuple[np.ndarray, np.ndarray], b: Tuple[np.ndarray, np.ndarray]):
+            uniq, idx = np.unique(np.concatenate([a[0], b[0]]), return_inverse=True)
+            counts = np.bincount(idx, weights=np.concatenate([a[1], b[1]]), minlength=len(uniq))
+            return uniq, counts.astype(np.int64)
+
+        def _add(chunk: List[np.ndarray]):
+            level = np.unique(np.concatenate(chunk), return_counts=True)
+            while levels and len(levels[-1][0]) <= 2 * len(level[0]):
+                level = _merge(levels.pop(), level)
+            levels.append(level)
+
+        chunk, count = [], 0
+        for ex in data:
+            xs = np.unique(np.asarray(ex.x, dtype=np.int64))
+            ys = np.unique(np.asarray(ex.y, dtype=np.int64))
+            src_counts[xs] += 1
+            tgt_counts[ys] += 1
+            chunk.append((xs[:, None] * tgt_vocab + ys[None, :]).reshape(-1))
+            count += 1
+            if len(chunk) >= chunk_size:
+                _add(chunk)
+                chunk = []
+            if 0 < max_examples <= count:
+                break
+        if chunk:
+            _add(chunk)
+        pairs, pair_counts = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        while levels:
+            pairs, pair_counts = _merge(levels.pop(), (pairs, pair_counts))
+        log.info(f"Counted {len(pairs):,} co-occurring pairs in {count:,} examples")
+
+        srcs, tgts = pairs // tgt_vocab, pairs % tgt_vocab
+        dice = 2 * pair_counts / (src_counts[srcs] + tgt_counts[tgts])
+        order = np.lexsort((-dice, srcs))  # by source, then by descending dice
+        srcs, tgts = srcs[order], tgts[order]
+        # rank of each pair among the pairs of the same source
+        starts = np.searchsorted(srcs, srcs, side='left')
+        ranks = np.arange(len(srcs)) - starts
+        keep = ranks < top_k
+        candidates = np.full((src_vocab, top_k), fill_value=-1, dtype=np.int64)
+        candidates[srcs[keep], ranks[keep]] = tgts[keep]
+
+        frequent_ids = np.argsort(-tgt_counts, kind='stable')[:frequent]
+        always = np.unique(np.concatenate([frequent_ids, np.asarray(always, dtype=np.int64)]))
+        return cls(candidates=torch.from_numpy(candidates), always=torch.from_numpy(always))
+
+    def vocab_subset(self, x_seqs: torch.Tensor) -> torch.Tensor:
+        """
+        :param x_seqs: source sequences
+        :return: sorted target ids in the shortlist of the given sources
+        """
+        cands = self.candidates[x_seqs.unique().cpu()].view(-1)
+        subset = torch.cat([cands[cands >= 0], self.always]).unique(sorted=True)
+        return subset.to(x_seqs.device)
+
+    def save(self, path: Union[str, Path]):
+        torch.save(dict(candidates=self.candidates, always=self.always), str(path))
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> 'Shortlist':
+        state = torch.load(str(path), map_location='cpu')
+        return cls(candidates=state['candidates'], always=state['always'])
@@ -36,6 +36,23 @@ def parse_args():
                         help='max source len; longer seqs will be truncated')
     parser.add_argument("-nb", '--no-buffer', action='store_true',
                         help='Processes one line per batch followed by flush output')
+    parser.add_argument("-cb", '--continuous', action='store_true',
+                        help='Continuous batching: sentences join and leave a batch as they start'
+                             ' and end, instead of waiting for the longest sentence in the batch')
+    parser.add_argument("-sw", '--sort-window', type=int,
+                        help='Read and sort by length these many lines at a time, and write outputs'
+                             ' as soon as the preceding lines are decoded. Default reads all lines')
+    parser.add_argument("-w", '--workers', type=int,
+                        help='Number of worker processes for decoding on CPU; the model is shared'
+                             ' and the CPU threads (env RTG_CPUS) are divided among the workers')
+    parser.add_argument("-q", '--quantize', action='store_true',
+                        help='Dynamically quantize linear layers to int8 for decoding on CPU')
+    parser.add_argument("-sl", '--shortlist', action='store_true',
+                        help='Restrict the output vocabulary to the lexical shortlist of source'
+                             ' pieces in each batch; the shortlist is built from training data')
+    parser.add_argument("-ema", '--ema', action='store_true',
+                        help='Use the exponential moving average of weights that was maintained'
+                             ' during training (optim.ema in conf.yml)')
     args = vars(parser.parse_args())
     return args
 
@@ -54,6 +71,18 @@ def validate_args(cli_args, conf_args, exp):
         conf_args['batch_size'] = batch_size
     if cli_args.get('max_src_len'):
         conf_args['max_src_len'] = cli_args['max_src_len']
+    if cli_args.pop('continuous', False):
+        conf_args['continuous'] = True
+    if cli_args.get('sort_window'):
+        conf_args['sort_window'] = cli_args['sort_window']
+    if cli_args.get('workers'):
+        conf_args['workers'] = cli_args['workers']
+    if cli_args.pop('quantize', False):
+        conf_args['quantize'] = True
+    if cli_args.pop('shortlist', False):
+        conf_args['shortlist'] = True
+    if cli_args.pop('ema', False):
+        conf_args['ema'] = True
 
 
 def decode_mt(exp, **cli_args):
@@ -61,7 +90,10 @@ def decode_mt(exp, **cli_args):
     validate_args(cli_args, dec_args, exp)
     input: List[TextIO] = cli_args.pop('input')
     output: List[TextIO] = cli_args.pop('output')
-    decoder = Decoder.new(exp, ensemble=dec_args.pop('ensemble', 1))
+    decoder = Decoder.new(exp, ensemble=dec_args.pop('ensemble', 1),
+                          quantize=dec_args.pop('quantize', False),
+                          shortlist=dec_args.pop('shortlist', False),
+                          ema=dec_args.pop('ema', False))
     for inp, out in zip(input, output):
         log.info(f"Decode :: {inp} -> {out}")
         try:
@@ -60,6 +60,9 @@ def parse_args():
 
     parser.add_argument("-en", '--ensemble', type=int, default=1,
                         help='Ensemble best --ensemble models by averaging them')
+    parser.add_argument("-ema", '--ema', action='store_true',
+                        help='Use the exponential moving average of weights that was maintained'
+                             ' during training (optim.ema in conf.yml)')
 
     parser.add_argument("-cb", '--sys-comb', type=Path,
                         help='System combine models at the softmax layer using the weights'
@@ -111,7 +114,7 @@ def main():
                                     weights=weights)
     else:
         decoder = Decoder.new(exp, gen_args=gen_args, model_paths=args.pop('model_path', None),
-                              ensemble=args.pop('ensemble', 1))
+                              ensemble=args.pop('ensemble', 1), ema=args.pop('ema'))
     if args.pop('interactive'):
         if weights:
             log.warning("Interactive shell not reloadable for combo mode. FIXME: TODO:")
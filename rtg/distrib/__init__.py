@@ -3,7 +3,9 @@
 # Author: Thamme Gowda [tg (at) isi (dot) edu] 
 # Created: 7/10/20
 import os
+import random
 import socket
+from contextlib import contextmanager
 from dataclasses import dataclass
 from typing import ClassVar
 from torch import nn
@@ -15,6 +17,7 @@ import torch
 from torch import nn
 
 from rtg import log
+from rtg.distrib.reducer import GradientReducer
 
 get_env = os.environ.get
 
@@ -34,12 +37,15 @@ class DistribTorch:
     visible_devices: str = get_env('CUDA_VISIBLE_DEVICES', '')
     max_norm = 10
     fp16 = False  # Manually enable by calling enable_fp16()
+    grad_bucket_mb: float = 25  # size of gradient buckets for all-reduce
+    grad_fp16: bool = False   # compress gradients to float16 for all-reduce
 
     _scaler = None
     _is_backend_ready = False
     # singleton instance; lazy initialization
     _instance: ClassVar['DistribTorch'] = None
     _model: nn.Module = None
+    _reducer: GradientReducer = None
 
     def setup(self):
         log.info("DistribTorch setup()")
@@ -82,6 +88,8 @@ class DistribTorch:
             if not self._is_backend_ready:
                 self.setup()
             self._model = module
+            self._reducer = GradientReducer(module, bucket_mb=self.grad_bucket_mb,
+                                            fp16=self.grad_fp16)
             #return torch.nn.parallel.DistributedDataParallel(module)
         return module    # don't wrap
 
@@ -97,6 +105,37 @@ class DistribTorch:
     def is_local_main(self) -> bool:
         return self.local_rank <= 0
 
+    def shared_seed(self) -> int:
+        """
+        :return: a random seed that is the same on all ranks; picked by the global main
+        """
+        seed = [random.randrange(2 ** 31)]
+        if self.is_distributed:
+            if not self._is_backend_ready:
+                self.setup()
+            dist.broadcast_object_list(seed, src=0)
+        return seed[0]
+
+    @contextmanager
+    def no_sync(self):
+        """
+        Context for backward of gradient accumulation micro-batches that do not take a step;
+        gradients are not communicated, but accumulated locally until the next step
+        """
+        if self._reducer is None:
+            yield
+        else:
+            with self._reducer.no_sync():
+                yield
+
+    def set_grad_weight(self, weight: float):
+        """
+        Weighs the gradients of this rank (e.g. by its number of tokens) in the average of the next
+        step; all ranks must call this before the backward of the step
+        """
+        if self.is_distributed and self._reducer is not None:
+            self._reducer.set_weight(weight)
+
     def barrier(self):
         if self.is_distributed:
             torch.distributed.barrier()
@@ -113,11 +152,16 @@ class DistribTorch:
         loss.backward()
 
     def average_gradients(self, model):
-        size = float(self.world_size)
-        for param in model.parameters():
-            dist.all_reduce(param.grad.data, op=dist.reduce_op.SUM)
-            # TODO: ring reduce https://pytorch.org/tutorials/intermediate/dist_tuto.html#our-own-ring-allreduce
-            param.grad.data /= size
+        """
+        Averages gradients across ranks. The buckets of gradients that were ready during backward
+        are already being reduced in background; see GradientReducer
+        """
+        if self._reducer is None or self._reducer.model is not model:
+            if self._reducer is not None:
+                self._reducer.close()
+            self._reducer = GradientReducer(model, bucket_mb=self.grad_bucket_mb,
+                                            fp16=self.grad_fp16)
+        self._reducer.synchronize()
 
     def step(self, optimizer: Optimizer):
         if self.is_distributed:
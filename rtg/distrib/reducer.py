@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+#
+# Created: 10/17/26
+
+"""
+Bucketed and asynchronous all-reduce of gradients for data parallel training
+"""
+from contextlib import contextmanager
+from typing import List, Optional
+
+import torch
+import torch.distributed as dist
+from torch import nn
+
+from rtg import log
+
+
+class GradientReducer:
+    """
+    Averages the gradients of a model across ranks. Gradients are flattened into buckets of upto
+    `bucket_mb` megabytes, and the all-reduce of a bucket is launched (async) as soon as all its
+    gradients are accumulated during backward, so that the communication overlaps with the rest of
+    the backward. synchronize() waits for all buckets and copies the averages back to the gradients.
+
+    Buckets are launched as they fill, without waiting for the earlier buckets, so a late or unused
+    parameter delays only its own bucket. The order in which buckets fill is decided by the
+    autograd graph, which is the same on all ranks, so all ranks launch them in the same order.
+    The buckets that did not fill during backward (e.g. with unused parameters) are launched by
+    synchronize() in the order of their index.
+
+    Buckets are launched during backward only after set_weight() is called for the step; it
+    announces that the next backward completes the gradients. Otherwise, all buckets are reduced
+    by synchronize(), so that trainers that call backward multiple times per step (e.g. gradient
+    accumulation without no_sync()) do not reduce a bucket more than once.
+    For gradient accumulation, use no_sync() for the backward of micro-batches that do not take a
+    step: they do not communicate at all, and their gradients are reduced along with the last one.
+    Gradients accumulated in no_sync() after set_weight() (e.g. of the generator, by a chunked
+    loss) are counted as ready as soon as the next backward outside of no_sync() begins.
+
+    The weights of ranks (set_weight()) are summed by the same all-reduce, as an extra element in
+    the last bucket, and the averages are normalized by the sum in synchronize().
+    """
+
+    def __init__(self, model: nn.Module, bucket_mb: float = 25, fp16: bool = False,
+                 group: Optional[dist.ProcessGroup] = None):
+        """
+        :param model: model whose gradients are to be averaged
+        :param bucket_mb: maximum size of a bucket in megabytes
+        :param fp16: compress the buckets to float16 for communication
+        :param group: process group; default is the world
+        """
+        assert bucket_mb > 0
+        self.model = model
+        self.fp16 = fp16
+        self.group = group
+        self.world_size = dist.get_world_size(group)
+        self.require_sync = True   # launch buckets from backward hooks
+        params = [p for p in model.parameters() if p.requires_grad]
+        self.buckets: List[List[nn.Parameter]] = []
+        self._bucket_of = {}   # param index -> bucket index
+        max_bytes = bucket_mb * 2 ** 20
+        size = 0
+        for idx, param in reversed(list(enumerate(params))):
+            bucket = self.buckets[-1] if self.buckets else None
+            nbytes = param.numel() * param.element_size()
+            if not bucket or size + nbytes > max_bytes or bucket[0].dtype != param.dtype \
+                    or bucket[0].device != param.device:
+                bucket = []
+                self.buckets.append(bucket)
+                size = 0
+            bucket.append(param)
+            size += nbytes
+            self._bucket_of[idx] = len(self.buckets) - 1
+        # the last bucket has an extra element for the weight of rank
+        self._buffers = [torch.empty(sum(p.numel() for p in bucket) + (b == len(self.buckets) - 1),
+                                     device=bucket[0].device,
+                                     dtype=torch.float16 if fp16 else bucket[0].dtype)
+                         for b, bucket in enumerate(self.buckets)]
+        # sum of weights of ranks in the previous step; keeps weighted grads in the range of fp16
+        self._ref_weight: Optional[torch.Tensor] = None
+        self._grad_accs = []  # keeps the grad accumulators alive, for hooks on older torch
+        self._hooks = [self._register_hook(param, idx) for idx, param in enumerate(params)]
+        self._reset()
+        log.info(f"Gradient all-reduce: {len(params)} params in {len(self.buckets)} buckets of"
+                 f" upto {bucket_mb}MB; fp16 compression: {fp16}")
+
+    def _register_hook(self, param: nn.Parameter, idx: int):
+        if hasattr(param, 'register_post_accumulate_grad_hook'):  # torch 2.1+
+            return param.register_post_accumulate_grad_hook(lambda p: self._on_grad_ready(idx))
+        grad_acc = param.expand_as(param).grad_fn.next_functions[0][0]
+        self._grad_accs.append(grad_acc)
+        return grad_acc.register_hook(lambda *args: self._on_grad_ready(idx))
+
+    def _reset(self):
+        n = len(self.buckets)
+        self._ready = [set() for _ in range(n)]
+        self._works = [None] * n
+        self._stale = [False] * n
+        self._deferred = set()  # params accumulated in no_sync() after set_weight()
+        self._armed = False     # set_weight() is called; launch buckets from backward hooks
+        self._scale = 1 / self.world_size  # weight of this rank in the average
+
+    @contextmanager
+    def no_sync(self):
+        """
+        Context for backward of gradient accumulation micro-batches: the gradients are only
+        accumulated locally, and are reduced by the next synchronize()
+        """
+        prev, self.require_sync = self.require_sync, False
+        try:
+            yield
+        finally:
+            self.require_sync = prev
+
+    def set_weight(self, weight: float = 1.):
+        """
+        Sets the weight (e.g. number of tokens) of this rank in the average of the next
+        synchronize(), and enables launching of buckets during the next backward. All ranks must
+        call it before the backward of the step. Only the first call communicates.
+        :param weight: weight of this rank; must be positive on atleast one rank
+        """
+        device = self._buffers[0].device
+        if self._ref_weight is None:  # first step; weighted grads may overflow fp16 without this
+            total = torch.tensor([float(weight)], dtype=torch.float32, device=device)
+            dist.all_reduce(total, group=self.group)
+            self._ref_weight = total[0]
+        self._scale = weight / self._ref_weight
+        self._armed = True
+
+    def _on_grad_ready(self, idx: int):
+        if not self._armed:   # reduced by synchronize()
+            return
+        if not self.require_sync:
+            self._deferred.add(idx)
+            return
+        if self._deferred:
+            deferred, self._deferred = self._deferred, set()
+            for i in sorted(deferred):
+                self._mark_ready(i)
+        self._mark_ready(idx)
+
+    def _mark_ready(self, idx: int):
+        b = self._bucket_of[idx]
+        if self._works[b] is not None:   # already launched, but the grads changed
+            self._stale[b] = True
+            return
+        self._ready[b].add(idx)
+        if len(self._ready[b]) == len(self.buckets[b]):
+            self._launch(b)
+
+    def _launch(self, b: int):
+        if self._works[b] is not None:
+            self._works[b].wait()
+        buffer, offset = self._buffers[b], 0
+        for param in self.buckets[b]:
+            n = param.numel()
+            if param.grad is None:  # unused in this step, but maybe not on the other ranks
+                buffer[offset: offset + n].zero_()
+            else:  # scale before casting, so that fp16 doesnt overflow
+                buffer[offset: offset + n].copy_(param.grad.detach().view(-1) * self._scale)
+            offset += n
+        if b == len(self.buckets) - 1:
+            buffer[offset:].fill_(self._scale)
+        self._works[b] = dist.all_reduce(buffer, group=self.group, async_op=True)
+        self._stale[b] = False
+
+    @torch.no_grad()
+    def synchronize(self):
+        """
+        Launches the remaining buckets, waits for all, and sets the averaged gradients
+        """
+        for b in range(len(self.buckets)):
+            if self._works[b] is None or self._stale[b]:
+                self._launch(b)
+        for work in self._works:
+            work.wait()
+        # sum of scaled weights of ranks; no host sync
+        total = self._buffers[-1][-1].to(torch.float32, copy=True)
+        for b, bucket in enumerate(self.buckets):
+            buffer, offset = self._buffers[b], 0
+            for param in bucket:
+                n = param.numel()
+                grad = buffer[offset: offset + n].view_as(param).to(param.dtype) / total
+                if param.grad is None:
+                    param.grad = grad
+                else:
+                    param.grad.copy_(grad)
+                offset += n
+        if self._armed:
+            self._ref_weight = total * self._ref_weight
+        self._reset()
+
+    def close(self):
+        """Removes the hooks from model"""
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
@@ -1,6 +1,7 @@
 import copy
 import os
 import random
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
 from pathlib import Path
 from functools import partial
@@ -12,10 +13,13 @@ import torch
 import hashlib
 import portalocker
 
-from rtg import log, yaml, device
-from rtg.data.dataset import (TSVData, BatchIterable, LoopingIterable, SqliteFile, GenerativeBatchIterable)
+from rtg import log, yaml, device, cpu_count
+from rtg.data.dataset import (TSVData, BatchIterable, LoopingIterable, SqliteFile, MemmapFile,
+                              SubwordRegBatchIterable, TokenizerTask, MultiCorpusBatchIterable)
 from rtg.data.codec import Field, SPField, NLField, PretrainMatchField
-from rtg.utils import IO, line_count
+from rtg.data.shortlist import Shortlist
+from rtg.distrib import DistribTorch
+from rtg.utils import IO, line_count, cpu_copy
 
 
 seeded = False
@@ -41,6 +45,8 @@ class BaseExperiment:
         self.data_dir = work_dir / 'data'
         self.model_dir = work_dir / 'models'
         self._config_file = work_dir / 'conf.yml'
+        self._store_pool: Optional[ThreadPoolExecutor] = None  # writes models in background
+        self._store_job: Optional[Future] = None  # at most one model is written at a time
         if isinstance(config, str) or isinstance(config, Path):
             config = load_conf(config)
         self.config = config if config else load_conf(self._config_file)
@@ -60,6 +66,7 @@ class BaseExperiment:
         self.train_file = self.data_dir / 'train.tsv.gz'
         self.train_db = self.data_dir / 'train.db'
         self.train_db_tmp = self.data_dir / 'train.db.tmp'
+        self.train_mmap = self.data_dir / 'train.mmap'
         self.finetune_file = self.data_dir / 'finetune.db'
         self.valid_file = self.data_dir / 'valid.tsv.gz'
         self.combo_file = self.data_dir / 'combo.tsv.gz'
@@ -114,7 +121,7 @@ class BaseExperiment:
         return self._trained_flag.exists()
 
     def store_model(self, optimizer_step: int, model, train_score: float, val_score: float, keep: int,
-                    prefix='model', keeper_sort='step'):
+                    prefix='model', keeper_sort='step', background=False):
         """
         saves model to a given path
         :param optimizer_step: optimizer step of the model
@@ -125,22 +132,45 @@ class BaseExperiment:
         :param prefix: prefix to store model. default is "model"
         :param keeper_sort: criteria for choosing the old or bad models for deletion.
             Choices: {'total_score', 'step'}
+        :param background: copy the tensors of model (state dict) to CPU memory, and write them
+          (and delete the old models) in a background thread. Waits for the previous write, if any
         :return:
         """
         # TODO: improve this by skipping the model save if the model is not good enough to be saved
         if self.read_only:
             log.warning("Ignoring the store request; experiment is readonly")
             return
+        self.wait_for_models()
+        args = (optimizer_step, model, train_score, val_score, keep, prefix, keeper_sort)
+        if not background:
+            return self._store_model(*args)
+        args = (optimizer_step, cpu_copy(model), *args[2:])
+        if self._store_pool is None:
+            self._store_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ModelWriter')
+        self._store_job = self._store_pool.submit(self._store_model, *args)
+
+    def wait_for_models(self):
+        """
+        Waits for the model that is being written in background, if any; see store_model()
+        """
+        if self._store_job is not None:
+            job, self._store_job = self._store_job, None
+            job.result()  # raises the error, if any
+
+    def _store_model(self, optimizer_step: int, model, train_score: float, val_score: float,
+                     keep: int, prefix: str, keeper_sort: str):
         name = f'{prefix}_{optimizer_step:03d}_{train_score:.6f}_{val_score:.6f}.pkl'
         path = self.model_dir / name
         log.info(f"Saving optimizer step {optimizer_step} to {path}")
-        torch.save(model, str(path))
+        tmp_path = path.with_name(name + '.tmp')
+        torch.save(model, str(tmp_path))
+        os.replace(tmp_path, path)  # atomic; a partially written model is never listed
 
         del_models = []
         if keeper_sort == 'total_score':
-            del_models = self.list_models(sort='total_score', desc=False)[keep:]
+            del_models = self._list_models(sort='total_score', desc=False)[keep:]
         elif keeper_sort == 'step':
-            del_models = self.list_models(sort='step', desc=True)[keep:]
+            del_models = self._list_models(sort='step', desc=True)[keep:]
         else:
             Exception(f'Sort criteria{keeper_sort} not understood')
         for d_model in del_models:
@@ -181,6 +211,10 @@ class BaseExperiment:
         :param desc: True to sort in reverse (default); False to sort in ascending
         :return: list of model paths
         """
+        self.wait_for_models()
+        return self._list_models(sort=sort, desc=desc)
+
+    def _list_models(self, sort: str, desc: bool) -> List[Path]:
         paths = list(self.model_dir.glob('model_*.pkl'))
         if not paths:
             paths = list(self.model_dir.glob('embeddings_*.gz'))
@@ -293,45 +327,92 @@ class BaseExperiment:
         raise NotImplementedError()
 
     def reload(self):
+        self.wait_for_models()
         exp = type(self)(self.work_dir, read_only=self.read_only)
         self.__dict__ = exp.__dict__
 
     @classmethod
-    def _checkpt_to_model_state(cls, checkpt_path: Union[str, Path]):
-        state = torch.load(checkpt_path, map_location=device)
+    def _checkpt_to_model_state(cls, checkpt_path: Union[str, Path], map_location=None,
+                                mmap=False, ema=False):
+        """
+        Loads model state from a checkpoint
+        :param checkpt_path: path to checkpoint
+        :param map_location: device to load the tensors to; default is rtg.device
+        :param mmap: memory map the checkpoint file instead of reading it; tensors (e.g. of
+          optimizer state) are not read from disk unless they are used.
+          Ignored for checkpoints in the legacy (non zip) format of torch.save, and on torch < 2.1
+        :param ema: get the exponential moving average of weights (see trainer.WeightsEMA)
+          instead of the weights
+        :return: model state dict
+        """
+        map_location = device if map_location is None else map_location
+        state = None
+        if mmap:
+            try:
+                state = torch.load(checkpt_path, map_location=map_location, mmap=True)
+            except (RuntimeError, TypeError) as e:  # TypeError: torch < 2.1 has no mmap arg
+                log.warning(f"Could not memory map {checkpt_path}; reading it instead. {e}")
+        if state is None:
+            state = torch.load(checkpt_path, map_location=map_location)
+        if ema:
+            if 'ema_state' in state:
+                state = state['ema_state']
+            else:
+                log.warning(f"{checkpt_path} has no EMA of weights; using the weights instead")
         if 'model_state' in state:
             state = state['model_state']
         return state
 
     @classmethod
-    def average_states(cls, model_paths: List[Path]):
+    def average_states(cls, model_paths: List[Path], mmap=True, ema=False):
+        """
+        Averages the model states of checkpoints. Checkpoints are read one at a time, and
+        accumulated in place in a float32 copy on CPU, so the memory stays around two model states
+        regardless of the number of checkpoints
+        :param model_paths: paths to checkpoints
+        :param mmap: memory map the checkpoints; see _checkpt_to_model_state
+        :param ema: average the EMA of weights of checkpoints; see _checkpt_to_model_state
+        :return: averaged state dict, on rtg.device
+        """
         assert model_paths, 'at least one model checkpoint should be given. Check your directory'
+        dtypes, state_dict = {}, None
         for i, mp in enumerate(model_paths):
-            next_state = cls._checkpt_to_model_state(mp)
-            if i < 1:
-                state_dict = next_state
-                key_set = set(state_dict.keys())
+            log.info(f"Averaging checkpoint {i + 1}/{len(model_paths)}: {mp}")
+            next_state = cls._checkpt_to_model_state(mp, map_location='cpu', mmap=mmap, ema=ema)
+            if state_dict is None:
+                dtypes = {key: val.dtype for key, val in next_state.items()}
+                # only floats are averaged; the rest (e.g. int buffers) are taken from the first
+                state_dict = {key: val.to(torch.float32, copy=True) if val.is_floating_point()
+                              else val.clone() for key, val in next_state.items()}
             else:
-                # noinspection PyUnboundLocalVariable
-                assert key_set == set(next_state.keys())
-                for key in key_set:     # Running average
-                    state_dict[key] = (i*state_dict[key] + next_state[key]) / (i + 1)
+                assert set(state_dict.keys()) == set(next_state.keys())
+                for key, val in next_state.items():
+                    if val.is_floating_point():
+                        state_dict[key].add_(val)
+            del next_state
+        for key, val in state_dict.items():
+            if val.is_floating_point():
+                val.div_(len(model_paths))
+            state_dict[key] = val.to(device=device, dtype=dtypes[key])
         return state_dict
 
-    def maybe_ensemble_state(self, model_paths: Optional[List[str]], ensemble: int = 1):
+    def maybe_ensemble_state(self, model_paths: Optional[List[str]], ensemble: int = 1,
+                             ema=False):
         if model_paths and len(model_paths) == 1:
             log.info(f" Restoring state from requested model {model_paths[0]}")
-            return self._checkpt_to_model_state(model_paths[0])
+            return self._checkpt_to_model_state(model_paths[0], ema=ema)
         elif not model_paths and ensemble <= 1:
             model_path, _ = self.get_best_known_model()
             log.info(f" Restoring state from best known model: {model_path}")
-            return self._checkpt_to_model_state(model_path)
+            return self._checkpt_to_model_state(model_path, ema=ema)
         else:
             if not model_paths:
                 # Average last n models
                 model_paths = self.list_models(sort='step', desc=True)[:ensemble]
             digest = hashlib.md5(";".join(str(p) for p in model_paths).encode('utf-8')).hexdigest()
             cache_file = self.model_dir / f'avg_state{len(model_paths)}_{digest}.pkl'
+            if ema:
+                cache_file = cache_file.with_name(f'avg_ema{len(model_paths)}_{digest}.pkl')
             lock_file = cache_file.with_suffix('.lock')
             MAX_TIMEOUT = 1 * 60 * 60  # 1 hour
             with portalocker.Lock(lock_file, 'w', timeout=MAX_TIMEOUT) as fh:
@@ -341,17 +422,17 @@ class BaseExperiment:
                     state = self._checkpt_to_model_state(cache_file)
                 else:
                     log.info(f"Averaging {len(model_paths)} model states :: {model_paths}")
-                    state = self.average_states(model_paths)
+                    state = self.average_states(model_paths, ema=ema)
                     if len(model_paths) > 1:
                         log.info(f"Caching the averaged state at {cache_file}")
                         torch.save(state, str(cache_file))
             return state
         
-    def load_model(self, model_paths=None, ensemble=1):
+    def load_model(self, model_paths=None, ensemble=1, ema=False):
         from rtg.registry import factories
         factory = factories[self.model_type]
         model = factory(exp=self, **self.model_args)[0]
-        state = self.maybe_ensemble_state(model_paths=model_paths, ensemble=ensemble)
+        state = self.maybe_ensemble_state(model_paths=model_paths, ensemble=ensemble, ema=ema)
         errors = model.load_state_dict(state)
         log.info(f"{errors}")
         return model
@@ -365,6 +446,9 @@ class BaseExperiment:
         # Dummy experiment wrapper
         factory = factories[model_type]
         model = factory(exp=self, **model_args)[0]
+        from rtg.module.quantize import quantize_model, is_quantized_state
+        if is_quantized_state(state):
+            model = quantize_model(model.eval())
         errors = model.load_state_dict(state)
         log.info(f"{errors}")
         log.info(f"Successfully restored the model state of : {model_type}")
@@ -400,6 +484,7 @@ class TranslationExperiment(BaseExperiment):
         self.mono_valid_tgt = self.data_dir / 'mono.valid.tgt.gz'
 
         self.parent_model_state = self.data_dir / 'parent_model_state.pt'
+        self.shortlist_file = self.data_dir / 'shortlist.pt'
 
     @property
     def problem_type(self):
@@ -429,32 +514,47 @@ class TranslationExperiment(BaseExperiment):
             log.warning(f"Going to count lines. If this is a big dataset, it will take long time")
             self.check_line_count('training', args['train_src'], args['train_tgt'])
 
+        corpora = args.get('corpora') or {}
+        for name, corpus in corpora.items():
+            assert 'src' in corpus and 'tgt' in corpus, f'prep.corpora.{name} needs src and tgt'
+            self.check_line_count(f'{name} corpus', corpus['src'], corpus['tgt'])
+
         xt_args = dict(no_split_toks=args.get('no_split_toks'),
                        char_coverage=args.get('char_coverage', 0))
         if args.get('shared_vocab'):  # shared vocab
             corpus = [args[key] for key in ['train_src', 'train_tgt', 'mono_src', 'mono_tgt']
                       if args.get(key)]
+            corpus += [corp[side] for corp in corpora.values() for side in ('src', 'tgt')]
             self.shared_field = self._make_vocab("shared", self._shared_field_file, args['pieces'],
                                                  args['max_types'], corpus=corpus, **xt_args)
         else:  # separate vocabularies
             src_corpus = [args[key] for key in ['train_src', 'mono_src'] if args.get(key)]
+            src_corpus += [corp['src'] for corp in corpora.values()]
             self.src_field = self._make_vocab("src", self._src_field_file, args['pieces'],
                                               args['max_src_types'], corpus=src_corpus, **xt_args)
 
             # target vocabulary
             tgt_corpus = [args[key] for key in ['train_tgt', 'mono_tgt'] if args.get(key)]
+            tgt_corpus += [corp['tgt'] for corp in corpora.values()]
             self.tgt_field = self._make_vocab("src", self._tgt_field_file, args['pieces'],
                                               args['max_tgt_types'], corpus=tgt_corpus, **xt_args)
 
-        train_file = self.train_db
+        data_format = args.get('data_format', 'sqlite')
+        assert data_format in ('sqlite', 'mmap'), f'prep.data_format={data_format} is unknown'
+        train_file = self.train_mmap if data_format == 'mmap' else self.train_db
 
         self._pre_process_parallel('train_src', 'train_tgt', out_file=train_file, args=args,
                                    line_check=False)
+        for name, corpus in corpora.items():
+            self._pre_process_parallel('src', 'tgt', out_file=self.corpus_file(name, data_format),
+                                       args=dict(args, **corpus), line_check=False)
         self._pre_process_parallel('valid_src', 'valid_tgt', out_file=self.valid_file, args=args,
                                    line_check=False)
 
         if args.get("finetune_src") or args.get("finetune_tgt"):
             self._pre_process_parallel('finetune_src', 'finetune_tgt', self.finetune_file)
+        if args.get('shortlist'):
+            self.make_shortlist()
 
         # get samples from validation set
         n_samples = args.get('num_samples', 5)
@@ -572,12 +672,16 @@ class TranslationExperiment(BaseExperiment):
         parallel_recs = reader_func(
             args[src_key], args[tgt_key], args['truncate'], args['src_len'], args['tgt_len'],
             src_tokenizer=partial(self.src_vocab.encode_as_ids, split_ratio=split_ratio),
-            tgt_tokenizer=partial(self.tgt_vocab.encode_as_ids, split_ratio=split_ratio))
+            tgt_tokenizer=partial(self.tgt_vocab.encode_as_ids, split_ratio=split_ratio),
+            workers=cpu_count)
         if any([out_file.name.endswith(suf) for suf in ('.nldb', '.nldb.tmp')]):
             from nlcodec.db import MultipartDb
             MultipartDb.create(path=out_file, recs=parallel_recs, field_names=('x', 'y'))
         elif any([out_file.name.endswith(suf) for suf in ('.db', '.db.tmp')]):
             SqliteFile.write(out_file, records=parallel_recs)
+        elif out_file.name.endswith('.mmap'):
+            vocab_size = max(len(self.src_vocab), len(self.tgt_vocab))
+            MemmapFile.write(out_file, records=parallel_recs, vocab_size=vocab_size)
         else:
             TSVData.write_parallel_recs(parallel_recs, out_file)
         e_time = time.time()
@@ -586,7 +690,8 @@ class TranslationExperiment(BaseExperiment):
             # Redo again as plain text files
             parallel_recs = reader_func(
                 args[src_key], args[tgt_key], args['truncate'], args['src_len'], args['tgt_len'],
-                src_tokenizer=self.src_vocab.tokenize, tgt_tokenizer=self.tgt_vocab.tokenize)
+                src_tokenizer=self.src_vocab.tokenize, tgt_tokenizer=self.tgt_vocab.tokenize,
+                workers=cpu_count)
 
             text_file_name = str(out_file).replace('.db', '.tsv.gz').replace('.tsv', '.pieces.tsv')
             TSVData.write_parallel_recs(parallel_recs, text_file_name)
@@ -803,6 +908,33 @@ class TranslationExperiment(BaseExperiment):
         self.persist_state()
         self._prepared_flag.touch()
 
+    def make_shortlist(self) -> Shortlist:
+        """
+        Builds lexical shortlist from training data and stores it; see rtg.data.shortlist.
+        The args are read from prep.shortlist of config: top_k, frequent, and max_examples
+        """
+        args = self.config.get('prep', {}).get('shortlist')
+        args = args if isinstance(args, dict) else {}
+        prep = self.config.get('prep', {})
+        len_args = dict(max_src_len=prep.get('src_len', 512), max_tgt_len=prep.get('tgt_len', 512))
+        if self.train_mmap.exists():
+            log.info(f"Building lexical shortlist from {self.train_mmap} ; args: {args}")
+            data = MemmapFile(self.train_mmap, sort_by=None, truncate=True, **len_args)
+        else:
+            log.info(f"Building lexical shortlist from {self.train_db} ; args: {args}")
+            data = SqliteFile(self.train_db, sort_by=None, truncate=True, **len_args)
+        shortlist = Shortlist.build(data, src_vocab=len(self.src_vocab),
+                                    tgt_vocab=len(self.tgt_vocab),
+                                    always=self.tgt_vocab.reserved_idxs, **args)
+        shortlist.save(self.shortlist_file)
+        log.info(f"Stored lexical shortlist at {self.shortlist_file}")
+        return shortlist
+
+    def get_shortlist(self) -> Shortlist:
+        if not self.shortlist_file.exists():
+            return self.make_shortlist()
+        return Shortlist.load(self.shortlist_file)
+
     def persist_state(self):
         """Writes state of current experiment to the disk"""
         assert not self.read_only
@@ -855,6 +987,7 @@ class TranslationExperiment(BaseExperiment):
                                             model_factory=factories[self.model_type], **optim_args)
         if last_step < train_steps:  # regular training
             stopped = trainer.train(fine_tune=False, **run_args)
+            self.wait_for_models()
             if not self.read_only:
                 status = dict(steps=train_steps, early_stopped=stopped, finetune=False)
                 try:
@@ -869,6 +1002,7 @@ class TranslationExperiment(BaseExperiment):
             run_args['batch_size'] = finetune_batch_size
 
             stopped = trainer.train(fine_tune=True, **run_args)
+            self.wait_for_models()
             status = dict(steps=finetune_steps, early_stopped=stopped, finetune=True)
             try:
                 status['earlier'] = yaml.load(self._trained_flag.read_text())
@@ -890,11 +1024,34 @@ class TranslationExperiment(BaseExperiment):
                 [('src_len', 'max_src_len'), ('tgt_len', 'max_tgt_len'), ('truncate', 'truncate')]
                 if ik in prep_args}
 
+    def corpus_file(self, name: str, data_format: str = None) -> Path:
+        """
+        :param name: name of an extra training corpus; see prep.corpora
+        :param data_format: sqlite or mmap; default is the one that exists
+        :return: path to prepared data of the corpus
+        """
+        paths = dict(sqlite=self.data_dir / f'train.{name}.db',
+                     mmap=self.data_dir / f'train.{name}.mmap')
+        if not data_format:
+            data_format = 'mmap' if paths['mmap'].exists() else 'sqlite'
+        return paths[data_format]
+
     def get_train_data(self, batch_size:  Union[int, Tuple[int,int]], steps: int = 0, sort_by='eq_len_rand_batch',
                        batch_first=True, shuffle=False, fine_tune=False, keep_in_mem=False,
-                       split_ratio: float = 0., dynamic_epoch=False, y_is_cls=False):
+                       split_ratio: float = 0., dynamic_epoch=False, y_is_cls=False,
+                       swr_workers: int = 0, corpus_weights: Optional[Dict[str, float]] = None,
+                       corpus_temperature: float = 1., len_jitter: float = 0.):
+        """
+        :param len_jitter: noise in lengths for sorting eq_len_rand_batch; see plan_eq_len_batches
+        :param corpus_weights: sampling weights of training corpora; 'train' is the corpus of
+          prep.train_src and prep.train_tgt, and the rest are the names in prep.corpora.
+          see MultiCorpusBatchIterable
+        :param corpus_temperature: temperature for sampling corpora
+        """
 
         data_path = self.train_db if self.train_db.exists() else self.train_file
+        if self.train_mmap.exists() and not split_ratio > 0:  # split_ratio re-creates the db
+            data_path = self.train_mmap
         if fine_tune:
             if not self.finetune_file.exists():
                 # user may have added fine tune file later
@@ -902,29 +1059,46 @@ class TranslationExperiment(BaseExperiment):
             log.info("Using Fine tuning corpus instead of training corpus")
             data_path = self.finetune_file
 
+        # each rank trains on its own shard; the shards are planned with a seed shared by all ranks
+        dtorch = DistribTorch.instance()
+        shard_args = {}
+        if dtorch.is_distributed:
+            shard_args = dict(rank=dtorch.global_rank, world_size=dtorch.world_size,
+                              seed=self.config['seed'] if 'seed' in self.config else dtorch.shared_seed())
+
         if split_ratio > 0:
-            data_path = IO.maybe_tmpfs(data_path)
-            train_file = data_path.with_suffix('.db.tmp')
+            # subword regularization: raw text is segmented on the fly, every pass differently
             assert not y_is_cls, 'Not supported feature'
-            file_creator = partial(self.file_creator, train_file=train_file, split_ratio=split_ratio)
-            train_data = GenerativeBatchIterable(
-                file_creator=file_creator, batches=steps, batch_size=batch_size, field=self.tgt_vocab,
-                dynamic_epoch=dynamic_epoch, batch_first=batch_first, shuffle=shuffle, sort_by=sort_by,
-                **self._get_batch_args())
+            if not dynamic_epoch:
+                log.info("split_ratio > 0 segments every epoch differently; dynamic_epoch is implied")
+            prep = self.config['prep']
+            task = TokenizerTask(
+                [partial(self.src_vocab.encode_as_ids, split_ratio=split_ratio),
+                 partial(self.tgt_vocab.encode_as_ids, split_ratio=split_ratio)],
+                lengths=[prep['src_len'], prep['tgt_len']], truncate=prep['truncate'])
+            data = SubwordRegBatchIterable(
+                prep['train_src'], prep['train_tgt'], task=task, batch_size=batch_size,
+                field=self.tgt_vocab, batch_first=batch_first, workers=swr_workers, **shard_args)
+            train_data = LoopingIterable(data, steps)
         else:
-            data = BatchIterable(
-                data_path=data_path, batch_size=batch_size, field=self.tgt_vocab, sort_by=sort_by,
-                batch_first=batch_first, shuffle=shuffle, y_is_cls=y_is_cls, **self._get_batch_args())
+            corpora = {} if fine_tune else self.config['prep'].get('corpora') or {}
+            paths = dict(train=data_path, **{name: self.corpus_file(name) for name in corpora})
+            datas = {name: BatchIterable(
+                data_path=path, batch_size=batch_size, field=self.tgt_vocab, sort_by=sort_by,
+                batch_first=batch_first, shuffle=shuffle, y_is_cls=y_is_cls, len_jitter=len_jitter,
+                **shard_args,
+                **self._get_batch_args()) for name, path in paths.items()}
+            if len(datas) > 1:
+                data = MultiCorpusBatchIterable(datas, weights=corpus_weights,
+                                                temperature=corpus_temperature,
+                                                seed=shard_args.get('seed'))
+            else:
+                data = datas['train']
             train_data = LoopingIterable(data, steps)
 
         return train_data
 
 
-    def file_creator(self, train_file, split_ratio, *args, **kwargs):
-        self._pre_process_parallel(*args, src_key='train_src', tgt_key='train_tgt',
-                                   out_file=train_file, split_ratio=split_ratio, **kwargs)
-        return train_file
-
     def get_val_data(self, batch_size: Union[int, Tuple[int,int]], sort_desc=False, batch_first=True,
                      shuffle=False, y_is_cls=False):
         raw_path = None
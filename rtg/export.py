@@ -6,8 +6,12 @@ from rtg.exp import TranslationExperiment as Experiment
 from dataclasses import dataclass
 from pathlib import Path
 from rtg.module.decoder import Decoder
+from rtg.module.quantize import quantize_model
 from rtg import log, device, yaml
 from rtg.utils import IO
+from sacrebleu import corpus_bleu
+from typing import Optional
+from io import StringIO
 import datetime
 
 import os
@@ -19,8 +23,30 @@ import argparse
 class ExperimentExporter:
     exp: Experiment
 
+    def validation_bleu(self, model) -> Optional[float]:
+        """
+        Decodes the validation set with model, using the decoder args from config
+        :param model: model to be evaluated
+        :return: BLEU or None if the validation set is unknown
+        """
+        prep = self.exp.config.get('prep', {})
+        if not ('valid_src' in prep and 'valid_tgt' in prep):
+            log.warning("Validation BLEU is not possible; prep.valid_src or valid_tgt is unknown")
+            return None
+        dec_args = self.exp.config.get('decoder') or self.exp.config['tester'].get('decoder', {})
+        dec_args = {k: v for k, v in dec_args.items() if k not in Decoder.new_args}
+        dec_args['num_hyp'] = 1
+        decoder = Decoder.new(self.exp, model=model)
+        out = StringIO()
+        with IO.reader(prep['valid_src']) as inp:
+            decoder.decode_file(inp, out, **dec_args)
+        hyps = [line.split('\t')[0] for line in out.getvalue().splitlines()]
+        with IO.reader(prep['valid_tgt']) as refs:
+            refs = [line.strip() for line in refs]
+        return corpus_bleu(hyps, [refs]).score
+
     def export(self, target: Path, name: str=None, ensemble: int = 1, copy_config=True,
-               copy_vocab=True):
+               copy_vocab=True, quantize=False, ema=False):
         to_exp = Experiment(target.resolve(), config=self.exp.config)
 
         if copy_config:
@@ -37,14 +63,26 @@ class ExperimentExporter:
         model_paths = self.exp.list_models()[:ensemble]
         log.info(f'Model paths: {model_paths}')
         chkpt_state = torch.load(model_paths[0], map_location=device)
-        if ensemble > 1:
-            log.info("Averaging them ...")
-            avg_state = self.exp.average_states(model_paths)
+        if ensemble > 1 or ema:
+            log.info("Averaging them ..." if ensemble > 1 else "Getting EMA of weights ...")
+            avg_state = self.exp.average_states(model_paths, ema=ema)
             chkpt_state = dict(model_state=avg_state,
                                model_type=chkpt_state['model_type'],
                                model_args=chkpt_state['model_args'])
         log.info("Instantiating it ...")
         model = self.exp.load_model_with_state(checkpt_state=chkpt_state)
+        parity = {}
+        if quantize:
+            model = model.eval()
+            int8_model = quantize_model(model)
+            if device.type == 'cpu':
+                log.info("Parity check: validation BLEU of fp32 and int8 models")
+                parity = dict(bleu_fp32=self.validation_bleu(model),
+                              bleu_int8=self.validation_bleu(int8_model))
+                log.info(f"Parity check: {parity}")
+            else:
+                log.warning("Parity check is skipped; quantized models run on CPU only")
+            model = int8_model
         log.info(f"Exporting to {target}")
         to_exp = Experiment(target, config=self.exp.config)
         to_exp.persist_state()
@@ -64,6 +102,10 @@ class ExperimentExporter:
         state['averaged_time'] = time.time()
         state['model_paths'] = model_paths
         state['num_checkpts'] = len(model_paths)
+        if quantize:
+            state['quantized'] = 'int8'
+        if ema:
+            state['ema'] = True
         prefix = f'model_{name}_avg{len(model_paths)}'
         to_exp.store_model(step_num, state, train_score=train_loss, val_score=val_loss, keep=10,
                            prefix=prefix)
@@ -75,6 +117,11 @@ class ExperimentExporter:
             'when': datetime.datetime.now().isoformat(),
             'who': os.environ.get('USER', '<unknown>'),
         }
+        if ema:
+            status['ema'] = True
+        if quantize:
+            status['quantized'] = 'int8'
+            status.update(parity)
         yaml.dump(status, stream=to_exp.work_dir / '_EXPORTED')
 
         if self.exp._trained_flag.exists():
@@ -103,6 +150,13 @@ def parse_args():
     add_boolean(p, 'config', dest='copy_config', help='Copy config')
     add_boolean(p, 'vocab', dest='copy_vocab',
                 help='Copy vocabulary files (such as sentence piece models)')
+    p.add_argument('-q', '--quantize', action='store_true',
+                   help='Dynamically quantize linear layers to int8 (for decoding on CPU), and check'
+                        ' the BLEU parity of the quantized model on the validation set')
+    p.add_argument('-ema', '--ema', action='store_true',
+                   help='Export the exponential moving average of weights that was maintained'
+                        ' during training (optim.ema in conf.yml), averaged over the --ensemble'
+                        ' checkpoints')
     args = vars(p.parse_args())
     return args
 
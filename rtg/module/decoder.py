@@ -8,13 +8,17 @@ from dataclasses import dataclass, field
 import warnings
 import sys
 import os
+import itertools
+import collections
+import multiprocessing as mp
 
 import torch
 from torch import nn as nn
 
 from rtg import TranslationExperiment as Experiment
-from rtg import log, device, my_tensor as tensor, debug_mode
+from rtg import log, device, my_tensor as tensor, debug_mode, cpu_count
 from rtg.module.generator import GeneratorFactory
+from rtg.module.quantize import quantize_model, is_quantized_state
 from rtg.data.dataset import Field
 from rtg.registry import factories, generators
 
@@ -37,6 +41,21 @@ def load_models(models: List[Path], exp: Experiment):
     return res
 
 
+_worker_decoder: Optional['Decoder'] = None  # in worker process; see Decoder.decode_parallel()
+_worker_args: Dict[str, Any] = {}
+
+
+def _init_decode_worker(decoder: 'Decoder', num_threads: int, args: Dict[str, Any]):
+    global _worker_decoder, _worker_args
+    _worker_decoder, _worker_args = decoder, args
+    torch.set_num_threads(num_threads)
+    torch.set_grad_enabled(False)
+
+
+def _decode_in_worker(batch: 'DecoderBatch'):
+    return _worker_decoder.decode_batch(batch, **_worker_args)
+
+
 class ReloadEvent(Exception):
     """An exception to reload model with new path
     -- Its a kind of hack to pass event back to caller and redo interactive shell--
@@ -86,7 +105,7 @@ class DecoderBatch:
 
     @classmethod
     def from_lines(cls, lines: Iterator[str], batch_size: int, vocab: Field, sort=True,
-                   max_src_len=0, max_len_buffer=0):
+                   max_src_len=0, max_len_buffer=0, sort_window=0):
         """
         Note: this changes the order based on sequence length if sort=True
         :param lines: stream of input lines
@@ -94,11 +113,62 @@ class DecoderBatch:
         :param vocab: Field to use for mapping word pieces to ids
         :param sort: sort based on descending order of length
         :param max_src_len : truncate at length ; 0 disables this
+        :param sort_window: read and sort these many lines at a time; 0 reads all lines at once
         :return: stream of DecoderBatches
         """
+        for buffer in cls.read_windows(lines, vocab=vocab, sort=sort, max_src_len=max_src_len,
+                                       sort_window=sort_window):
+            batch = cls()
+            batch.max_len_buffer = max_len_buffer
+            for idx, src, ref, seq, _id in buffer:
+                batch.add(idx=idx, src=src, ref=ref, seq=seq, id=_id)
+                if batch.padded_tok_count >= batch_size:
+                    yield batch
+                    batch = cls()
+                    batch.max_len_buffer = max_len_buffer
+
+            if batch.line_count > 0:
+                yield batch
+
+    @classmethod
+    def read_windows(cls, lines: Iterator[str], vocab: Field, sort=True, max_src_len=0,
+                     sort_window=0) \
+            -> Iterator[List[Tuple[int, str, Optional[str], List[int], Optional[str]]]]:
+        """
+        Reads and encodes input lines, a window at a time
+        :param lines: stream of input lines
+        :param vocab: Field to use for mapping word pieces to ids
+        :param sort: sort based on descending order of length, within a window
+        :param max_src_len : truncate at length ; 0 disables this
+        :param sort_window: number of lines in a window; 0 reads all lines as one window
+        :return: stream of windows, see read_lines()
+        """
+        if sort_window <= 0:
+            yield cls.read_lines(lines, vocab=vocab, sort=sort, max_src_len=max_src_len)
+            return
+        lines = iter(lines)
+        for start in itertools.count(step=sort_window):
+            window = list(itertools.islice(lines, sort_window))
+            if not window:
+                break
+            yield cls.read_lines(window, vocab=vocab, sort=sort, max_src_len=max_src_len,
+                                 start=start)
+
+    @staticmethod
+    def read_lines(lines: Iterator[str], vocab: Field, sort=True, max_src_len=0, start=0) \
+            -> List[Tuple[int, str, Optional[str], List[int], Optional[str]]]:
+        """
+        Reads and encodes input lines
+        :param lines: stream of input lines
+        :param vocab: Field to use for mapping word pieces to ids
+        :param sort: sort based on descending order of length
+        :param max_src_len : truncate at length ; 0 disables this
+        :param start: index of the first line
+        :return: list of (idx, src, ref, seq, id)
+        """
         log.info("Tokenizing sequences")
         buffer = []
-        for i, line in enumerate(lines):
+        for i, line in enumerate(lines, start=start):
             line = line.strip()
             if not line:
                 log.warning(f"line {i + 1} was empty. inserting a dot (.). "
@@ -121,22 +191,13 @@ class DecoderBatch:
         if sort:
             log.info(f"Sorting based on the length. total = {len(buffer)}")
             buffer = sorted(buffer, reverse=True, key=lambda x: len(x[3]))  # sort by length of seq
-
-        batch = cls()
-        batch.max_len_buffer = max_len_buffer
-        for idx, src, ref, seq, _id in buffer:
-            batch.add(idx=idx, src=src, ref=ref, seq=seq, id=_id)
-            if batch.padded_tok_count >= batch_size:
-                yield batch
-                batch = cls()
-                batch.max_len_buffer = max_len_buffer
-
-        if batch.line_count > 0:
-            yield batch
+        return buffer
 
 
 class Decoder:
     default_beam_size = 5
+    # args in decoder config that are consumed by Decoder.new() and not by the decode methods
+    new_args = ('ensemble', 'quantize', 'shortlist', 'ema')
 
     def __init__(self, model, gen_factory: Type[GeneratorFactory], exp: Experiment, gen_args=None,
                  debug=debug_mode):
@@ -170,7 +231,8 @@ class Decoder:
     @classmethod
     def new(cls, exp: Experiment, model=None, gen_args=None,
             model_paths: Optional[List[str]] = None,
-            ensemble: int = 1, model_type: Optional[str] = None):
+            ensemble: int = 1, model_type: Optional[str] = None, quantize: bool = False,
+            shortlist: bool = False, ema: bool = False):
         """
         create a new decoder
         :param exp: experiment
@@ -179,6 +241,11 @@ class Decoder:
         :param model_paths: optional model paths
         :param ensemble: number of models to use for ensembling (if model is not specified)
         :param model_type: model_type ; when not specified, model_type will be read from experiment
+        :param quantize: dynamically quantize the linear layers to int8 for faster decoding on CPU
+        :param shortlist: restrict the output vocabulary to the lexical shortlist of sources;
+          see rtg.data.shortlist
+        :param ema: use the exponential moving average of weights that was maintained during
+          training (optim.ema in conf.yml), instead of the weights
         :return:
         """
         if not model_type:
@@ -186,18 +253,28 @@ class Decoder:
         if model is None:
             factory = factories[model_type]
             model = factory(exp=exp, **exp.model_args)[0]
-            state = exp.maybe_ensemble_state(model_paths=model_paths, ensemble=ensemble)
+            state = exp.maybe_ensemble_state(model_paths=model_paths, ensemble=ensemble, ema=ema)
+            if is_quantized_state(state):  # exported with quantization
+                model = quantize_model(model.eval())
             model.load_state_dict(state)
             log.info("Successfully restored the model state.")
         elif isinstance(model, nn.DataParallel):
             model = model.module
 
+        if quantize or is_quantized_state(model.state_dict()):
+            assert device.type == 'cpu', \
+                'Quantized models run on CPU only. Tip: export CUDA_VISIBLE_DEVICES=""'
         model = model.eval().to(device=device)
+        if quantize:
+            model = quantize_model(model)
         generator = generators[model_type]
         if exp.optim_args[1] and exp.optim_args[1].get('criterion') == 'binary_cross_entropy':
             log.info("((Going to decode in multi-label mode))")
             gen_args = gen_args or {}
             gen_args['multi_label'] = True
+        if shortlist:
+            gen_args = gen_args or {}
+            gen_args['shortlist'] = exp.get_shortlist()
         return cls(model, generator, exp, gen_args)
 
     def greedy_decode(self, x_seqs, x_lens, max_len, **args) -> List[Hypothesis]:
@@ -226,6 +303,8 @@ class Decoder:
                 break
             log_prob = gen.generate_next(ys)
             max_prob, next_word = torch.max(log_prob, dim=1)
+            if gen.vocab_subset is not None:
+                next_word = gen.vocab_subset[next_word]
             scores += max_prob
             ys = torch.cat([ys, next_word.view(batch_size, 1)], dim=1)
             actives &= ys[:, -1] != self.eos_val
@@ -261,7 +340,7 @@ class Decoder:
         return x.contiguous().view(*shape)
 
     def beam_decode(self, x_seqs, x_lens, max_len, beam_size=default_beam_size, num_hyp=1,
-                    lp_alpha: float = 0., **args) -> List[List[Hypothesis]]:
+                    lp_alpha: float = 0., shrink: bool = True, **args) -> List[List[Hypothesis]]:
         """
         Beam decoder
         :param x_seqs: input x_seqs as a padded tensor
@@ -270,6 +349,9 @@ class Decoder:
         :param beam_size: how many beams
         :param num_hyp: how many hypothesis to return ( must be <= beam_size)
         :param lp_alpha: length penalty (0.0 means disables)
+        :param shrink: drop sentences from the batch as soon as all their beams have ended, so
+          that the cost of a time step is proportional to the number of unfinished sentences.
+          This is effective only if the generator supports state compaction
         :return:
         """
         args = dict((k, v) for k, v in args.items() if v is not None)
@@ -289,15 +371,23 @@ class Decoder:
             ys = torch.full((batch_size, beam_size, 1), fill_value=self.bos_val,
                             device=device, dtype=torch.long)
 
-        # repeat x_seqs and x_lens beam times
-        beamed_x_seqs = self.repeat_adjacent(x_seqs, n=beam_size, dim=0)
-        beamed_x_lens = self.repeat_adjacent(x_lens, n=beam_size, dim=0)
-        gen = self.generator(beamed_x_seqs, beamed_x_lens)
+        if getattr(self.gen_factory, 'beam_expansion', False):
+            # encode sources once, then the generator repeats the encoded states beam times
+            gen = self.generator(x_seqs, x_lens)
+            gen.expand_beams(beam_size)
+        else:
+            # repeat x_seqs and x_lens beam times
+            beamed_x_seqs = self.repeat_adjacent(x_seqs, n=beam_size, dim=0)
+            beamed_x_lens = self.repeat_adjacent(x_lens, n=beam_size, dim=0)
+            gen = self.generator(beamed_x_seqs, beamed_x_lens)
         scores = torch.zeros(batch_size, beam_size, device=device)
         actives = ys[:, :, 0] != self.eos_val
         lengths = torch.full((batch_size, beam_size), fill_value=max_len, device=device,
                              dtype=torch.long)
         max_x_len = x_lens.max().item()
+        shrink = shrink and getattr(self.gen_factory, 'state_compaction', False)
+        result: List[Optional[List[Hypothesis]]] = [None] * batch_size
+        seq_idxs = torch.arange(batch_size, device=device)  # position of sentences in x_seqs
         for t in range(1, max_x_len + max_len + 1):
             if actives.sum() == 0:  # all sequences Ended
                 break
@@ -315,38 +405,12 @@ class Decoder:
                 beam_mask[:, 0, :] = 0
                 log_prob.masked_fill_(mask=beam_mask, value=float('-inf'))
 
-            inactives = ~actives
-            if inactives.sum() > 0:
-                # Goal: do not let the inactive beams grow. How? this is tricky
-                # we set -inf to all next words of inactive beams (so none of them make to topk)
-                log_prob.masked_fill_(mask=inactives.unsqueeze(-1), value=float('-inf'))
-                # But we need to preserve the inactive beam (just one copy) if it is still in topk. how?
-                # just set zero to just one word of inactive beam
-                # shouldn't matter which word since an EOS has already appeared --> pick index 0 word
-                log_prob[:, :, 0].masked_fill_(mask=inactives, value=0.0)
-
-            # add current beam_scores all possible next_words
-            # broadcast scores to each word in vocab [Batch x Beams x Vocab=1]
-            next_scores = scores.unsqueeze(-1) + log_prob
-
-            # max_probs and next_words: [Batch x Beams x Beams] --> [Batch x Beams*Beams]
-            next_scores, next_words = next_scores.topk(k=beam_size, dim=-1, largest=True)
-            next_scores = next_scores.view(batch_size, beam_size * beam_size)
-            next_words = next_words.view(batch_size, beam_size * beam_size)
-
-            # Trim beams: [Batch, Beams] <-- [Batch, Beams*Beams]
-            scores, next_words_idxs = next_scores.topk(k=beam_size, dim=-1, largest=True)
-            next_words = next_words.gather(dim=1, index=next_words_idxs)
-
-            # task: rearrange ys based on the newer ranking of beams
-            # ys_idx: [Beams] --> [Beams x 1] --> [Beams x Beams]
-            #          --> [1 x Beams x Beams] --> [Batch x Beams * Beams]
-            ys_idx = torch.arange(beam_size, device=device) \
-                .unsqueeze(-1).expand(-1, beam_size) \
-                .unsqueeze(0).expand(batch_size, -1, -1).contiguous() \
-                .view(batch_size, beam_size * beam_size)
-            # [Batch x Beams] <- [Batch x Beams*Beams] as per the topk next_scores of beams
-            ys_idx = ys_idx.gather(dim=1, index=next_words_idxs)
+            scores, next_words, ys_idx = self._next_beams(log_prob, scores, actives)
+            if gen.vocab_subset is not None:
+                next_words = gen.vocab_subset[next_words]
+            # generator's state (if any) should follow the beams: [Batch*Beams] flat row indices
+            beam_offset = torch.arange(batch_size, device=device).unsqueeze(-1) * beam_size
+            gen.reorder_state((ys_idx + beam_offset).view(-1))
             ys_idx = ys_idx.unsqueeze(-1).expand_as(ys)  # expand along time dim
             ys = ys.gather(1, ys_idx)  # re arrange beams
             ys = torch.cat([ys, next_words.unsqueeze(-1)], dim=-1)  # cat along the time dim
@@ -356,6 +420,204 @@ class Decoder:
             lengths.masked_fill_(mask=ended_beams, value=t)
             actives &= next_words != self.eos_val  # was active and not EOS yet
 
+            if shrink:
+                finished = ~actives.any(dim=1)  # all beams of these sentences have ended
+                if finished.any():
+                    hyps = self._pick_hyps(ys[finished], scores[finished], lengths[finished],
+                                           num_hyp=num_hyp, lp_alpha=lp_alpha)
+                    for seq_idx, seq_hyps in zip(seq_idxs[finished].tolist(), hyps):
+                        result[seq_idx] = seq_hyps
+                    keep = (~finished).nonzero(as_tuple=True)[0]
+                    ys, scores, lengths, actives, seq_idxs = \
+                        [x[keep] for x in (ys, scores, lengths, actives, seq_idxs)]
+                    # [Batch*Beams] flat row indices of the remaining sentences
+                    gen.compact_state((keep.unsqueeze(-1) * beam_size
+                                       + torch.arange(beam_size, device=device)).view(-1))
+                    batch_size = len(keep)
+
+        hyps = self._pick_hyps(ys, scores, lengths, num_hyp=num_hyp, lp_alpha=lp_alpha)
+        for seq_idx, seq_hyps in zip(seq_idxs.tolist(), hyps):
+            result[seq_idx] = seq_hyps
+        return result
+
+    def continuous_beam_decode(self, seqs: Iterator[Tuple[Any, List[int]]], batch_size: int,
+                               max_len: int, beam_size=default_beam_size, num_hyp=1,
+                               lp_alpha: float = 0., max_len_buffer=0, **args) \
+            -> Iterator[Tuple[Any, List[Hypothesis]]]:
+        """
+        Beam decoder with continuous (aka in-flight) batching: a sentence leaves the batch as soon
+        as all its beams end, and the next sentences join the batch at their own first time step,
+        so the batch stays full instead of waiting for its longest sentence to end.
+        Unlike beam_decode, the max time steps are x_len + max_len for each sentence.
+        :param seqs: stream of (key, seq) where seq is the token ids of a source sentence and key
+          is any object for identifying the sentence in the output
+        :param batch_size: max tokens in flight; a sentence costs len(seq) + max_len_buffer
+        :param max_len: maximum time steps to run (in addition to the source length)
+        :param beam_size: how many beams
+        :param num_hyp: how many hypothesis to return ( must be <= beam_size)
+        :param lp_alpha: length penalty (0.0 means disables)
+        :param max_len_buffer: extra buffer for target size in computing cost of a sentence
+        :return: stream of (key, hypotheses) in the order sentences end
+        """
+        args = dict((k, v) for k, v in args.items() if v is not None)
+        if args:
+            warnings.warn(f"Ignored args: {args}. To remove this message simply remove the args")
+        assert beam_size >= num_hyp
+        assert not self.dec_bos_cut, 'dec_bos_cut is not supported by continuous batching'
+        for feature in ('beam_expansion', 'state_compaction', 'state_extension'):
+            assert getattr(self.gen_factory, feature, False), \
+                f'{self.gen_factory} does not support {feature}; needed for continuous batching'
+        seqs = iter(seqs)
+        next_seq = next(seqs, None)
+        gen = None
+        keys, costs = [], []  # of sentences in the batch
+        ys = torch.full((0, beam_size, 1), fill_value=self.bos_val, device=device, dtype=torch.long)
+        scores = torch.zeros(0, beam_size, device=device)
+        actives = torch.zeros(0, beam_size, device=device, dtype=torch.bool)
+        lengths = torch.zeros(0, beam_size, device=device, dtype=torch.long)
+        steps = torch.zeros(0, device=device, dtype=torch.long)  # time steps decoded so far
+        limits = torch.zeros(0, device=device, dtype=torch.long)  # max time steps
+        while True:
+            # Task: fill the batch with new sentences
+            new_keys, new_seqs = [], []
+            while next_seq is not None:
+                cost = len(next_seq[1]) + max_len_buffer
+                if (keys or new_keys) and sum(costs) + cost > batch_size:
+                    break
+                new_keys.append(next_seq[0])
+                new_seqs.append(next_seq[1])
+                costs.append(cost)
+                next_seq = next(seqs, None)
+            if new_seqs:
+                n = len(new_seqs)
+                x_lens = torch.tensor([len(seq) for seq in new_seqs], device=device,
+                                      dtype=torch.long)
+                x_seqs = torch.zeros(n, x_lens.max().item(), device=device, dtype=torch.long)
+                for i, seq in enumerate(new_seqs):
+                    x_seqs[i, :len(seq)] = torch.tensor(seq, dtype=torch.long)
+                new_gen = self.generator(x_seqs, x_lens)
+                new_gen.expand_beams(beam_size)
+                if gen is None:
+                    gen = new_gen
+                else:
+                    gen.extend(new_gen)
+                keys += new_keys
+                # new sentences have BOS at the last time step, and padding before it
+                new_ys = torch.full((n, beam_size, ys.size(2)), fill_value=self.pad_val,
+                                    device=device, dtype=torch.long)
+                new_ys[:, :, -1] = self.bos_val
+                ys = torch.cat([ys, new_ys])
+                scores = torch.cat([scores, scores.new_zeros(n, beam_size)])
+                actives = torch.cat([actives, actives.new_ones(n, beam_size)])
+                lengths = torch.cat([lengths, lengths.new_full((n, beam_size), max_len)])
+                steps = torch.cat([steps, steps.new_zeros(n)])
+                limits = torch.cat([limits, x_lens + max_len])
+            if not keys:  # all sentences have ended and there are no more
+                break
+
+            steps += 1
+            n = len(keys)
+            log_prob = gen.generate_next(ys.contiguous().view(n * beam_size, -1))
+            log_prob = log_prob.view(n, beam_size, -1)
+            firsts = steps == 1
+            if firsts.any():
+                # beams of new sentences are duplicates; pick the top k from the first beam only
+                beam_mask = firsts.view(-1, 1, 1) & \
+                            (torch.arange(beam_size, device=device) > 0).view(1, -1, 1)
+                log_prob.masked_fill_(mask=beam_mask, value=float('-inf'))
+
+            scores, next_words, ys_idx = self._next_beams(log_prob, scores, actives)
+            if gen.vocab_subset is not None:
+                next_words = gen.vocab_subset[next_words]
+            beam_offset = torch.arange(n, device=device).unsqueeze(-1) * beam_size
+            gen.reorder_state((ys_idx + beam_offset).view(-1))
+            ys = ys.gather(1, ys_idx.unsqueeze(-1).expand_as(ys))
+            ys = torch.cat([ys, next_words.unsqueeze(-1)], dim=-1)
+
+            ended_beams = actives & (next_words == self.eos_val)
+            lengths = torch.where(ended_beams, steps.unsqueeze(-1), lengths)
+            actives &= next_words != self.eos_val
+
+            finished = ~actives.any(dim=1) | (steps >= limits)
+            if not finished.any():
+                continue
+            for i in finished.nonzero(as_tuple=True)[0].tolist():
+                seq_ys = ys[i:i + 1, :, -(steps[i].item() + 1):]  # remove padding before BOS
+                hyps = self._pick_hyps(seq_ys, scores[i:i + 1], lengths[i:i + 1],
+                                       num_hyp=num_hyp, lp_alpha=lp_alpha)
+                yield keys[i], hyps[0]
+            keep = (~finished).nonzero(as_tuple=True)[0]
+            keys = [keys[i] for i in keep.tolist()]
+            costs = [costs[i] for i in keep.tolist()]
+            scores, actives, lengths, steps, limits = \
+                [x[keep] for x in (scores, actives, lengths, steps, limits)]
+            if keys:
+                gen.compact_state((keep.unsqueeze(-1) * beam_size
+                                   + torch.arange(beam_size, device=device)).view(-1))
+                # drop the padded time steps before the oldest sentence
+                ys = ys[keep][:, :, -(steps.max().item() + 1):]
+            else:
+                gen = None
+                ys = ys[keep][:, :, -1:]
+
+    @staticmethod
+    def _next_beams(log_prob, scores, actives):
+        """
+        Extends the beams by one time step and keeps the top beams
+        :param log_prob: [Batch x Beams x Vocab] log probabilities of next words
+        :param scores: [Batch x Beams] scores of beams
+        :param actives: [Batch x Beams] beams that are not ended
+        :return: scores [Batch x Beams] of the top beams, their next words [Batch x Beams], and
+          indices [Batch x Beams] of the beams from which they are extended
+        """
+        batch_size, beam_size = scores.shape
+        device = scores.device
+        inactives = ~actives
+        if inactives.sum() > 0:
+            # Goal: do not let the inactive beams grow. How? this is tricky
+            # we set -inf to all next words of inactive beams (so none of them make to topk)
+            log_prob.masked_fill_(mask=inactives.unsqueeze(-1), value=float('-inf'))
+            # But we need to preserve the inactive beam (just one copy) if it is still in topk. how?
+            # just set zero to just one word of inactive beam
+            # shouldn't matter which word since an EOS has already appeared --> pick index 0 word
+            log_prob[:, :, 0].masked_fill_(mask=inactives, value=0.0)
+
+        # add current beam_scores all possible next_words
+        # broadcast scores to each word in vocab [Batch x Beams x Vocab=1]
+        next_scores = scores.unsqueeze(-1) + log_prob
+
+        # max_probs and next_words: [Batch x Beams x Beams] --> [Batch x Beams*Beams]
+        next_scores, next_words = next_scores.topk(k=beam_size, dim=-1, largest=True)
+        next_scores = next_scores.view(batch_size, beam_size * beam_size)
+        next_words = next_words.view(batch_size, beam_size * beam_size)
+
+        # Trim beams: [Batch, Beams] <-- [Batch, Beams*Beams]
+        scores, next_words_idxs = next_scores.topk(k=beam_size, dim=-1, largest=True)
+        next_words = next_words.gather(dim=1, index=next_words_idxs)
+
+        # task: rearrange ys based on the newer ranking of beams
+        # ys_idx: [Beams] --> [Beams x 1] --> [Beams x Beams]
+        #          --> [1 x Beams x Beams] --> [Batch x Beams * Beams]
+        ys_idx = torch.arange(beam_size, device=device) \
+            .unsqueeze(-1).expand(-1, beam_size) \
+            .unsqueeze(0).expand(batch_size, -1, -1).contiguous() \
+            .view(batch_size, beam_size * beam_size)
+        # [Batch x Beams] <- [Batch x Beams*Beams] as per the topk next_scores of beams
+        ys_idx = ys_idx.gather(dim=1, index=next_words_idxs)
+        return scores, next_words, ys_idx
+
+    @staticmethod
+    def _pick_hyps(ys, scores, lengths, num_hyp, lp_alpha) -> List[List[Hypothesis]]:
+        """
+        Picks the top hypotheses from the beams
+        :param ys: [Batch x Beams x Time] beams, starting with BOS
+        :param scores: [Batch x Beams] scores of beams
+        :param lengths: [Batch x Beams] lengths of beams
+        :param num_hyp: how many hypothesis to return per sentence
+        :param lp_alpha: length penalty (0.0 means disables)
+        :return: list of hypotheses of each sentence
+        """
+        batch_size = ys.size(0)
         ys = ys[:, :, 1:]  # remove BOS
         if lp_alpha > 0:
             # Page 12 of Wu et al (2016) Google NMT : https://arxiv.org/pdf/1609.08144.pdf
@@ -368,7 +630,7 @@ class Decoder:
         for seq_idx in range(batch_size):
             result.append([])
             for hyp_score, beam_idx in zip(n_hyp_scores[seq_idx], n_hyp_idxs[seq_idx]):
-                result[-1].append((hyp_score, ys[seq_idx, beam_idx, :].tolist()))
+                result[-1].append((hyp_score.item(), ys[seq_idx, beam_idx, :].tolist()))
         return result
 
     @property
@@ -524,51 +786,114 @@ class Decoder:
     def _remove_null_vals(args: Dict):
         return {k: v for k, v in args.items() if v is not None}  # remove None args
 
+    def decode_batch(self, batch: DecoderBatch, num_hyp=1, **args) \
+            -> List[Tuple[Tuple, List[Hypothesis]]]:
+        """
+        Decodes a batch
+        :return: list of ((idx, src, ref, seq, id), hypotheses) of sentences in batch
+        """
+        in_seqs, in_lens = batch.as_tensors(device=device)
+        batched_hyps: List[List[Hypothesis]] = self.beam_decode(in_seqs, in_lens,
+                                                                num_hyp=num_hyp, **args)
+        assert len(batched_hyps) == batch.line_count
+        entries = zip(batch.idxs, batch.srcs, batch.refs, batch.seqs, batch.ids)
+        return list(zip(entries, batched_hyps))
+
+    def decode_parallel(self, batches: Iterator[DecoderBatch], workers: int, **args) \
+            -> Iterator[Tuple[Tuple, List[Hypothesis]]]:
+        """
+        Decodes batches in parallel using worker processes on CPU. The workers are forked after
+        the model is loaded, so they share the model weights with this process.
+        The CPU threads (see rtg.cpu_count) are divided among the workers.
+        :param batches: stream of batches
+        :param workers: number of worker processes
+        :param args: args to decode_batch()
+        :return: stream of ((idx, src, ref, seq, id), hypotheses) in the order batches are decoded
+        """
+        assert device.type == 'cpu', 'Parallel decoding with worker processes is only for CPU'
+        num_threads = max(1, cpu_count // workers)
+        log.info(f"Decoding with {workers} worker processes, {num_threads} threads each")
+        ctx = mp.get_context('fork')
+        with ctx.Pool(workers, initializer=_init_decode_worker,
+                      initargs=(self, num_threads, args)) as pool:
+            pending = collections.deque()   # bounded, so that batches are read as needed
+            for batch in batches:
+                pending.append(pool.apply_async(_decode_in_worker, (batch,)))
+                if len(pending) >= 2 * workers:
+                    yield from pending.popleft().get()
+            while pending:
+                yield from pending.popleft().get()
+
     def decode_file(self, inp: Iterator[str], out: StringIO,
-                    num_hyp=1, batch_size=1, max_src_len=-1, **args):
+                    num_hyp=1, batch_size=1, max_src_len=-1, continuous=False, sort_window=0,
+                    workers=1, **args):
+        """
+        Decodes lines of inp and writes the results to out in the same order
+        :param continuous: use continuous batching; see continuous_beam_decode()
+        :param sort_window: read and sort by length these many lines at a time, and write the
+          outputs as soon as all the preceding lines are decoded. 0 reads all lines at once
+        :param workers: number of worker processes for decoding on CPU; see decode_parallel()
+        """
         args = self._remove_null_vals(args)
         log.info(f"Args to decoder : {args} and num_hyp={num_hyp} "
-                 f"batch_size={batch_size} max_src_len={max_src_len}")
-
-        batches: Iterator[DecoderBatch] = DecoderBatch.from_lines(
-            inp, batch_size=batch_size, vocab=self.inp_vocab, max_src_len=max_src_len,
-            max_len_buffer=args.get('max_len', 1))
-
-        def _decode_all():
-            buffer = []
+                 f"batch_size={batch_size} max_src_len={max_src_len} continuous={continuous}"
+                 f" sort_window={sort_window} workers={workers}")
+        assert not (continuous and workers > 1), \
+            'continuous batching with multiple workers is not supported'
+
+        def _decoded() -> Iterator[Tuple[Tuple, List[Hypothesis]]]:
+            # (idx, src, ref, seq, id), hyps
+            if continuous:
+                windows = DecoderBatch.read_windows(inp, vocab=self.inp_vocab,
+                                                    max_src_len=max_src_len,
+                                                    sort_window=sort_window)
+                entries = itertools.chain.from_iterable(windows)
+                yield from self.continuous_beam_decode(
+                    ((entry, entry[3]) for entry in entries), batch_size=batch_size,
+                    num_hyp=num_hyp, max_len_buffer=args.get('max_len', 1), **args)
+                return
+            batches: Iterator[DecoderBatch] = DecoderBatch.from_lines(
+                inp, batch_size=batch_size, vocab=self.inp_vocab, max_src_len=max_src_len,
+                max_len_buffer=args.get('max_len', 1), sort_window=sort_window)
+            if workers > 1:
+                yield from self.decode_parallel(batches, workers=workers, num_hyp=num_hyp, **args)
+                return
             for batch in batches:
-                in_seqs, in_lens = batch.as_tensors(device=device)
-                batched_hyps: List[List[Hypothesis]] = self.beam_decode(in_seqs, in_lens,
-                                                                        num_hyp=num_hyp, **args)
-                assert len(batched_hyps) == batch.line_count
-                for i, hyps in enumerate(batched_hyps):
-                    idx = batch.idxs[i]
-                    src = batch.srcs[i]
-                    _id = batch.ids[i]
-                    log.info(f"{idx}: SRC: {batch.srcs[i]}")
-                    ref = batch.refs[i]  # just for the sake of logging, if it exists
-                    if ref:
-                        log.info(f"{idx}: REF: {batch.refs[i]}")
-
-                    result = []
-                    for j, (score, hyp) in enumerate(hyps):
-                        hyp_line = self.out_vocab.decode_ids(hyp,
-                                                             trunc_eos=True)  # tok ids to string
-                        log.info(f"{idx}: HYP{j}: {score:g} : {hyp_line}")
-                        result.append((score, hyp_line))
-                    buffer.append((idx, src, result, _id))
-
-            buffer = sorted(buffer, key=lambda x: x[0])  # restore order
-            for _, src, result, _id in buffer:
-                yield src, result, _id
-
-        streamed_results: Iterator[Tuple[str, List[StrHypothesis], Any]] = _decode_all()
-        for src, hyps, _id in streamed_results:
-            prefix = f'{_id}\t' if _id else ''  # optional Id
-            out_line = '\n'.join(f'{prefix}{hyp}\t{score:.4f}' for score, hyp in hyps)
-            out.write(f'{out_line}\n')
-            if num_hyp > 1:
-                out.write('\n')
+                yield from self.decode_batch(batch, num_hyp=num_hyp, **args)
+
+        def _decode_all() -> Iterator[List[Tuple[str, List[StrHypothesis], Any]]]:
+            # yields the results of lines as soon as all the preceding lines are decoded
+            buffer = {}   # idx -> result; of lines that are decoded sooner than preceding lines
+            next_idx = 0
+            for (idx, src, ref, _, _id), hyps in _decoded():
+                log.info(f"{idx}: SRC: {src}")
+                if ref:  # just for the sake of logging, if it exists
+                    log.info(f"{idx}: REF: {ref}")
+
+                result = []
+                for j, (score, hyp) in enumerate(hyps):
+                    hyp_line = self.out_vocab.decode_ids(hyp,
+                                                         trunc_eos=True)  # tok ids to string
+                    log.info(f"{idx}: HYP{j}: {score:g} : {hyp_line}")
+                    result.append((score, hyp_line))
+                buffer[idx] = (src, result, _id)
+                ready = []  # restore order
+                while next_idx in buffer:
+                    ready.append(buffer.pop(next_idx))
+                    next_idx += 1
+                if ready:
+                    yield ready
+            assert not buffer, f'Results of {len(buffer)} lines are out of order'
+
+        streamed_results: Iterator[List[Tuple[str, List[StrHypothesis], Any]]] = _decode_all()
+        for ready in streamed_results:
+            for src, hyps, _id in ready:
+                prefix = f'{_id}\t' if _id else ''  # optional Id
+                out_line = '\n'.join(f'{prefix}{hyp}\t{score:.4f}' for score, hyp in hyps)
+                out.write(f'{out_line}\n')
+                if num_hyp > 1:
+                    out.write('\n')
+            out.flush()
 
     def decode_stream(self, inp: Iterator[str], out: StringIO,
                       max_src_len=-1, **args):
@@ -27,11 +27,14 @@ class RobertaGenerator(Generator):
     def forward(self, x, score=None, *args, **kwargs):
         assert not args, f'Support for {args} are removed. Please use "{score}" argument'
         if score not in ('embedding', 'identity'):
-            x = self.dense(x)
-            x = self.activation(x)
-            x = self.layer_norm(x)
+            x = self.features(x)
         return super().forward(x, score=score, **kwargs)
 
+    def features(self, x):
+        x = self.dense(x)
+        x = self.activation(x)
+        return self.layer_norm(x)
+
 
 class RoBERTaMT(TransformerNMT):
     GeneratorFactory = RobertaGenerator
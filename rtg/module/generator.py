@@ -5,6 +5,7 @@
 
 import abc
 import torch
+import torch.nn.functional as F
 from rtg import log
 from rtg.module.rnnmt import RNNMT
 from rtg.lm.rnnlm import RnnLm
@@ -12,6 +13,8 @@ from rtg.lm.tfmlm import TfmLm
 from rtg.module.tfmnmt import TransformerNMT
 from rtg.data.dataset import subsequent_mask
 from rtg.data.codec import Field
+from rtg.data.shortlist import Shortlist
+from typing import Optional
 
 INTERACTIVE = False
 
@@ -23,10 +26,55 @@ class GeneratorFactory(abc.ABC):
         self.model = model
         self.field = field
 
+    # target ids of log_probs of generate_next(), if they are over a subset of the vocabulary
+    vocab_subset = None
+
     @abc.abstractmethod
     def generate_next(self, past_ys):
         pass
 
+    def reorder_state(self, index: torch.Tensor):
+        """
+        Rearranges the internal decoder state (if any) when beams are regathered.
+        Stateless generators need not to override this
+        :param index: flat indices [Batch*Beams] of rows to be picked, in the new order
+        """
+        pass
+
+    # True if the generator can encode each source once and then expand its states to beams;
+    # see expand_beams(). Otherwise, the decoder repeats sources beam times before encoding them
+    beam_expansion = False
+
+    def expand_beams(self, n: int):
+        """
+        Repeats the states of every source sequence n times (adjacently) for beam search
+        :param n: beam size
+        """
+        raise NotImplementedError()
+
+    # True if the generator can drop rows of its states; see compact_state()
+    state_compaction = False
+
+    def compact_state(self, index: torch.Tensor):
+        """
+        Keeps only the given rows of the states, e.g., when finished sentences are dropped from
+        the batch
+        :param index: flat indices [Batch*Beams] of rows to be kept
+        """
+        raise NotImplementedError()
+
+    # True if the generator can take in rows of another generator; see extend()
+    state_extension = False
+
+    def extend(self, other: 'GeneratorFactory'):
+        """
+        Appends the rows of other generator (that has not generated any time step yet) to this
+        generator; the new rows start at their own first time step, e.g., when new sentences join
+        a batch that is already being decoded
+        :param other: generator of new rows
+        """
+        raise NotImplementedError()
+
 
 class Seq2SeqGenerator(GeneratorFactory):
 
@@ -46,8 +94,10 @@ class Seq2SeqGenerator(GeneratorFactory):
 class T2TGenerator(GeneratorFactory):
 
     multi_label_warned = False
+    shortlist_warned = False
 
-    def __init__(self, model: TransformerNMT, field, x_seqs, x_lens=None, multi_label=False):
+    def __init__(self, model: TransformerNMT, field, x_seqs, x_lens=None, multi_label=False,
+                 incremental=True, shortlist: Optional[Shortlist] = None):
         super().__init__(model, field)
         self.x_mask = (x_seqs != field.pad_idx).unsqueeze(1)
         self.memory = self.model.encode(x_seqs, self.x_mask)
@@ -55,10 +105,143 @@ class T2TGenerator(GeneratorFactory):
         if multi_label and not type(self).multi_label_warned:
             log.warning(">>> Multi-label decoding mode enabled")
             type(self).multi_label_warned = True
+        # incremental: cache self attention keys and values; decode only the newest time step
+        #   src_attn keys and values are projected from memory once for all time steps
+        self.incremental = incremental
+        self.cache = self.model.init_decode_cache(self.memory) if incremental else {}
+        # [Batch x 1 x Time] valid time steps of self_attn cache; None when all are valid
+        self.y_mask = None
+        self.subset_proj = None  # output projection restricted to vocab_subset
+        if shortlist is not None:
+            self._restrict_vocab(shortlist.vocab_subset(x_seqs))
+
+    def _restrict_vocab(self, vocab_subset: torch.Tensor):
+        if not hasattr(self.model.generator, 'features'):
+            if not type(self).shortlist_warned:
+                log.warning(f"shortlist is not supported for {type(self.model.generator).__name__};"
+                            f" decoding with full vocabulary")
+                type(self).shortlist_warned = True
+            return
+        proj = self.model.generator.proj
+        weight, bias = proj.weight, proj.bias
+        if callable(weight):  # dynamically quantized; see rtg.module.quantize
+            weight, bias = weight().dequantize(), bias()
+        self.vocab_subset = vocab_subset
+        self.subset_proj = weight[vocab_subset], None if bias is None else bias[vocab_subset]
+
+    beam_expansion = True
+
+    def expand_beams(self, n: int):
+        from rtg.module.decoder import Decoder
+        self.x_mask = Decoder.repeat_adjacent(self.x_mask, n=n, dim=0)
+        self.memory = Decoder.repeat_adjacent(self.memory, n=n, dim=0)
+        for layer_cache in self.cache.values():
+            for attn_cache in layer_cache.values():
+                for name, val in attn_cache.items():
+                    attn_cache[name] = Decoder.repeat_adjacent(val, n=n, dim=0)
+
+    state_compaction = True
+
+    def compact_state(self, index: torch.Tensor):
+        self.x_mask = self.x_mask.index_select(0, index)
+        self.memory = self.memory.index_select(0, index)
+        for layer_cache in self.cache.values():
+            for attn_cache in layer_cache.values():
+                for name, val in attn_cache.items():
+                    attn_cache[name] = val.index_select(0, index)
+        if self.y_mask is not None:
+            self.y_mask = self.y_mask.index_select(0, index)
+        if len(index) > 0:
+            self._trim_state()
+
+    def _trim_state(self):
+        """
+        Drops the source positions and past time steps that are padded in all rows
+        """
+        # remaining rows may have shorter sources
+        src_len = self.x_mask.any(dim=0).view(-1).nonzero().max().item() + 1
+        if src_len < self.x_mask.size(-1):
+            self.x_mask = self.x_mask[:, :, :src_len]
+            self.memory = self.memory[:, :src_len]
+            for layer_cache in self.cache.values():
+                attn_cache = layer_cache['src_attn']
+                for name, val in attn_cache.items():
+                    attn_cache[name] = val[:, :, :src_len]
+        if self.y_mask is not None and self.y_mask.size(-1) > 0:
+            # rows that started earlier may have left
+            start = self.y_mask.any(dim=0).view(-1).nonzero().min().item()
+            if start > 0:
+                self.y_mask = self.y_mask[:, :, start:]
+                for layer_cache in self.cache.values():
+                    attn_cache = layer_cache.get('self_attn', {})
+                    for name, val in attn_cache.items():
+                        attn_cache[name] = val[:, :, start:]
+
+    state_extension = True
+
+    def extend(self, other: 'T2TGenerator'):
+        assert self.incremental and other.incremental
+        y_len = 0  # past time steps in self_attn cache
+        if 'key' in self.cache[0].get('self_attn', {}):
+            y_len = self.cache[0]['self_attn']['key'].size(2)
+        if self.y_mask is None:
+            self.y_mask = self.x_mask.new_ones(len(self.x_mask), 1, y_len)
+        # the new rows have no past time steps; their padded steps are masked out
+        self.y_mask = torch.cat([self.y_mask, other.x_mask.new_zeros(len(other.x_mask), 1, y_len)])
+        self.x_mask = self._pad_cat(self.x_mask, other.x_mask, dim=2)
+        self.memory = self._pad_cat(self.memory, other.memory, dim=1)
+        for i, layer_cache in self.cache.items():
+            attn_cache = layer_cache['src_attn']
+            for name, val in attn_cache.items():
+                attn_cache[name] = self._pad_cat(val, other.cache[i]['src_attn'][name], dim=2)
+            attn_cache = layer_cache.get('self_attn', {})
+            for name, val in attn_cache.items():
+                attn_cache[name] = torch.cat([val, val.new_zeros(len(other.x_mask), *val.shape[1:])])
+        if self.vocab_subset is not None:
+            self._restrict_vocab(torch.cat([self.vocab_subset, other.vocab_subset]).unique())
+
+    @staticmethod
+    def _pad_cat(x, y, dim):
+        """
+        Pads x and y with zeros along dim to the same size, and concatenates them along dim=0
+        """
+        size = max(x.size(dim), y.size(dim))
+        padded = []
+        for t in (x, y):
+            if t.size(dim) < size:
+                shape = list(t.shape)
+                shape[dim] = size - t.size(dim)
+                t = torch.cat([t, t.new_zeros(shape)], dim=dim)
+            padded.append(t)
+        return torch.cat(padded)
+
+    def reorder_state(self, index: torch.Tensor):
+        # src_attn states are identical for all beams of a sentence; only self_attn follows beams
+        for layer_cache in self.cache.values():
+            attn_cache = layer_cache.get('self_attn', {})
+            for name, val in attn_cache.items():
+                attn_cache[name] = val.index_select(0, index)
 
     def generate_next(self, past_ys):
-        out = self.model.decode(self.memory, self.x_mask, past_ys, subsequent_mask(past_ys.size(1)))
-        if self.multi_label:
+        if self.incremental:
+            positions = None
+            if self.y_mask is not None:  # rows are at different time steps; see extend()
+                positions = self.y_mask.sum(dim=-1)  # [Batch x 1]
+                self.y_mask = torch.cat([self.y_mask, self.y_mask.new_ones(len(self.y_mask), 1, 1)],
+                                        dim=-1)
+            out = self.model.decode(self.memory, self.x_mask, past_ys, self.y_mask,
+                                    cache=self.cache, positions=positions)
+        else:
+            out = self.model.decode(self.memory, self.x_mask, past_ys,
+                                    subsequent_mask(past_ys.size(1)))
+        if self.vocab_subset is not None:
+            # same as generator, but projects only to vocab_subset
+            logits = F.linear(self.model.generator.features(out[:, -1]), *self.subset_proj)
+            if self.multi_label:
+                log_probs = logits.sigmoid().log()
+            else:
+                log_probs = F.log_softmax(logits, dim=-1)
+        elif self.multi_label:
             log_probs = self.model.generator(out[:, -1], score='sigmoid').log()
         else:
             log_probs = self.model.generator(out[:, -1], score='log_softmax')
@@ -79,8 +262,12 @@ class MTfmGenerator(GeneratorFactory):
 
 class TfmExtEembGenerator(T2TGenerator):
 
+    beam_expansion = False
+    state_compaction = False
+    state_extension = False
+
     def __init__(self, model: TransformerNMT, x_seqs, x_lens=None):
-        super().__init__(model, x_seqs, x_seqs)
+        super().__init__(model, x_seqs, x_seqs, incremental=False)
         self.src_ext_emb = self.model.src_ext_emb(x_seqs)
 
     def generate_next(self, past_ys):
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+#
+# Created: 10/17/26
+
+"""
+Dynamic int8 quantization of models for inference on CPU
+"""
+from typing import Dict
+
+import torch
+import torch.nn as nn
+
+from rtg import log
+
+# layers to be quantized; in transformers, this covers MultiHeadedAttention.linears,
+#   PositionwiseFeedForward and Generator.proj
+QUANTIZABLE = {nn.Linear}
+
+
+def quantize_model(model: nn.Module) -> nn.Module:
+    """
+    Dynamically quantizes the weights of linear layers to int8; activations are quantized on the
+    fly. Quantized models run on CPU only.
+    :param model: model in eval mode
+    :return: a quantized copy of the model
+    """
+    assert not model.training, 'Only models in eval mode are quantized'
+    log.info(f"Quantizing {', '.join(m.__name__ for m in QUANTIZABLE)} layers to int8")
+    return torch.quantization.quantize_dynamic(model.to('cpu'), QUANTIZABLE, dtype=torch.qint8)
+
+
+def is_quantized_state(state: Dict) -> bool:
+    """
+    :param state: model state dict
+    :return: True if the state is of a quantized model, see quantize_model()
+    """
+    return any(key.endswith('_packed_params') for key in state)
@@ -8,7 +8,7 @@ import copy
 import torch
 import torch.nn as nn
 from abc import ABC
-from typing import List, Optional
+from typing import List, Optional, Dict
 
 from rtg.module import tfmnmt as tfm
 from rtg.utils import get_my_args
@@ -45,10 +45,11 @@ class SkipDecoder(tfm.Decoder):
         else:
             self.depth_probs = [1.0 for _ in range(N)]
 
-    def forward(self, x, memory, src_mask, tgt_mask):
-        for layer, run_prob in zip(self.layers, self.depth_probs):
+    def forward(self, x, memory, src_mask, tgt_mask, cache: Optional[Dict] = None):
+        for i, (layer, run_prob) in enumerate(zip(self.layers, self.depth_probs)):
             if not self.training or run_prob >= torch.rand(1).item():
-                x = layer(x, memory, src_mask, tgt_mask)
+                x = layer(x, memory, src_mask, tgt_mask,
+                          cache=None if cache is None else cache.setdefault(i, {}))
         return self.norm(x)
 
 
@@ -1,11 +1,13 @@
 # Transformer aka "Attention is all you need"
 # Thanks to http://nlp.seas.harvard.edu/2018/04/03/attention.html
+import collections
 import copy
 import math
 import time
 import gc
 from abc import ABC
-from typing import Callable, Optional, Union
+from contextlib import nullcontext
+from typing import Callable, Optional, Union, Dict
 import traceback
 
 import torch
@@ -17,7 +19,7 @@ from tqdm import tqdm
 
 from rtg import device, log, TranslationExperiment as Experiment
 from rtg.utils import get_my_args
-from rtg.data.dataset import BatchIterable
+from rtg.data.dataset import BatchIterable, PrefetchIterable
 from rtg.module import NMTModel
 from rtg.module.trainer import TrainerState, TrainerStateWithRDrop, SteppedTrainer, EarlyStopper
 from rtg.module.criterion import Criterion, SmoothKLD
@@ -84,6 +86,13 @@ class Generator(nn.Module):
         x = self.proj(x)
         return self.scores[score](x, dim=-1)
 
+    def features(self, x):
+        """
+        :param x: hidden states
+        :return: inputs to the output projection (proj); subclasses may transform x here
+        """
+        return x
+
 
 class EncoderLayer(nn.Module):
     "Encoder is made up of self-attn and feed forward (defined below)"
@@ -128,11 +137,19 @@ class DecoderLayer(nn.Module):
         self.feed_forward = feed_forward
         self.sublayer = clones(SublayerConnection(size, dropout), 3)
 
-    def forward(self, x, memory, src_mask, tgt_mask):
-        "Follow Figure 1 (right) for connections."
+    def forward(self, x, memory, src_mask, tgt_mask, cache: Optional[Dict] = None):
+        """
+        Follow Figure 1 (right) for connections.
+        :param cache: optional state of this layer for incremental decoding; see Decoder.forward
+        """
         m = memory
-        x = self.sublayer[0](x, lambda _x: self.self_attn(_x, _x, _x, tgt_mask))
-        x = self.sublayer[1](x, lambda _x: self.src_attn(_x, m, m, src_mask))
+        self_cache, src_cache = None, None
+        if cache is not None:
+            self_cache = cache.setdefault('self_attn', {})
+            src_cache = cache.setdefault('src_attn', {})
+        x = self.sublayer[0](x, lambda _x: self.self_attn(_x, _x, _x, tgt_mask, cache=self_cache))
+        x = self.sublayer[1](x, lambda _x: self.src_attn(_x, m, m, src_mask, cache=src_cache,
+                                                         static_kv=True))
         return self.sublayer[2](x, self.feed_forward)
 
 
@@ -144,9 +161,20 @@ class Decoder(nn.Module):
         self.layers = clones(layer, n_layers)
         self.norm = nn.LayerNorm(layer.size)
 
-    def forward(self, x, memory, src_mask, tgt_mask):
-        for layer in self.layers:
-            x = layer(x, memory, src_mask, tgt_mask)
+    def forward(self, x, memory, src_mask, tgt_mask, cache: Optional[Dict] = None):
+        """
+        :param x: target side inputs
+        :param memory: encoder outputs
+        :param src_mask: source mask
+        :param tgt_mask: target (autoregressive) mask; unused in incremental mode
+        :param cache: optional dict for incremental decoding. When given, x is the newest time step
+           only, and the keys and values of the past time steps are read from (and appended to) this
+           cache as {layer_idx: {attn_name: {'key': tensor, 'value': tensor}}}
+        :return:
+        """
+        for i, layer in enumerate(self.layers):
+            x = layer(x, memory, src_mask, tgt_mask,
+                      cache=None if cache is None else cache.setdefault(i, {}))
         return self.norm(x)
 
 
@@ -178,8 +206,38 @@ class AbstractTransformerNMT(NMTModel, ABC):
     def encode(self, src, src_mask):
         return self.encoder(self.src_embed(src), src_mask)
 
-    def decode(self, memory, src_mask, tgt, tgt_mask):
-        return self.decoder(self.tgt_embed(tgt), memory, src_mask, tgt_mask)
+    def decode(self, memory, src_mask, tgt, tgt_mask, cache: Optional[Dict] = None,
+               positions: Optional[torch.Tensor] = None):
+        """
+        :param memory: encoder outputs
+        :param src_mask: source mask
+        :param tgt: target sequences
+        :param tgt_mask: target mask; with cache, it is optional and masks the time steps of cache
+        :param cache: optional state for incremental decoding; when given, only the last time step
+          of tgt is decoded while the past time steps are served from this cache.
+        :param positions: optional [Batch x 1] positions of the last time step; used with cache
+          when sequences are at different time steps. Default is the last position of tgt
+        :return: decoder features
+        """
+        if cache is None:
+            return self.decoder(self.tgt_embed(tgt), memory, src_mask, tgt_mask)
+        if positions is None:
+            positions = torch.full((tgt.size(0), 1), fill_value=tgt.size(1) - 1,
+                                   dtype=torch.long, device=tgt.device)
+        embed, pos_enc = self.tgt_embed
+        x = pos_enc(embed(tgt[:, -1:]), positions=positions)
+        return self.decoder(x, memory, src_mask, tgt_mask, cache=cache)
+
+    def init_decode_cache(self, memory) -> Dict:
+        """
+        Creates a cache for incremental decoding (see decode()) with the keys and values of
+        src_attn of every decoder layer projected from memory, so they are computed once for all
+        time steps instead of once per time step
+        :param memory: encoder outputs
+        :return: cache
+        """
+        return {i: {'src_attn': layer.src_attn.project_key_value(memory, memory)}
+                for i, layer in enumerate(self.decoder.layers)}
 
     def forward(self, src, tgt, src_mask, tgt_mask, gen_probs=False, log_probs=True, encode_only=False):
         "Take in and process masked src and target sequences."
@@ -409,20 +467,36 @@ class MultiHeadedAttention(nn.Module):
         self.attn = None
         self.dropout = nn.Dropout(p=dropout)
 
-    def forward(self, query, key, value, mask=None):
-        "Implements Figure 2"
+    def forward(self, query, key, value, mask=None, cache: Optional[Dict[str, torch.Tensor]] = None,
+                static_kv=False):
+        """
+        Implements Figure 2
+        :param cache: optional dict for incremental decoding; projected keys and values of the
+          current call are appended to the ones already in the cache (along the time dimension)
+        :param static_kv: key and value are same for all calls (e.g. encoder memory), so the
+          projected key and value in the cache are reused as they are
+        """
         if mask is not None:
             # Same mask applied to all h heads.
             mask = mask.unsqueeze(1)  # [BatchSize x 1 x Time x SeqLen]  1=Broadcast for all heads
         batch_size = query.size(0)
 
-        # 1) Do all the linear projections in batch from d_model => h x d_k
-        query, key, value = \
-            [l(x).view(batch_size, -1, self.h, self.d_k).transpose(1, 2)
-             for l, x in zip(self.linears, (query, key, value))]
-        # Q,K,V  --> input, linear: [BatchSize x SeqLen x ModelDim]
-        #        --> view: [BatchSize x SeqLen x Heads x ModelDim/Heads ]
-        #        --> transpose: [BatchSize x Heads x SeqLen x ModelDim/Heads ]
+        if cache is not None and static_kv and 'key' in cache:
+            query = self.linears[0](query).view(batch_size, -1, self.h, self.d_k).transpose(1, 2)
+            key, value = cache['key'], cache['value']
+        else:
+            # 1) Do all the linear projections in batch from d_model => h x d_k
+            query, key, value = \
+                [l(x).view(batch_size, -1, self.h, self.d_k).transpose(1, 2)
+                 for l, x in zip(self.linears, (query, key, value))]
+            # Q,K,V  --> input, linear: [BatchSize x SeqLen x ModelDim]
+            #        --> view: [BatchSize x SeqLen x Heads x ModelDim/Heads ]
+            #        --> transpose: [BatchSize x Heads x SeqLen x ModelDim/Heads ]
+            if cache is not None:
+                if 'key' in cache:  # past time steps were projected by earlier calls
+                    key = torch.cat([cache['key'], key], dim=2)
+                    value = torch.cat([cache['value'], value], dim=2)
+                cache['key'], cache['value'] = key, value
 
         # 2) Apply attention on all the projected vectors in batch.
         x, self.attn = attention(query, key, value, mask=mask, dropout=self.dropout)
@@ -435,6 +509,16 @@ class MultiHeadedAttention(nn.Module):
 
         return self.linears[-1](x)
 
+    def project_key_value(self, key, value) -> Dict[str, torch.Tensor]:
+        """
+        Projects key and value (but not query); the result can be used as a cache with static_kv
+        :return: {'key': [BatchSize x Heads x SeqLen x ModelDim/Heads], 'value': (same as key)}
+        """
+        batch_size = key.size(0)
+        key, value = [l(x).view(batch_size, -1, self.h, self.d_k).transpose(1, 2)
+                      for l, x in zip(self.linears[1:3], (key, value))]
+        return dict(key=key, value=value)
+
 
 class PositionwiseFeedForward(nn.Module):
     "Implements FFN equation."
@@ -484,8 +568,15 @@ class PositionalEncoding(nn.Module):
         pe = pe.unsqueeze(0)
         self.register_buffer('pe', pe)
 
-    def forward(self, x):
-        x = x + Variable(self.pe[:, :x.size(1)], requires_grad=False)
+    def forward(self, x, positions: Optional[torch.Tensor] = None):
+        """
+        :param x: [Batch x Time x ModelDim] embeddings
+        :param positions: optional [Batch x Time] positions; default is 0, 1, 2... for all sequences
+        """
+        if positions is None:
+            x = x + Variable(self.pe[:, :x.size(1)], requires_grad=False)
+        else:
+            x = x + self.pe[0, positions]
         return self.dropout(x)
 
 
@@ -637,7 +728,8 @@ class ChunkedLossCompute(SimpleLossFunction):
             loss = self.criterion(chunked_dist, chunked_ys).sum() / normalizer
             total += loss.detach().item()
             if train_mode:
-                dtorch.backward(loss)
+                with dtorch.no_sync():  # generator grads are ready when y_feats.backward begins
+                    dtorch.backward(loss)
         if train_mode:
             out_grad = _y_feats.grad.data
             y_feats.backward(gradient=out_grad)
@@ -697,7 +789,8 @@ class ChunkedLossComputeWithRDrop(SimpleLossFunctionWithRDrop):
             total += loss.detach().item()
             total_nll += nll_loss.detach().item()
             total_kl += kl_loss.detach().item()
-            dtorch.backward(loss)
+            with dtorch.no_sync():  # generator grads are ready when y_feats.backward begins
+                dtorch.backward(loss)
             if get_out:
                 top_idxs = chunked_lprobs.argmax(dim=-1) # # B x C x V -> B x C
                 out_chunks.append(top_idxs)
@@ -894,13 +987,18 @@ class TransformerTrainer(SteppedTrainer):
         :param keep_models: how many checkpts to keep
         :param keep_in_mem: keep training data in memory
         :param early_stop: {patience: N validations, by: loss, enabled: True}
-        :param args: any extra args
+        :param args: any extra args; prefetch: number of batches to read ahead in background
         :return:
         """
         log_resources = args.pop('log_resources', False)
         log_embedding = args.pop('log_embedding', False)
         split_ratio = args.pop('split_ratio', 0.)
+        swr_workers = args.pop('swr_workers', 0)
+        len_jitter = args.pop('len_jitter', 0.)
+        corpus_weights = args.pop('corpus_weights', None)
+        corpus_temperature = args.pop('corpus_temperature', 1.)
         dynamic_epoch = args.pop('dynamic_epoch', False)
+        prefetch = args.pop('prefetch', 2)
         assert log_interval > 0
 
         # Gradient accumulation
@@ -928,8 +1026,12 @@ class TransformerTrainer(SteppedTrainer):
 
         train_data = self.exp.get_train_data(
             batch_size=batch_size, steps=batches - start_batch, sort_by=sort_by, batch_first=True,
-            fine_tune=fine_tune, keep_in_mem=keep_in_mem, split_ratio=split_ratio, dynamic_epoch=dynamic_epoch
-        )
+            fine_tune=fine_tune, keep_in_mem=keep_in_mem, split_ratio=split_ratio, dynamic_epoch=dynamic_epoch,
+            swr_workers=swr_workers, corpus_weights=corpus_weights,
+            corpus_temperature=corpus_temperature, len_jitter=len_jitter)
+        if self.data_state and hasattr(train_data, 'load_state_dict'):
+            # skip the batches that were trained on before the last checkpoint
+            train_data.load_state_dict(self.data_state)
         val_data = None
         if distr.is_global_main:
             val_data = self.exp.get_val_data(batch_size=max_toks, shuffle=False, batch_first=True,
@@ -950,11 +1052,17 @@ class TransformerTrainer(SteppedTrainer):
         else:
             mono_state = None
             mlm_weight = None
+        if prefetch > 0:  # read batches (and move to device) ahead in background
+            train_data = PrefetchIterable(train_data, size=prefetch,
+                                          device=device if self.n_gpus <= 1 else None)
+        self.train_data = train_data
 
         unsaved_state = False
         cuda_available = torch.cuda.is_available()
 
         batch_count = -1
+        step_toks = 0  # of the micro-batches since the last step
+        corpus_toks = collections.Counter()  # when drawn from multiple corpora
         stopper = None
         early_stopped = False   # or converged
         if early_stop:
@@ -976,6 +1084,12 @@ class TransformerTrainer(SteppedTrainer):
                     batch = batch.to(device)
 
                 num_toks = batch.y_toks
+                if batch.corpus:
+                    corpus_toks[batch.corpus] += num_toks
+                step_toks += num_toks
+                if take_step:  # ranks are weighed by their tokens in the average of grads
+                    distr.set_grad_weight(step_toks)
+                    step_toks = 0
                 x_seqs = batch.x_seqs
                 if dec_bos_cut:
                     bos_step = x_seqs[:, :1]
@@ -989,48 +1103,50 @@ class TransformerTrainer(SteppedTrainer):
                 y_seqs_with_bos = torch.cat([bos_step, batch.y_seqs], dim=1)
                 y_mask = batch.make_autoreg_mask(y_seqs_with_bos)
 
-                with autocast(enabled=dtorch.fp16):
-                    # [Batch x Time x D]
-                    out = self.model(x_seqs, y_seqs_with_bos, x_mask, y_mask)
-                    if self.rdrop > 0:
-                        out2 = self.model(x_seqs, y_seqs_with_bos, x_mask, y_mask)
-                        # [Batch*2 x Time x D]
-                        out = torch.cat([out, out2], dim=0)
-
-                    # skip the last time step (the one with EOS as input)
-                    out = out[:, :-1, :]
-
-                    # assumption:  y_seqs has EOS, and not BOS
-                    loss = self.loss_func(out, batch.y_seqs, num_toks, train_mode=True,
-                                          take_step=take_step and not self.mlm)
-
-                    if self.rdrop > 0:
-                        loss, nll_loss, kl_loss = loss
-                    else:
-                        nll_loss = loss
-                        kl_loss = 0.0
-
-                if mono_batch is not None:
-                    if self.n_gpus <= 1:
-                        mono_batch = mono_batch.to(device)
-
-                    seqs = mono_batch.x_seqs
-                    x_mask = (seqs != mono_batch.pad_val).unsqueeze(1)
-                    masked_seq, mask = mono_batch.mask_tokens(seqs, p=self.mask_prob)
-                    tgt_seqs = seqs[mask]
-                    num_masked_toks = mask.int().sum().item()
+                # accumulation micro-batches dont communicate; grads are reduced at the step
+                with (nullcontext() if take_step else distr.no_sync()):
                     with autocast(enabled=dtorch.fp16):
                         # [Batch x Time x D]
-                        out = self.model(masked_seq, None, x_mask, None, encode_only=True)
-                        # [B x D]
-                        out = out[mask, :]
-                        # [B, V]
-                        out = F.linear(out, mlm_weight)
-                        out = F.log_softmax(out, dim=-1)
-                        mlm_loss = self.mlm_loss_func(out, tgt_seqs, num_masked_toks,
-                                                      train_mode=True, take_step=take_step)
-                else:
-                    mlm_loss = 0.0
+                        out = self.model(x_seqs, y_seqs_with_bos, x_mask, y_mask)
+                        if self.rdrop > 0:
+                            out2 = self.model(x_seqs, y_seqs_with_bos, x_mask, y_mask)
+                            # [Batch*2 x Time x D]
+                            out = torch.cat([out, out2], dim=0)
+
+                        # skip the last time step (the one with EOS as input)
+                        out = out[:, :-1, :]
+
+                        # assumption:  y_seqs has EOS, and not BOS
+                        loss = self.loss_func(out, batch.y_seqs, num_toks, train_mode=True,
+                                              take_step=take_step and not self.mlm)
+
+                        if self.rdrop > 0:
+                            loss, nll_loss, kl_loss = loss
+                        else:
+                            nll_loss = loss
+                            kl_loss = 0.0
+
+                    if mono_batch is not None:
+                        if self.n_gpus <= 1:
+                            mono_batch = mono_batch.to(device)
+
+                        seqs = mono_batch.x_seqs
+                        x_mask = (seqs != mono_batch.pad_val).unsqueeze(1)
+                        masked_seq, mask = mono_batch.mask_tokens(seqs, p=self.mask_prob)
+                        tgt_seqs = seqs[mask]
+                        num_masked_toks = mask.int().sum().item()
+                        with autocast(enabled=dtorch.fp16):
+                            # [Batch x Time x D]
+                            out = self.model(masked_seq, None, x_mask, None, encode_only=True)
+                            # [B x D]
+                            out = out[mask, :]
+                            # [B, V]
+                            out = F.linear(out, mlm_weight)
+                            out = F.log_softmax(out, dim=-1)
+                            mlm_loss = self.mlm_loss_func(out, tgt_seqs, num_masked_toks,
+                                                          train_mode=True, take_step=take_step)
+                    else:
+                        mlm_loss = 0.0
 
 
                 if stopper and take_step:
@@ -1044,6 +1160,8 @@ class TransformerTrainer(SteppedTrainer):
                                                       'mlm_loss': mlm_loss,
                                                       'learn_rate': self.opt.curr_lr},
                                          self.opt.curr_step)
+                    if corpus_toks:
+                        self.tbd.add_scalars('corpus_toks', dict(corpus_toks), self.opt.curr_step)
                     if log_resources and cuda_available:
                         self._log_resources(batch)
 
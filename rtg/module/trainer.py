@@ -14,7 +14,7 @@ from typing import Optional, Callable, List
 from dataclasses import dataclass, field
 import time
 
-from torch import optim
+from torch import optim, nn
 from torch.optim.optimizer import Optimizer
 from torch.utils.tensorboard import SummaryWriter
 from enum import Enum
@@ -265,6 +265,71 @@ class EarlyStopper:
         return should_stop
 
 
+class WeightsEMA:
+    """
+    Exponential moving average (EMA) of model weights, updated after every `interval` optimizer
+    steps: ema = decay * ema + (1 - decay) * weights.
+    The decay is warmed up as min(decay, (1 + n) / (10 + n)) where n is the number of updates,
+    so that the average is not dominated by the (random) initial weights.
+    Floating point entries of the state dict are averaged in float32; the rest (e.g. int buffers)
+    are copied from the model.
+    """
+
+    def __init__(self, model: nn.Module, decay: float = 0.9999, interval: int = 1,
+                 device: Optional[str] = None):
+        """
+        :param model: model whose weights are to be averaged
+        :param decay: decay of the average per update; 0 < decay < 1
+        :param interval: update the average every these many optimizer steps
+        :param device: device for the average; default is the device of model.
+           'cpu' saves GPU memory, at the cost of copying the weights at every update
+        """
+        assert 0 < decay < 1, f'ema.decay should be in (0, 1); given={decay}'
+        assert interval > 0, f'ema.interval should be positive; given={interval}'
+        self.decay = decay
+        self.interval = interval
+        self.updates = 0
+        # state dict tensors share memory with the model, so they track the updates
+        self._model_state = model.state_dict()
+        self.state = {key: val.detach().to(device=device or val.device, copy=True,
+                                           dtype=torch.float32 if val.is_floating_point() else None)
+                      for key, val in self._model_state.items()}
+        log.info(f"Weights EMA: decay={decay}, interval={interval}, device={device}")
+
+    @torch.no_grad()
+    def update(self, step: int):
+        """
+        Updates the average, if step is a multiple of interval
+        :param step: optimizer step number
+        """
+        if step % self.interval != 0:
+            return
+        self.updates += 1
+        decay = min(self.decay, (1 + self.updates) / (10 + self.updates))
+        for key, val in self._model_state.items():
+            avg = self.state[key]
+            if avg.is_floating_point():
+                avg.lerp_(val.to(device=avg.device, dtype=avg.dtype), 1 - decay)
+            else:
+                avg.copy_(val)
+
+    def model_state(self):
+        """
+        :return: the averaged weights as a state dict, in the dtypes of model
+        """
+        return {key: self.state[key].to(dtype=val.dtype) for key, val in self._model_state.items()}
+
+    def state_dict(self):
+        return dict(model_state=self.model_state(), decay=self.decay, interval=self.interval,
+                    updates=self.updates)
+
+    def load_state_dict(self, state):
+        assert set(state['model_state'].keys()) == set(self.state.keys())
+        for key, val in state['model_state'].items():
+            self.state[key].copy_(val)
+        self.updates = state.get('updates', 0)
+
+
 class NoOpSummaryWriter(SummaryWriter):
     """
     A No-Op TensorBordX for tests and such experiments that doesnt want to leave
@@ -318,6 +383,9 @@ class SteppedTrainer:
         self.last_step = -1
         self.exp = exp
         optim_state = None
+        ema_state = None
+        self.data_state = None  # position of training data iterator, to resume from
+        self.train_data = None  # training data iterator; its state is saved in checkpoints
         if model:
             self.model = model
         else:
@@ -334,6 +402,8 @@ class SteppedTrainer:
 
                 if 'optim_state' in state:
                     optim_state = state['optim_state']
+                self.data_state = state.get('data_state')
+                ema_state = state.get('ema_state')
                 self.model.load_state_dict(model_state)
                 if 'amp_state' in state and dtorch.fp16:
                     log.info("Restoring  AMP state")
@@ -403,6 +473,28 @@ class SteppedTrainer:
         self.mlm = optim_args['mlm']
         self.mask_prob = optim_args['mask_prob']
 
+        # average of weights; created after maybe_init_model, so it starts from the initial weights
+        self.ema: Optional[WeightsEMA] = None
+        ema_args = self.exp.config['optim'].get('ema')
+        if ema_args:
+            self.ema = WeightsEMA(self.core_model, **ema_args)
+            if ema_state:
+                log.info("restoring weights EMA from checkpoint")
+                self.ema.load_state_dict(ema_state)
+            self._register_ema_hook()
+
+    def _register_ema_hook(self):
+        """Updates the EMA of weights after every optimizer step, irrespective of the trainer"""
+        if hasattr(self.opt, 'register_step_post_hook'):  # torch 2.0+
+            self.opt.register_step_post_hook(lambda *args: self.ema.update(self.opt.curr_step))
+        else:
+            opt_step = self.opt.step
+
+            def step(closure=None):
+                opt_step(closure=closure)
+                self.ema.update(self.opt.curr_step)
+            self.opt.step = step
+
     @property
     def start_step(self):
         _, step = self.exp.get_last_saved_model()
@@ -525,9 +617,15 @@ class SteppedTrainer:
         }
         if dtorch.fp16:
             state['amp_state'] = dtorch._scaler.state_dict()
+        if self.ema is not None:
+            state['ema_state'] = self.ema.state_dict()
+        if hasattr(self.train_data, 'state_dict'):
+            data_state = self.train_data.state_dict()
+            if data_state:
+                state['data_state'] = data_state
 
         self.exp.store_model(step_num, state, train_score=train_loss,
-                             val_score=val_loss, keep=keep_models)
+                             val_score=val_loss, keep=keep_models, background=True)
         self.last_step = step_num
 
     @abstractmethod
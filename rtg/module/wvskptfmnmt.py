@@ -6,7 +6,7 @@
 
 import torch
 import torch.nn as nn
-from typing import List, Optional
+from typing import List, Optional, Dict
 
 from rtg.module import wvtfmnmt as wvtfm
 from rtg.module import tfmnmt as tfm
@@ -51,10 +51,11 @@ class WidthVaryingSkipDecoder(wvtfm.WidthVaryingDecoder):
         else:
             self.depth_probs = [1.0 for _ in range(N)]
 
-    def forward(self, x, memory, src_mask, tgt_mask):
-        for layer, run_prob in zip(self.layers, self.depth_probs):
+    def forward(self, x, memory, src_mask, tgt_mask, cache: Optional[Dict] = None):
+        for i, (layer, run_prob) in enumerate(zip(self.layers, self.depth_probs)):
             if not self.training or run_prob >= torch.rand(1).item():
-                x = layer(x, memory, src_mask, tgt_mask)
+                x = layer(x, memory, src_mask, tgt_mask,
+                          cache=None if cache is None else cache.setdefault(i, {}))
         return self.norm(x)
 
 
@@ -6,7 +6,7 @@
 
 import torch.nn as nn
 from abc import ABC
-from typing import List, Optional
+from typing import List, Optional, Dict
 
 from rtg.module.tfmnmt import (EncoderLayer, DecoderLayer, PositionwiseFeedForward, MultiHeadedAttention,
                                Embeddings, PositionalEncoding, Generator, AbstractTransformerNMT, TransformerTrainer)
@@ -56,9 +56,10 @@ class WidthVaryingDecoder(nn.Module):
         self.layers = nn.ModuleList(layers)
         self.norm = nn.LayerNorm(d_model)
 
-    def forward(self, x, memory, src_mask, tgt_mask):
-        for layer in self.layers:
-            x = layer(x, memory, src_mask, tgt_mask)
+    def forward(self, x, memory, src_mask, tgt_mask, cache: Optional[Dict] = None):
+        for i, layer in enumerate(self.layers):
+            x = layer(x, memory, src_mask, tgt_mask,
+                      cache=None if cache is None else cache.setdefault(i, {}))
         return self.norm(x)
 
 
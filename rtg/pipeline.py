@@ -222,7 +222,7 @@ class Pipeline:
             max_len = args.get('max_len', 256))
         ens = args.get('ensemble', 1)
         _, step = exp.get_last_saved_model()
-        model = exp.load_model(ensemble=ens)
+        model = exp.load_model(ensemble=ens, ema=args.get('ema', False))
         model = model.eval()
         test_dir = exp.work_dir / f'test_step{step}_ens{ens}'
         test_dir.mkdir(exist_ok=True, parents=True)
@@ -308,7 +308,10 @@ class Pipeline:
         log.info(f"Test Dir = {test_dir}")
         test_dir.mkdir(parents=True, exist_ok=True)
 
-        decoder = Decoder.new(exp, ensemble=ensemble)
+        # dec_args is persisted in conf, so Decoder.new args are read, not popped; decode_eval_file
+        # is given the decoding args explicitly
+        new_args = {k: dec_args[k] for k in Decoder.new_args if k != 'ensemble' and k in dec_args}
+        decoder = Decoder.new(exp, ensemble=ensemble, **new_args)
         for name, data in suite.items():
             # noinspection PyBroadException
             src, ref = data, None
@@ -380,8 +383,13 @@ def parse_args():
                         help="Multi-GPU - Local rank")
     parser.add_argument("--master-port", type=int, default=-1,
                         help="Master port (for multi-node SLURM jobs)")
+    parser.add_argument("--grad-bucket-mb", type=float, default=dtorch.grad_bucket_mb,
+                        help="Multi-GPU - size (MB) of gradient buckets for all-reduce")
+    parser.add_argument("--grad-fp16", action="store_true", default=False,
+                        help="Multi-GPU - compress gradients to float16 for all-reduce")
     dtorch.setup()
     args = parser.parse_args()
+    dtorch.grad_bucket_mb, dtorch.grad_fp16 = args.grad_bucket_mb, args.grad_fp16
     if args.fp16:
         assert torch.cuda.is_available(), "GPU required for fp16... exiting."
         dtorch.enable_fp16()
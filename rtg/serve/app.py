@@ -7,12 +7,15 @@ from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 from flask import Flask, request, jsonify, render_template, send_from_directory, Blueprint
 import torch
 import os
+import atexit
 import html
 from sacremoses import MosesTokenizer, MosesDetokenizer, MosesPunctNormalizer, MosesTruecaser
 from functools import partial
 
-from rtg import TranslationExperiment as Experiment
+from rtg import TranslationExperiment as Experiment, log
 from rtg.module.decoder import Decoder
+from rtg.serve.batcher import MicroBatcher
+from rtg.serve.cache import TranslationCache, model_fingerprint
 from rtg.utils import shell_pipe
 
 
@@ -137,7 +140,26 @@ def attach_translate_route(cli_args):
     global exp, src_prep, tgt_postp
     exp = Experiment(cli_args.pop("exp_dir"), read_only=True)
     dec_args = exp.config.get("decoder") or exp.config["tester"].get("decoder", {})
-    decoder = Decoder.new(exp, ensemble=dec_args.pop("ensemble", 1))
+    decoder = Decoder.new(exp, ensemble=dec_args.pop("ensemble", 1),
+                          quantize=dec_args.pop("quantize", False),
+                          shortlist=dec_args.pop("shortlist", False),
+                          ema=dec_args.pop("ema", False))
+    for name in ("batch_size", "continuous", "sort_window", "workers"):  # for rtg-decode only
+        dec_args.pop(name, None)
+    for name in ("max_wait", "max_tokens", "max_src_len", "cache"):  # from CLI args, below
+        if dec_args.pop(name, None) is not None:
+            log.warning(f"decoder.{name} in conf is ignored; rtg-serve uses its CLI args instead")
+    batcher = MicroBatcher(decoder, max_wait=cli_args.pop("max_wait"),
+                           max_tokens=cli_args.pop("max_batch_tokens"),
+                           max_src_len=cli_args.pop("max_src_len"), **dec_args)
+    cache_size = cli_args.pop("cache_size")
+    if cache_size > 0:
+        # truncation affects the translations, so it is a part of the cache namespace
+        cache_args = dict(batcher.dec_args, max_src_len=batcher.max_src_len)
+        batcher.cache = TranslationCache(model_fingerprint(decoder.model), dec_args=cache_args,
+                                         max_size=cache_size, ttl=cli_args.pop("cache_ttl"),
+                                         path=cli_args.pop("cache_db"))
+        atexit.register(batcher.cache.close)  # commit the pending writes
     src_prep, tgt_postp = TextTransform.recommended()
     src_prep_chain = exp.config.get('prep', {}).get('src_pre_proc', None)
     tgt_postp_chain = exp.config.get('prep', {}).get('tgt_post_proc', None)
@@ -161,16 +183,17 @@ def attach_translate_route(cli_args):
         prep = request.args.get('prep', "True").lower() in ("true", "yes", "y", "t")
         if prep:
             sources = [src_prep(sent) for sent in sources]
-        translations = []
-        for source in sources:
-            translated = decoder.decode_sentence(source, **dec_args)[0][1]
-            if prep:
-                translated = tgt_postp(translated.split())
-            translations.append(translated)
+        translations = batcher.translate(sources)
+        if prep:
+            translations = [tgt_postp(translated.split()) for translated in translations]
 
         res = dict(source=sources, translation=translations)
         return jsonify(res)
 
+    @bp.route("/stats", methods=["GET"])
+    def stats():
+        return jsonify(dict(cache=batcher.cache.stats() if batcher.cache is not None else None))
+
     @bp.route("/conf.yml", methods=["GET"])
     def get_conf():
         conf_str = exp._config_file.read_text(encoding='utf-8', errors='ignore')
@@ -195,6 +218,16 @@ def parse_args():
     parser.add_argument("-b", "--base", help="Base prefix path for all the URLs")
     parser.add_argument("-msl", "--max-src-len", type=int, default=250,
                         help="max source len; longer seqs will be truncated")
+    parser.add_argument("-mw", "--max-wait", type=float, default=10,
+                        help="Milliseconds to wait for concurrent requests to be batched together")
+    parser.add_argument("-mbt", "--max-batch-tokens", type=int, default=4000,
+                        help="Maximum source tokens (subword pieces) in a batch of concurrent requests")
+    parser.add_argument("-cs", "--cache-size", type=int, default=10_000,
+                        help="Maximum number of translations in cache; 0 disables the cache")
+    parser.add_argument("-ct", "--cache-ttl", type=float, default=0,
+                        help="Seconds after which cached translations expire; 0 for never")
+    parser.add_argument("-cdb", "--cache-db",
+                        help="SQLite file path to persist the cached translations across restarts")
     args = vars(parser.parse_args())
     return args
 
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#
+# Created: 10/17/26
+
+"""
+Micro-batching of concurrent translation requests:
+sentences from requests that arrive within a short wait are decoded together in one batch
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Optional
+
+import torch
+
+from rtg import log, my_tensor as tensor
+from rtg.module.decoder import Decoder
+from rtg.serve.cache import TranslationCache
+
+
+class MicroBatcher:
+    """
+    Collects sentences of concurrent requests in a background thread, and decodes them together
+    via Decoder.beam_decode. A batch is decoded as soon as `max_wait` milliseconds have passed since
+    its first request arrived, or its sentences have `max_tokens` (subword pieces, as encoded for
+    decoding), whichever is earlier.
+    If a cache is given, only the sentences missing in the cache are decoded.
+    """
+
+    def __init__(self, decoder: Decoder, max_wait: float = 10, max_tokens: int = 4000,
+                 max_len=20, max_src_len: int = 0, cache: Optional[TranslationCache] = None,
+                 **dec_args):
+        """
+        :param decoder: decoder
+        :param max_wait: milliseconds to wait for more requests after the first one of a batch
+        :param max_tokens: maximum number of source tokens (including padding) in a batch
+        :param max_len: maximum time steps to decode, relative to source length
+        :param max_src_len: truncate sources at these many pieces; 0 disables this
+        :param cache: optional cache of translations; it must be made for the same model and args
+        :param dec_args: args to Decoder.beam_decode such as beam_size, num_hyp and lp_alpha
+        """
+        assert max_wait >= 0 and max_tokens > 0
+        self.decoder = decoder
+        self.max_wait = max_wait / 1000
+        self.max_tokens = max_tokens
+        self.max_src_len = max_src_len
+        self.dec_args = dict(dec_args, max_len=max_len)
+        self.cache = cache
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self._run, name='MicroBatcher', daemon=True)
+        self.worker.start()
+
+    def submit(self, sources: List[str]) -> Future:
+        """
+        Submits sentences for translation
+        :param sources: source sentences (pre-processed)
+        :return: a future of [[(score, translation)...] for each sentence] hypotheses
+        """
+        sources = [src.strip() for src in sources]
+        seqs = [self._encode(src) for src in sources]  # in the caller's thread
+        future = Future()
+        self.requests.put((sources, seqs, future))
+        return future
+
+    def _encode(self, source: str) -> List[int]:
+        seq = self.decoder.inp_vocab.encode_as_ids(source, add_eos=True, add_bos=False)
+        if self.max_src_len > 0 and len(seq) > self.max_src_len:
+            log.warning(f"Source full length={len(seq)} ; truncated to {self.max_src_len}")
+            seq = seq[:self.max_src_len]
+        return seq
+
+    def translate(self, sources: List[str]) -> List[str]:
+        """
+        Translates sentences and returns the best translation of each; blocks until done
+        """
+        return [hyps[0][1] for hyps in self.submit(sources).result()]
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]  # wait for the first request of the next batch
+            tokens = sum(len(seq) for seq in batch[0][1])
+            deadline = time.time() + self.max_wait
+            while tokens < self.max_tokens:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                tokens += sum(len(seq) for seq in batch[-1][1])
+            batch = [(sources, seqs, future) for sources, seqs, future in batch
+                     if future.set_running_or_notify_cancel()]
+            try:
+                results = self._translate([src for sources, _, _ in batch for src in sources],
+                                          [seq for _, seqs, _ in batch for seq in seqs])
+            except Exception as e:
+                log.exception(f"Failed to decode a batch of {len(batch)} requests")
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            pos = 0
+            for sources, _, future in batch:
+                future.set_result(results[pos: pos + len(sources)])
+                pos += len(sources)
+
+    def _translate(self, sources: List[str], seqs: List[List[int]]):
+        if self.cache is not None:
+            results = [self.cache.get(src) for src in sources]
+        else:
+            results = [None] * len(sources)
+        misses = {src: seq for src, seq, res in zip(sources, seqs, results) if res is None}
+        if misses:
+            decoded = dict(zip(misses, self._decode(list(misses.values()))))
+            if self.cache is not None:
+                for src, res in decoded.items():
+                    self.cache.put(src, res)
+            results = [decoded[src] if res is None else res for src, res in zip(sources, results)]
+        return results
+
+    def _decode(self, seqs: List[List[int]]):
+        # sort by length so that the chunks have less padding; restore the order in the end
+        order = sorted(range(len(seqs)), key=lambda i: len(seqs[i]), reverse=True)
+        results = [None] * len(seqs)
+        start = 0
+        while start < len(order):
+            # longest first, so the padded size of chunk is its first seq's length x its count
+            max_count = max(1, self.max_tokens // len(seqs[order[start]]))
+            chunk = order[start: start + max_count]
+            start += len(chunk)
+            x_lens = tensor([len(seqs[i]) for i in chunk], dtype=torch.long)
+            x_seqs = torch.full((len(chunk), len(seqs[chunk[0]])), fill_value=self.decoder.pad_val,
+                                dtype=torch.long, device=x_lens.device)
+            for row, i in enumerate(chunk):
+                x_seqs[row, :len(seqs[i])] = tensor(seqs[i], dtype=torch.long)
+            log.debug(f"Decoding a batch of {x_seqs.shape}")
+            # grad mode is thread local, so disable it here too
+            with torch.no_grad():
+                hyps = self.decoder.beam_decode(x_seqs, x_lens, **self.dec_args)
+            for i, sent_hyps in zip(chunk, hyps):
+                results[i] = [(score, self.decoder.out_vocab.decode_ids(out, trunc_eos=True))
+                              for score, out in sent_hyps]
+        return results
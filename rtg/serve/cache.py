@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#
+# Created: 10/17/26
+
+"""
+Cache of translations for serving repetitive traffic
+"""
+import collections
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+
+import torch
+from torch import nn
+
+from rtg import log
+
+
+def model_fingerprint(model: nn.Module) -> str:
+    """
+    :param model: model
+    :return: a digest of the model's state; changes when any of the parameters changes
+    """
+    digest = hashlib.sha1()
+    for name, val in model.state_dict().items():
+        digest.update(name.encode())
+        for v in (val if isinstance(val, (list, tuple)) else [val]):  # quantized have tuples
+            if isinstance(v, torch.Tensor):
+                v = v.int_repr() if v.is_quantized else v
+                digest.update(v.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy())
+            else:
+                digest.update(repr(v).encode())
+    return digest.hexdigest()
+
+
+class TranslationCache:
+    """
+    LRU cache of translations with optional expiry (TTL) and persistence to a SQLite file.
+    Entries are keyed on source within a namespace, which is made of the model fingerprint and
+    decoder args, so that the entries of another model or args are never returned.
+    Writes to the SQLite file are committed in batches, every `commit_every` writes or
+    `commit_interval` seconds, whichever is earlier; call flush() or close() to commit the rest.
+    """
+
+    def __init__(self, fingerprint: str, dec_args: Dict[str, Any], max_size: int = 10_000,
+                 ttl: float = 0, path: Optional[Union[str, Path]] = None,
+                 commit_every: int = 100, commit_interval: float = 5):
+        """
+        :param fingerprint: model fingerprint; see model_fingerprint()
+        :param dec_args: decoder args that affect the translations e.g. beam_size, lp_alpha, max_len
+        :param max_size: maximum number of entries in memory
+        :param ttl: seconds after which entries expire; 0 for no expiry
+        :param path: optional path to SQLite file to persist the entries across restarts
+        :param commit_every: commit to SQLite after these many writes
+        :param commit_interval: commit to SQLite when these many seconds passed since the last one
+        """
+        assert max_size > 0
+        assert ttl >= 0
+        assert commit_every > 0 and commit_interval >= 0
+        key = json.dumps([fingerprint, dec_args], sort_keys=True, default=str)
+        self.namespace = hashlib.sha1(key.encode()).hexdigest()
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()  # source -> (time, value) ; recent last
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = None
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self._pending = 0  # writes since the last commit
+        self._committed_at = time.time()
+        if path:
+            self.db = sqlite3.connect(str(path), check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS cache (namespace TEXT, source TEXT,'
+                            ' value TEXT, time REAL, PRIMARY KEY (namespace, source))')
+            self._load()
+
+    def _expired(self, created: float, now: float) -> bool:
+        return self.ttl > 0 and now - created > self.ttl
+
+    def _load(self):
+        if self.ttl > 0:
+            self.db.execute('DELETE FROM cache WHERE time < ?', (time.time() - self.ttl,))
+            self.db.commit()
+        rows = self.db.execute('SELECT source, value, time FROM cache WHERE namespace = ?'
+                               ' ORDER BY time DESC LIMIT ?', (self.namespace, self.max_size))
+        for source, value, created in reversed(rows.fetchall()):
+            self.entries[source] = (created, json.loads(value))
+        log.info(f"Loaded {len(self.entries):,} cached translations from the database")
+
+    def get(self, source: str) -> Optional[Any]:
+        """
+        :param source: source sentence
+        :return: cached translation or None if missing or expired
+        """
+        with self.lock:
+            entry = self.entries.get(source)
+            if entry is not None and self._expired(entry[0], time.time()):
+                self._evict(source)
+                self._maybe_commit()
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(source)
+            return entry[1]
+
+    def put(self, source: str, value: Any):
+        """
+        :param source: source sentence
+        :param value: translation; must be JSON serializable if the cache is persisted
+        """
+        with self.lock:
+            now = time.time()
+            self.entries[source] = (now, value)
+            self.entries.move_to_end(source)
+            if self.db:
+                self.db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                                (self.namespace, source, json.dumps(value), now))
+                self._pending += 1
+            while len(self.entries) > self.max_size:
+                self._evict(next(iter(self.entries)))  # least recently used
+            self._maybe_commit()
+
+    def _evict(self, source: str):
+        del self.entries[source]
+        if self.db:
+            self.db.execute('DELETE FROM cache WHERE namespace = ? AND source = ?',
+                            (self.namespace, source))
+            self._pending += 1
+
+    def _maybe_commit(self):
+        if self._pending and (self._pending >= self.commit_every
+                              or time.time() - self._committed_at >= self.commit_interval):
+            self._commit()
+
+    def _commit(self):
+        if self.db:
+            self.db.commit()
+        self._pending = 0
+        self._committed_at = time.time()
+
+    def flush(self):
+        """
+        Commits the pending writes to the SQLite file, if any
+        """
+        with self.lock:
+            if self._pending:
+                self._commit()
+
+    def close(self):
+        """
+        Commits the pending writes and closes the SQLite file
+        """
+        with self.lock:
+            if self.db:
+                self._commit()
+                self.db.close()
+                self.db = None
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return dict(size=len(self.entries), max_size=self.max_size, ttl=self.ttl,
+                    hits=self.hits, misses=self.misses,
+                    hit_rate=self.hits / total if total else 0.)
+
+    def __len__(self):
+        return len(self.entries)
@@ -239,6 +239,22 @@ def max_RSS(who=resource.RUSAGE_SELF) -> Tuple[int, str]:
     return mem, f'{int(h_mem)}{unit}'
 
 
+def cpu_copy(obj):
+    """
+    Copies tensors in a (nested) state dict to CPU memory, so that they are not changed by the
+    training that continues on the originals
+    :param obj: tensor, or dict/list/tuple of them (and other objects, which are not copied)
+    :return: same structure, with copies of tensors
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, cpu_copy(val)) for key, val in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_copy(val) for val in obj)
+    return obj
+
+
 def maybe_compress(arr, frugal=False):
     # python list wastes a lot of memory: references to each item, and int is 28 bytes
     if isinstance(arr[0], int):
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+#
+# Created: 10/17/26
+import shutil
+from functools import partial
+
+import numpy as np
+import pytest
+import torch
+
+from rtg import TranslationExperiment as Experiment
+from rtg.data.codec import NLField
+from rtg.data.dataset import (SqliteFile, MemmapFile, BatchIterable, LoopingIterable,
+                              PrefetchIterable, Batch, IdExample, InMemoryData,
+                              SubwordRegBatchIterable, TokenizerTask, TSVData,
+                              MultiCorpusBatchIterable,
+                              plan_eq_len_batches)
+
+
+def test_memmap_file(tmp_path):
+    exp = Experiment('experiments/sample-exp', read_only=True)
+    db = SqliteFile(exp.train_db, sort_by=None)
+    recs = [(ex.x, ex.y) for ex in db]
+    for vocab_size, dtype in [(len(exp.tgt_vocab), np.uint16), (-1, np.int32)]:
+        path = tmp_path / f'train.{dtype.__name__}.mmap'
+        MemmapFile.write(path, records=iter(recs), vocab_size=vocab_size)
+        data = MemmapFile(path, sort_by=None)
+        assert data.dtype == dtype
+        assert len(data) == len(recs)
+        for (x, y), ex in zip(recs, data):
+            assert ex.x.dtype == np.int32
+            assert np.array_equal(x, ex.x) and np.array_equal(y, ex.y)
+        ids = [3, 0, 7]
+        for id, ex in zip(ids, data.get_all_ids(ids)):
+            assert ex.id == id and np.array_equal(ex.x, recs[id][0])
+        rows = list(data.get_all(cols=['id', 'y_len'], sort='y_len desc, random() desc'))
+        assert len(rows) == len(recs)
+        assert [r['y_len'] for r in rows] == sorted([len(y) for x, y in recs], reverse=True)
+
+    batches = BatchIterable(path, batch_size=400, field=exp.tgt_vocab, sort_by='eq_len_rand_batch')
+    assert batches.num_batches > 1
+    n_seqs = 0
+    for batch in batches:
+        # budget is of stored lengths; Batch appends EOS
+        assert len(batch) * (batch.y_seqs.shape[1] - 1) <= 400
+        n_seqs += len(batch)
+    assert n_seqs == len(recs)
+
+
+def test_prefetch_iterable():
+    exp = Experiment('experiments/sample-exp', read_only=True)
+    data = BatchIterable(exp.train_db, batch_size=400, field=exp.tgt_vocab, sort_by=None)
+    expected = [batch.y_seqs for batch in data]
+    pairs = list(PrefetchIterable(zip(data, data), size=2, device='cpu'))
+    assert len(pairs) == len(expected)
+    for (batch1, batch2), y_seqs in zip(pairs, expected):
+        assert torch.equal(batch1.y_seqs, y_seqs) and torch.equal(batch2.y_seqs, y_seqs)
+
+    def failing():
+        yield from data
+        raise ValueError('bad data')
+    with pytest.raises(ValueError):
+        list(PrefetchIterable(failing(), size=1))
+
+    # consumer stops early, the producer must not block forever
+    for i, batch in enumerate(PrefetchIterable(LoopingIterable(data, 100), size=1)):
+        if i == 2:
+            break
+
+
+def test_batch_padding():
+    exp = Experiment('experiments/sample-exp', read_only=True)
+    field = exp.tgt_vocab
+    bos, eos, pad = field.bos_idx, field.eos_idx, field.pad_idx
+    seqs = [[5, 6, 7], [bos, 8, eos], [9], [bos, 10, 11, 12]]
+    examples = [IdExample(x=np.array(seq, dtype=np.int32), y=np.array(seq, dtype=np.int32), id=i)
+                for i, seq in enumerate(seqs)]
+    batch = Batch([examples[0], examples[2]], add_bos_x=False, add_eos_x=True, field=field)
+    assert batch.x_seqs.tolist() == [[5, 6, 7, eos], [9, eos, pad, pad]]
+    assert batch.x_len.tolist() == [4, 2]
+
+    batch = Batch(examples, add_bos_x=True, add_bos_y=True, add_eos_y=True, field=field)
+    assert batch.y_seqs.tolist() == [[bos, 5, 6, 7, eos], [bos, 8, eos, pad, pad],
+                                     [bos, 9, eos, pad, pad], [bos, 10, 11, 12, eos]]
+    assert batch.y_len.tolist() == [5, 3, 3, 5]
+    assert batch.y_toks == 16
+    with pytest.raises(AssertionError):  # should not have BOS, but has
+        Batch(examples, add_bos_x=False, field=field)
+
+
+def test_in_memory_data(tmp_path):
+    exp = Experiment('experiments/sample-exp', read_only=True)
+    db = SqliteFile(exp.train_db, sort_by=None)
+    recs = list(db)
+    data = InMemoryData(iter(recs))
+    data.x_raw = [f'src{i}' for i in range(len(recs))]
+    data.y_raw = [f'tgt{i}' for i in range(len(recs))]
+    path = tmp_path / 'train.memdb.npz'
+    data.save(path)
+    for data in [data, InMemoryData.load(path)]:
+        assert len(data) == len(recs)
+        for i, (rec, ex) in enumerate(zip(recs, data)):
+            assert ex.id == rec.id and ex.x_raw == f'src{i}' and ex.y_raw == f'tgt{i}'
+            assert np.array_equal(rec.x, ex.x) and np.array_equal(rec.y, ex.y)
+        ids = [recs[5].id, recs[1].id]
+        assert [ex.id for ex in data.get_all_ids(ids)] == ids
+        max_id = max(rec.id for rec in recs)
+        for unknown in ([max_id + 1], [-1], [recs[0].id, max_id + 10]):
+            with pytest.raises(KeyError):
+                data.get_all_ids(unknown)
+        rows = list(data.get_all(cols=['id', 'x_len'], sort='x_len asc, random() desc'))
+        assert [r['x_len'] for r in rows] == sorted(len(r.x) for r in recs)
+
+    mono = InMemoryData(IdExample(x=rec.x, y=None, id=rec.id) for rec in recs[:10])
+    assert all(ex.y is None for ex in mono)
+
+
+def test_plan_eq_len_batches():
+    rng = np.random.default_rng(1)
+    n = 1000
+    ids = np.arange(n) + 100
+    x_lens, y_lens = rng.integers(1, 50, size=n), rng.integers(1, 50, size=n)
+    y_lens[:5] = 0  # empty; skipped
+    plan = plan_eq_len_batches(ids, x_lens, y_lens, max_toks=200, max_sents=16,
+                               rng=np.random.default_rng(2))
+    lens = dict(zip(ids, np.maximum(x_lens, y_lens)))
+    assert sorted(np.concatenate(plan).tolist()) == ids[5:].tolist()
+    for batch in plan:
+        assert len(batch) <= 16
+        assert len(batch) * max(lens[id] for id in batch) <= 200
+    # greedy across lengths: a batch is full unless the next (shorter) sequence doesnt fit
+    full = [len(batch) == min(16, 200 // max(lens[id] for id in batch)) for batch in plan]
+    assert sum(full) >= len(plan) - 1
+
+    same = plan_eq_len_batches(ids, x_lens, y_lens, 200, 16, rng=np.random.default_rng(2))
+    assert all(np.array_equal(a, b) for a, b in zip(plan, same))
+
+    jittered = plan_eq_len_batches(ids, x_lens, y_lens, 200, 16, rng=np.random.default_rng(2),
+                                   jitter=4)
+    assert sorted(np.concatenate(jittered).tolist()) == ids[5:].tolist()
+    for batch in jittered:
+        assert len(batch) <= 16
+        assert len(batch) * max(lens[id] for id in batch) <= 200
+    assert {tuple(b) for b in jittered} != {tuple(b) for b in plan}
+
+    exp = Experiment('experiments/sample-exp', read_only=True)
+    data = BatchIterable(exp.train_db, batch_size=400, field=exp.tgt_vocab,
+                         sort_by='eq_len_rand_batch', seed=3)
+    assert data._plan(0) is data._plan(0)  # cached
+    epoch1 = [batch.y_seqs for batch in data]
+    assert len(epoch1) == data.num_batches and data.epoch == 1
+    assert (400, 400, 3, 1) in data._plans  # next epoch is planned ahead
+    epoch2 = [batch.y_seqs for batch in data]
+    assert len(epoch1) == len(epoch2)
+    assert any(not torch.equal(a, b) for a, b in zip(epoch1, epoch2))
+
+
+def test_eq_len_batches_keep_in_mem(tmp_path):
+    # the plan is made from the lengths of in-memory data, after the length filter
+    exp = Experiment('experiments/sample-exp', read_only=True)
+    db = tmp_path / 'train.db'
+    shutil.copy(exp.train_db, db)
+    data = BatchIterable(db, batch_size=400, field=exp.tgt_vocab, sort_by='eq_len_rand_batch',
+                         keep_in_mem=True, max_src_len=20, max_tgt_len=20, seed=3)
+    assert isinstance(data.data, InMemoryData)
+    ids, x_lens, y_lens = data._lengths
+    assert len(ids) == len(data.data) and x_lens.max() <= 20 and y_lens.max() <= 20
+    batches = list(data)
+    assert len(batches) == data.num_batches
+    assert sum(len(batch) for batch in batches) == len(data.data)
+
+
+def test_sharded_eq_len_batches():
+    rng = np.random.default_rng(1)
+    n, world_size = 1000, 3
+    ids = np.arange(n)
+    x_lens, y_lens = rng.integers(1, 50, size=n), rng.integers(1, 50, size=n)
+    lens = np.maximum(x_lens, y_lens)
+    full = plan_eq_len_batches(ids, x_lens, y_lens, 200, 16, rng=np.random.default_rng(2))
+    shards = [plan_eq_len_batches(ids, x_lens, y_lens, 200, 16, rng=np.random.default_rng(2),
+                                  rank=rank, world_size=world_size) for rank in range(world_size)]
+    assert all(len(shard) == len(full) // world_size for shard in shards)
+    shard_ids = [np.concatenate(shard) for shard in shards]
+    all_ids = np.concatenate(shard_ids)
+    assert len(np.unique(all_ids)) == len(all_ids)  # disjoint
+    # at each step, all ranks have batches of similar padded sizes
+    for step in zip(*shards):
+        sizes = [len(batch) * lens[batch].max() for batch in step]
+        assert max(sizes) - min(sizes) <= 50
+
+    exp = Experiment('experiments/sample-exp', read_only=True)
+    datas = [BatchIterable(exp.train_db, batch_size=400, field=exp.tgt_vocab, seed=3,
+                           sort_by='eq_len_rand_batch', rank=rank, world_size=2)
+             for rank in range(2)]
+    assert datas[0].num_batches == datas[1].num_batches > 0
+    planned = [set(np.concatenate(data._plan(0)).tolist()) for data in datas]
+    assert not planned[0] & planned[1]
+    assert all(len(list(data)) == data.num_batches for data in datas)
+
+
+def test_resume_data_state():
+    exp = Experiment('experiments/sample-exp', read_only=True)
+    args = dict(batch_size=400, field=exp.tgt_vocab, sort_by='eq_len_rand_batch')
+    data = LoopingIterable(BatchIterable(exp.train_db, seed=5, **args), 10_000)
+    itr = PrefetchIterable(data, size=3)
+    n = data.itr.num_batches
+    expected, state = [], None
+    for i, batch in enumerate(itr):
+        if i == n + 3:  # second epoch, fourth batch
+            state = itr.state_dict()
+        elif state:
+            expected.append(batch.y_seqs)
+        if len(expected) == 5:
+            break
+    assert state == dict(epoch=1, position=4, seed=5, batch_size=[400, 400])
+
+    # no seed: state has it; the skipped batches are not read
+    resumed = BatchIterable(exp.train_db, **args)
+    resumed.load_state_dict(state)
+    reads = []
+    get_all_ids = resumed.data.get_all_ids
+    resumed.data.get_all_ids = lambda ids: reads.append(ids) or get_all_ids(ids)
+    for exp_seqs, batch in zip(expected, resumed):
+        assert torch.equal(exp_seqs, batch.y_seqs)
+    assert len(reads) == len(expected)
+
+
+def test_subword_reg_batches(tmp_path):
+    pytest.importorskip('nlcodec')
+    src = 'experiments/sample-data/sampl.test.fr.tok'
+    tgt = 'experiments/sample-data/sampl.test.en.tok'
+    field = NLField.train('bpe', vocab_size=500, model_path=str(tmp_path / 'bpe.model'),
+                          files=[src, tgt])
+    task = TokenizerTask([partial(field.encode_as_ids, split_ratio=0.5)] * 2, lengths=[128, 128],
+                         truncate=True)
+    data = SubwordRegBatchIterable(src, tgt, task=task, batch_size=400, field=field, workers=2,
+                                   chunk_size=100)
+    n_lines = len(list(TSVData.read_raw_parallel_lines(src, tgt)))
+    epochs, count = [[], []], 0
+    for batch in LoopingIterable(data, 10_000):
+        assert len(batch) * batch.y_seqs.shape[1] <= 400 + len(batch)  # + EOS
+        if data.epoch >= 2:
+            break
+        epochs[data.epoch].append(batch.y_seqs)
+    assert [sum(len(b) for b in epoch) for epoch in epochs] == [n_lines, n_lines]
+    tokens = [sum((b != field.pad_idx).sum().item() for b in epoch) for epoch in epochs]
+    assert tokens[0] != tokens[1]  # split differently
+    greedy = sum(len(field.encode_as_ids(y)) + 1 for x, y in TSVData.read_raw_parallel_lines(src, tgt))
+    assert min(tokens) > greedy
+
+    # as in training: the worker pool is created in the background thread of prefetching
+    prefetched = iter(PrefetchIterable(LoopingIterable(data, 4), size=2))
+    assert all(len(batch) > 0 for batch in prefetched)
+
+
+def test_tokenize_parallel(tmp_path):
+    exp = Experiment('experiments/sample-exp', read_only=True)
+    prep = exp.config['prep']
+    args = dict(src_path=prep['train_src'], tgt_path=prep['train_tgt'], truncate=False,
+                src_len=30, tgt_len=30, src_tokenizer=exp.src_vocab.encode_as_ids,
+                tgt_tokenizer=exp.tgt_vocab.encode_as_ids)
+    serial = list(TSVData.read_raw_parallel_recs(**args))
+    assert 0 < len(serial) < len(list(TSVData.read_raw_parallel_lines(args['src_path'],
+                                                                      args['tgt_path'])))
+    # order is preserved; long records are filtered in workers
+    recs = list(TSVData.read_raw_parallel_recs(**args, workers=3))
+    assert [(list(x), list(y)) for x, y in recs] == [(list(x), list(y)) for x, y in serial]
+
+    db = tmp_path / 'train.db'
+    SqliteFile.write(db, records=iter(recs), insert_size=7)
+    stored = sorted(SqliteFile(db, sort_by=None), key=lambda ex: ex.id)
+    assert [list(ex.x) for ex in stored] == [list(x) for x, y in recs]
+
+
+def test_multi_corpus_batches():
+    exp = Experiment('experiments/sample-exp', read_only=True)
+    args = dict(batch_size=400, field=exp.tgt_vocab, sort_by='eq_len_rand_batch')
+
+    def corpora():
+        return {name: BatchIterable(exp.train_db, seed=i, **args) for i, name in enumerate('ab')}
+
+    data = MultiCorpusBatchIterable(corpora(), weights=dict(a=1, b=3), seed=1)
+    assert np.allclose(data.probs, [0.25, 0.75])
+    batches = list(LoopingIterable(data, 400))
+    assert len(batches) == 400 and data.draws == 400
+    names = [batch.corpus for batch in batches]
+    assert 60 < names.count('a') < 140  # 100 expected
+    # draws more than an epoch of b; corpora repeat
+    assert names.count('b') > data.corpora['b'].num_batches
+
+    flat = MultiCorpusBatchIterable(corpora(), weights=dict(a=1, b=3), temperature=1000)
+    assert np.allclose(flat.probs, [0.5, 0.5], atol=0.01)
+    same = MultiCorpusBatchIterable(corpora())  # by size
+    assert np.allclose(same.probs, [0.5, 0.5])
+
+    # resume
+    data = MultiCorpusBatchIterable(corpora(), weights=dict(a=1, b=3), seed=1)
+    itr = iter(data)
+    for _ in range(50):
+        next(itr)
+    state = data.state_dict()
+    expected = [(batch.corpus, batch.y_seqs) for batch, _ in zip(itr, range(20))]
+    resumed = MultiCorpusBatchIterable(corpora(), weights=dict(a=1, b=3))
+    resumed.load_state_dict(state)
+    for (name, y_seqs), batch in zip(expected, resumed):
+        assert name == batch.corpus and torch.equal(y_seqs, batch.y_seqs)
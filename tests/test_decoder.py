@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+#
+# Created: 10/17/26
+import io
+
+import torch
+
+from rtg import TranslationExperiment as Experiment
+from rtg.data.dataset import SqliteFile
+from rtg.data.shortlist import Shortlist
+from rtg.module.decoder import Decoder
+from rtg.registry import factories
+
+
+def make_decoder(gen_args=None, seed=1):
+    exp = Experiment('experiments/sample-exp', read_only=True)
+    torch.manual_seed(seed)
+    model = factories[exp.model_type](exp=exp, **exp.model_args)[0]
+    return Decoder.new(exp, model=model, gen_args=gen_args)
+
+
+def get_batch(decoder, n=6):
+    with open('experiments/sample-data/sampl.valid.fr.tok') as lines:
+        lines = [line.strip() for line in lines][:n]
+    seqs = [decoder.inp_vocab.encode_as_ids(line, add_eos=True, add_bos=False) for line in lines]
+    x_seqs = torch.full((len(seqs), max(len(s) for s in seqs)), fill_value=decoder.pad_val,
+                        dtype=torch.long)
+    for i, seq in enumerate(seqs):
+        x_seqs[i, :len(seq)] = torch.tensor(seq)
+    x_lens = torch.tensor([len(s) for s in seqs])
+    return x_seqs, x_lens
+
+
+def test_incremental_decode():
+    full = make_decoder(gen_args=dict(incremental=False))
+    incr = make_decoder(gen_args=dict(incremental=True))
+    x_seqs, x_lens = get_batch(full)
+    with torch.no_grad():
+        # greedy path: step by step log probs should match
+        full_gen, incr_gen = full.generator(x_seqs, x_lens), incr.generator(x_seqs, x_lens)
+        ys = torch.full((len(x_seqs), 1), fill_value=full.bos_val, dtype=torch.long)
+        for t in range(8):
+            full_lp, incr_lp = full_gen.generate_next(ys), incr_gen.generate_next(ys)
+            assert torch.allclose(full_lp, incr_lp, atol=1e-4)
+            ys = torch.cat([ys, full_lp.argmax(dim=-1, keepdim=True)], dim=1)
+
+        # beam path: cache must follow beams as they get regathered
+        args = dict(max_len=10, beam_size=4, num_hyp=2)
+        full_res = full.beam_decode(x_seqs, x_lens.clone(), **args)
+        incr_res = incr.beam_decode(x_seqs, x_lens.clone(), **args)
+    for full_hyps, incr_hyps in zip(full_res, incr_res):
+        for (full_score, full_hyp), (incr_score, incr_hyp) in zip(full_hyps, incr_hyps):
+            assert full_hyp == incr_hyp
+            assert abs(full_score - incr_score) < 1e-3
+
+
+def test_shrinking_beam_decode():
+    full = make_decoder()
+    x_seqs, x_lens = get_batch(full, n=12)
+    with torch.no_grad():
+        # random model rarely ends; favor EOS so that sentences end at different time steps
+        full.model.generator.proj.bias[full.eos_val] += 4
+        args = dict(max_len=12, beam_size=4, num_hyp=2, lp_alpha=0.6)
+        full_res = full.beam_decode(x_seqs, x_lens.clone(), shrink=False, **args)
+        shrunk_res = full.beam_decode(x_seqs, x_lens.clone(), shrink=True, **args)
+    assert len(full_res) == len(shrunk_res) == len(x_seqs)
+    lens = set()
+    for full_hyps, shrunk_hyps in zip(full_res, shrunk_res):
+        for (full_score, full_hyp), (shrunk_score, shrunk_hyp) in zip(full_hyps, shrunk_hyps):
+            # finished sentences are dropped early; they miss the padding after EOS
+            full_hyp = full_hyp[:full_hyp.index(full.eos_val) + 1] \
+                if full.eos_val in full_hyp else full_hyp
+            assert full_hyp == shrunk_hyp[:len(full_hyp)]
+            assert abs(full_score - shrunk_score) < 1e-3
+            lens.add(len(full_hyp))
+    assert len(lens) > 1
+
+
+def test_continuous_beam_decode():
+    decoder = make_decoder()
+    x_seqs, x_lens = get_batch(decoder, n=20)
+    seqs = [seq[:n].tolist() for seq, n in zip(x_seqs, x_lens)]
+    args = dict(max_len=10, beam_size=4, num_hyp=2, lp_alpha=0.6)
+    with torch.no_grad():
+        decoder.model.generator.proj.bias[decoder.eos_val] += 3
+        # small batch_size: sentences keep joining and leaving the batch
+        res = list(decoder.continuous_beam_decode(enumerate(seqs), batch_size=100, **args))
+        assert sorted(idx for idx, _ in res) == list(range(len(seqs)))
+        assert [idx for idx, _ in res] != list(range(len(seqs)))  # some ended sooner
+        for idx, hyps in res:
+            x_seq = torch.tensor([seqs[idx]])
+            ref_hyps = decoder.beam_decode(x_seq, torch.tensor([len(seqs[idx])]), **args)[0]
+            for (ref_score, ref_hyp), (score, hyp) in zip(ref_hyps, hyps):
+                ref_hyp = ref_hyp[:ref_hyp.index(decoder.eos_val) + 1] \
+                    if decoder.eos_val in ref_hyp else ref_hyp
+                assert ref_hyp == hyp[:len(ref_hyp)]
+                assert abs(ref_score - score) < 1e-3
+
+
+def test_decode_file_sort_window():
+    decoder = make_decoder()
+    with open('experiments/sample-data/sampl.valid.fr.tok') as lines:
+        # ID \t SRC ; ids are copied to output
+        lines = [f'id{i}\t{line.strip()}' for i, line in enumerate(lines)][:30]
+    args = dict(batch_size=200, max_len=6, beam_size=2)
+
+    consumed = []
+
+    def reader():
+        for line in lines:
+            consumed.append(line)
+            yield line
+
+    class Writer(io.StringIO):
+        first_write = None
+
+        def write(self, text):
+            if self.first_write is None:
+                self.first_write = len(consumed)
+            return super().write(text)
+
+    with torch.no_grad():
+        for continuous in (False, True):
+            consumed.clear()
+            out = Writer()
+            decoder.decode_file(reader(), out, sort_window=8, continuous=continuous, **args)
+            assert out.first_write <= 16  # did not wait for the whole input
+            out_ids = [line.split('\t')[0] for line in out.getvalue().splitlines()]
+            assert out_ids == [line.split('\t')[0] for line in lines]
+
+
+def test_decode_file_workers():
+    decoder = make_decoder()
+    with open('experiments/sample-data/sampl.valid.fr.tok') as lines:
+        lines = [line.strip() for line in lines][:20]
+    args = dict(batch_size=200, max_len=6, beam_size=2)
+    outs = []
+    with torch.no_grad():
+        for workers in (1, 2):
+            out = io.StringIO()
+            decoder.decode_file(iter(lines), out, workers=workers, **args)
+            outs.append(out.getvalue())
+    assert outs[0] == outs[1]
+
+
+def test_quantized_decode():
+    decoder = make_decoder()
+    int8 = Decoder.new(decoder.exp, model=decoder.model, quantize=True)
+    assert int8.model is not decoder.model  # fp32 model is left as it is
+    assert not any(isinstance(m, torch.nn.Linear) for m in int8.model.modules())
+    assert int8.model.generator.proj.weight().dtype == torch.qint8
+    x_seqs, x_lens = get_batch(decoder)
+    with torch.no_grad():
+        res = int8.beam_decode(x_seqs, x_lens, max_len=6, beam_size=2)
+        assert len(res) == len(x_seqs)
+
+        # quantized state can be restored
+        exp = decoder.exp
+        chkpt = dict(model_state=int8.model.state_dict(), model_type=exp.model_type,
+                     model_args=exp.model_args)
+        model = exp.load_model_with_state(chkpt).eval()
+        assert model.generator.proj.weight().dtype == torch.qint8
+        restored = Decoder.new(exp, model=model)
+        assert restored.beam_decode(x_seqs, x_lens, max_len=6, beam_size=2) == res
+
+
+def test_shortlist_decode():
+    decoder = make_decoder()
+    exp = decoder.exp
+    data = SqliteFile(exp.train_db, sort_by=None)
+    shortlist = Shortlist.build(data, src_vocab=len(exp.src_vocab), tgt_vocab=len(exp.tgt_vocab),
+                                top_k=20, frequent=50, always=exp.tgt_vocab.reserved_idxs)
+    chunked = Shortlist.build(data, src_vocab=len(exp.src_vocab), tgt_vocab=len(exp.tgt_vocab),
+                              top_k=20, frequent=50, always=exp.tgt_vocab.reserved_idxs,
+                              chunk_size=7)
+    assert torch.equal(chunked.candidates, shortlist.candidates)
+    x_seqs, x_lens = get_batch(decoder)
+    subset = shortlist.vocab_subset(x_seqs)
+    assert len(subset) < len(exp.tgt_vocab)
+    assert set(exp.tgt_vocab.reserved_idxs) <= set(subset.tolist())
+
+    listed = Decoder.new(exp, model=decoder.model, gen_args=dict(shortlist=shortlist))
+    with torch.no_grad():
+        # log probs over the subset match those of full vocabulary, upto normalization
+        full_gen, sl_gen = decoder.generator(x_seqs, x_lens), listed.generator(x_seqs, x_lens)
+        ys = torch.full((len(x_seqs), 1), fill_value=decoder.bos_val, dtype=torch.long)
+        full_lp, sl_lp = full_gen.generate_next(ys), sl_gen.generate_next(ys)
+        assert torch.allclose(full_lp[:, subset].log_softmax(dim=-1), sl_lp, atol=1e-4)
+
+        # generators that transform hidden states before the projection, e.g. robertamt
+        from rtg.module.ext.robertamt import RobertaGenerator
+        model = make_decoder().model
+        generator = RobertaGenerator(model.generator.d_model, model.generator.vocab)
+        generator.proj.load_state_dict(model.generator.proj.state_dict())
+        generator.activation = torch.nn.functional.gelu  # as set by RoBERTaMT
+        model.generator = generator.eval()
+        full_gen = Decoder.new(exp, model=model).generator(x_seqs, x_lens)
+        sl_gen = Decoder.new(exp, model=model, gen_args=dict(shortlist=shortlist)).generator(
+            x_seqs, x_lens)
+        full_lp, sl_lp = full_gen.generate_next(ys), sl_gen.generate_next(ys)
+        assert torch.allclose(full_lp[:, subset].log_softmax(dim=-1), sl_lp, atol=1e-4)
+
+        for beam_size in (1, 2):
+            res = listed.beam_decode(x_seqs, x_lens, max_len=6, beam_size=beam_size)
+            for hyps in res:
+                for score, hyp in hyps:
+                    assert set(hyp) <= set(subset.tolist())
+        seqs = ((i, x_seqs[i, :x_lens[i]]) for i in range(len(x_seqs)))
+        for i, hyps in listed.continuous_beam_decode(seqs, batch_size=20, max_len=6, beam_size=2):
+            assert set(hyps[0][1]) <= set(shortlist.vocab_subset(x_seqs[i]).tolist())
+
+
+def test_micro_batcher():
+    from rtg.serve.batcher import MicroBatcher
+    decoder = make_decoder()
+    with open('experiments/sample-data/sampl.valid.fr.tok') as lines:
+        lines = [line.strip() for line in lines][:12]
+    args = dict(max_len=6, beam_size=2)
+    x_seqs, x_lens = get_batch(decoder, n=len(lines))
+    with torch.no_grad():
+        expected = [decoder.out_vocab.decode_ids(hyps[0][1], trunc_eos=True)
+                    for hyps in decoder.beam_decode(x_seqs, x_lens, **args)]
+    # requests arriving within the wait are decoded as one batch
+    batcher = MicroBatcher(decoder, max_wait=1000, max_tokens=10_000, **args)
+    futures = [batcher.submit(lines[i:i + 3]) for i in range(0, len(lines), 3)]
+    translations = [hyps[0][1] for future in futures for hyps in future.result()]
+    assert translations == expected
+
+    # the budget is in pieces as decoded: a request of these many pieces fills a batch
+    pieces = int(x_lens[:3].sum())
+    batcher = MicroBatcher(decoder, max_wait=1000, max_tokens=pieces, **args)
+    sizes = []
+    translate = batcher._translate
+    batcher._translate = lambda sources, seqs: sizes.append(len(seqs)) or translate(sources, seqs)
+    futures = [batcher.submit(lines[:3]) for _ in range(3)]
+    assert all(future.result() for future in futures)
+    assert sizes == [3, 3, 3]
+
+    # sources are truncated to max_src_len pieces
+    with torch.no_grad():
+        expected = [decoder.out_vocab.decode_ids(hyps[0][1], trunc_eos=True)
+                    for hyps in decoder.beam_decode(x_seqs[:, :4], x_lens.clamp(max=4), **args)]
+    batcher = MicroBatcher(decoder, max_src_len=4, **args)
+    assert batcher.translate(lines) == expected
+
+
+def test_translation_cache(tmp_path):
+    from rtg.serve.batcher import MicroBatcher
+    from rtg.serve.cache import TranslationCache, model_fingerprint
+    decoder = make_decoder()
+    with open('experiments/sample-data/sampl.valid.fr.tok') as lines:
+        lines = [line.strip() for line in lines][:4]
+    args = dict(max_len=6, beam_size=2)
+    fingerprint = model_fingerprint(decoder.model)
+    assert fingerprint == model_fingerprint(make_decoder().model)
+    assert fingerprint != model_fingerprint(make_decoder(seed=2).model)
+
+    db = tmp_path / 'cache.db'
+    cache = TranslationCache(fingerprint, dec_args=args, max_size=3, path=db)
+    batcher = MicroBatcher(decoder, cache=cache, **args)
+    expected = batcher.translate(lines)
+    assert cache.stats()['misses'] == 4 and len(cache) == 3  # least recent is evicted
+    assert batcher.translate(lines[1:] + lines[1:2]) == expected[1:] + expected[1:2]
+    assert cache.stats()['hits'] == 4
+
+    # persisted in batches of commits; namespaced by args
+    assert len(TranslationCache(fingerprint, dec_args=args, max_size=3, path=db)) == 0
+    cache.flush()
+    assert len(TranslationCache(fingerprint, dec_args=args, max_size=3, path=db)) == 3
+    assert len(TranslationCache(fingerprint, dec_args=dict(args, beam_size=4), path=db)) == 0
+    cache = TranslationCache(fingerprint, dec_args=args, max_size=3, ttl=1e-6, path=db)
+    assert cache.get(lines[1]) is None  # expired
+
+    db = tmp_path / 'batched.db'
+    cache = TranslationCache(fingerprint, dec_args=args, max_size=3, path=db, commit_every=2)
+    cache.put('a', 'A')
+    assert len(TranslationCache(fingerprint, dec_args=args, path=db)) == 0
+    cache.put('b', 'B')  # commits every 2 writes
+    assert len(TranslationCache(fingerprint, dec_args=args, path=db)) == 2
+    cache.put('c', 'C')
+    cache.close()
+    assert len(TranslationCache(fingerprint, dec_args=args, path=db)) == 3
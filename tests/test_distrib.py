@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+#
+# Created: 10/17/26
+import multiprocessing as mp
+
+import torch
+import torch.distributed as dist
+from torch import nn
+
+from rtg.distrib import DistribTorch
+from rtg.distrib.reducer import GradientReducer
+from rtg.module.criterion import CrossEntropy
+from rtg.module.tfmnmt import ChunkedLossCompute, Generator
+
+WORLD_SIZE = 2
+
+
+def make_model():
+    torch.manual_seed(1)
+    return nn.Sequential(nn.Linear(8, 32), nn.ReLU(), nn.Linear(32, 32), nn.ReLU(),
+                         nn.Linear(32, 4))
+
+
+def make_inputs(rank):
+    torch.manual_seed(100 + rank)
+    return torch.randn(5, 8)
+
+
+def _reduce_worker(rank, init_file, fp16, results):
+    dist.init_process_group('gloo', init_method=f'file://{init_file}', rank=rank,
+                            world_size=WORLD_SIZE)
+    try:
+        model = make_model()
+        # tiny buckets: many buckets, some are launched during backward
+        reducer = GradientReducer(model, bucket_mb=2e-3, fp16=fp16)
+        assert len(reducer.buckets) > 2
+        for step in range(2):
+            x = make_inputs(rank)
+            out = model(x)
+            out.sum().backward()
+            if step == 1:  # grads of a launched bucket change again
+                model(x)[:, 0].sum().backward()
+            reducer.synchronize()
+            results.put((rank, step, [p.grad.clone() for p in model.parameters()]))
+            model.zero_grad()
+    finally:
+        dist.destroy_process_group()
+
+
+def _expected_grads():
+    grads = []
+    for step in range(2):
+        model = make_model()
+        for rank in range(WORLD_SIZE):
+            x = make_inputs(rank)
+            model(x).sum().backward()
+            if step == 1:
+                model(x)[:, 0].sum().backward()
+        grads.append([p.grad / WORLD_SIZE for p in model.parameters()])
+    return grads
+
+
+def test_gradient_reducer(tmp_path):
+    ctx = mp.get_context('fork')
+    expected = _expected_grads()
+    for fp16 in (False, True):
+        results = ctx.Queue()
+        init_file = tmp_path / f'init-{fp16}'
+        procs = [ctx.Process(target=_reduce_worker, args=(rank, init_file, fp16, results))
+                 for rank in range(WORLD_SIZE)]
+        for proc in procs:
+            proc.start()
+        outs = [results.get(timeout=60) for _ in range(2 * WORLD_SIZE)]
+        for proc in procs:
+            proc.join(timeout=60)
+            assert proc.exitcode == 0
+        atol = 1e-2 if fp16 else 1e-5
+        for rank, step, grads in outs:
+            for grad, exp_grad in zip(grads, expected[step]):
+                assert torch.allclose(grad, exp_grad, atol=atol)
+
+
+def _accum_worker(rank, init_file, results):
+    dist.init_process_group('gloo', init_method=f'file://{init_file}', rank=rank,
+                            world_size=WORLD_SIZE)
+    try:
+        model = make_model()
+        reducer = GradientReducer(model, bucket_mb=2e-3)
+        calls = []
+        all_reduce = dist.all_reduce
+        dist.all_reduce = lambda *args, **kwargs: calls.append(1) or all_reduce(*args, **kwargs)
+        # uneven loads: rank 1 has thrice the tokens of rank 0, and a micro-batch more
+        xs = [make_inputs(rank * 10 + i) for i in range(2 + rank)]
+        with reducer.no_sync():
+            for x in xs[:-1]:
+                model(x).sum().backward()
+        assert not calls  # micro-batches dont communicate
+        reducer.set_weight(weight=1 + 2 * rank)
+        model(xs[-1]).sum().backward()
+        reducer.synchronize()
+        dist.all_reduce = all_reduce
+        assert len(calls) == 1 + len(reducer.buckets)  # weights, and one per bucket
+        results.put((rank, [p.grad.clone() for p in model.parameters()]))
+    finally:
+        dist.destroy_process_group()
+
+
+def test_gradient_reducer_accumulation(tmp_path):
+    ctx = mp.get_context('fork')
+    weights = [1, 3]
+    expected = None
+    for rank in range(WORLD_SIZE):
+        model = make_model()
+        for i in range(2 + rank):
+            model(make_inputs(rank * 10 + i)).sum().backward()
+        grads = [p.grad * weights[rank] / sum(weights) for p in model.parameters()]
+        expected = grads if expected is None else [a + b for a, b in zip(expected, grads)]
+
+    results = ctx.Queue()
+    procs = [ctx.Process(target=_accum_worker, args=(rank, tmp_path / 'init', results))
+             for rank in range(WORLD_SIZE)]
+    for proc in procs:
+        proc.start()
+    outs = [results.get(timeout=60) for _ in range(WORLD_SIZE)]
+    for proc in procs:
+        proc.join(timeout=60)
+        assert proc.exitcode == 0
+    for rank, grads in outs:
+        for grad, exp_grad in zip(grads, expected):
+            assert torch.allclose(grad, exp_grad, atol=1e-5)
+
+
+def _count_all_reduce(calls):
+    all_reduce = dist.all_reduce
+    dist.all_reduce = lambda *args, **kwargs: calls.append(1) or all_reduce(*args, **kwargs)
+    return all_reduce
+
+
+def _overlap_worker(rank, init_file, results):
+    dist.init_process_group('gloo', init_method=f'file://{init_file}', rank=rank,
+                            world_size=WORLD_SIZE)
+    try:
+        model = make_model()
+        model.append(nn.Linear(4, 4))  # unused; in the first bucket
+        reducer = GradientReducer(model, bucket_mb=2e-3)
+        unused_bucket = reducer._bucket_of[len(list(model.parameters())) - 1]
+        for step in range(2):
+            calls = []
+            all_reduce = _count_all_reduce(calls)
+            reducer.set_weight(1 + 2 * rank)
+            model[:-1](make_inputs(rank + step)).sum().backward()
+            launched = [work is not None for work in reducer._works]
+            # all buckets, except the one with unused param, are launched during backward
+            assert launched == [b != unused_bucket for b in range(len(reducer.buckets))]
+            reducer.synchronize()
+            dist.all_reduce = all_reduce
+            # one per bucket; the weights are reduced along with the last bucket
+            assert len(calls) == len(reducer.buckets) + (step == 0)
+            results.put((rank, step, [p.grad.clone() for p in model[:-1].parameters()]))
+            model.zero_grad()
+    finally:
+        dist.destroy_process_group()
+
+
+def _weighted_grads(compute_grads, weights):
+    expected = None
+    for rank, weight in enumerate(weights):
+        grads = [g * weight / sum(weights) for g in compute_grads(rank)]
+        expected = grads if expected is None else [a + b for a, b in zip(expected, grads)]
+    return expected
+
+
+def _run_workers(target, init_file, num_results):
+    ctx = mp.get_context('fork')
+    results = ctx.Queue()
+    procs = [ctx.Process(target=target, args=(rank, init_file, results))
+             for rank in range(WORLD_SIZE)]
+    for proc in procs:
+        proc.start()
+    outs = [results.get(timeout=60) for _ in range(num_results)]
+    for proc in procs:
+        proc.join(timeout=60)
+        assert proc.exitcode == 0
+    return outs
+
+
+def test_gradient_reducer_overlap(tmp_path):
+    def compute_grads(rank, step):
+        model = make_model()
+        model(make_inputs(rank + step)).sum().backward()
+        return [p.grad for p in model.parameters()]
+
+    expected = [_weighted_grads(lambda rank: compute_grads(rank, step), weights=[1, 3])
+                for step in range(2)]
+    for rank, step, grads in _run_workers(_overlap_worker, tmp_path / 'init', 2 * WORLD_SIZE):
+        for grad, exp_grad in zip(grads, expected[step]):
+            assert torch.allclose(grad, exp_grad, atol=1e-5)
+
+
+class ChunkedModel(nn.Module):
+
+    def __init__(self):
+        super().__init__()
+        torch.manual_seed(1)
+        self.encoder = nn.Sequential(nn.Linear(8, 16), nn.ReLU(), nn.Linear(16, 16))
+        self.generator = Generator(16, 10)
+
+    def loss(self, rank):
+        torch.manual_seed(200 + rank)
+        x, y_seqs = torch.randn(3, 5, 8), torch.randint(1, 10, (3, 5))
+        loss_func = ChunkedLossCompute(self.generator, CrossEntropy(pad_idx=0), opt=None,
+                                       chunk_size=2)
+        return loss_func(self.encoder(x), y_seqs, normalizer=y_seqs.numel(), take_step=False)
+
+
+def _chunked_worker(rank, init_file, results):
+    dist.init_process_group('gloo', init_method=f'file://{init_file}', rank=rank,
+                            world_size=WORLD_SIZE)
+    try:
+        model = ChunkedModel()
+        reducer = GradientReducer(model, bucket_mb=2e-3)
+        DistribTorch.instance()._reducer = reducer   # used by the no_sync() of chunked loss
+        reducer.set_weight(1 + 2 * rank)
+        model.loss(rank)
+        # generator grads are accumulated in no_sync(), and counted as ready in encoder backward
+        assert all(work is not None for work in reducer._works)
+        assert not any(reducer._stale)
+        reducer.synchronize()
+        results.put((rank, [p.grad.clone() for p in model.parameters()]))
+    finally:
+        dist.destroy_process_group()
+
+
+def test_gradient_reducer_chunked_loss(tmp_path):
+    def compute_grads(rank):
+        model = ChunkedModel()
+        model.loss(rank)
+        return [p.grad for p in model.parameters()]
+
+    expected = _weighted_grads(compute_grads, weights=[1, 3])
+    for rank, grads in _run_workers(_chunked_worker, tmp_path / 'init', WORLD_SIZE):
+        for grad, exp_grad in zip(grads, expected):
+            assert torch.allclose(grad, exp_grad, atol=1e-5)
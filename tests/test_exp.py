@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#
+# Created: 10/17/26
+import threading
+
+import torch
+from torch import nn
+
+from rtg.exp import BaseExperiment
+from rtg.module.trainer import NoamOpt, WeightsEMA
+
+
+def test_store_model_background(tmp_path):
+    exp = BaseExperiment(tmp_path / 'exp', config={'prep': {'codec_lib': 'nlcodec'}})
+    weight = torch.zeros(4)
+    started, proceed = threading.Event(), threading.Event()
+    store = exp._store_model
+
+    def slow_store(*args):
+        started.set()
+        assert proceed.wait(timeout=30)
+        return store(*args)
+
+    exp._store_model = slow_store
+    exp.store_model(1, {'w': weight}, train_score=2.0, val_score=3.0, keep=2, background=True)
+    assert started.wait(timeout=30)
+    weight += 1   # training continues on the originals; the snapshot is not changed
+    assert not list(exp.model_dir.glob('model_*'))  # not yet written
+    proceed.set()
+    for step in range(2, 5):  # waits for the previous one; at most one in flight
+        exp.store_model(step, {'w': weight}, train_score=2.0, val_score=3.0, keep=2,
+                        background=True)
+    models = exp.list_models()  # waits for the last one
+    assert [exp._path_to_step_no(m) for m in models] == [4, 3]
+    assert not list(exp.model_dir.glob('*.tmp'))
+    assert torch.equal(torch.load(models[0])['w'], torch.ones(4))
+    assert len((exp.model_dir / 'scores.tsv').read_text().splitlines()) == 4
+
+
+def test_average_states(tmp_path):
+    torch.manual_seed(1)
+    states = [dict(weight=torch.randn(3, 4).half(), bias=torch.randn(4), steps=torch.tensor(i))
+              for i in range(4)]
+    paths = []
+    for i, state in enumerate(states):
+        paths.append(tmp_path / f'model_{i}.pkl')
+        chkpt = dict(model_state=state, optim_state={'state': {0: torch.randn(100)}}, step=i)
+        # legacy format can not be memory mapped; read instead
+        torch.save(chkpt, paths[-1], _use_new_zipfile_serialization=i != 2)
+    for mmap in (True, False):
+        avg = BaseExperiment.average_states(paths, mmap=mmap)
+        assert set(avg.keys()) == {'weight', 'bias', 'steps'}
+        assert avg['weight'].dtype == torch.float16
+        exp_weight = torch.stack([s['weight'].float() for s in states]).mean(dim=0)
+        assert torch.allclose(avg['weight'].float().cpu(), exp_weight, atol=1e-3)
+        exp_bias = torch.stack([s['bias'] for s in states]).mean(dim=0)
+        assert torch.allclose(avg['bias'].cpu(), exp_bias, atol=1e-6)
+        assert avg['steps'].item() == 0  # not averaged
+
+
+def test_weights_ema(tmp_path):
+    torch.manual_seed(1)
+    model = nn.Sequential(nn.Linear(4, 4), nn.BatchNorm1d(4))
+    opt = NoamOpt(4, 2, 10, torch.optim.SGD(model.parameters(), lr=0.1))
+    ema = WeightsEMA(model, decay=0.5, interval=2)
+    opt.register_step_post_hook(lambda *args: ema.update(opt.curr_step))
+    expected = {k: v.clone() for k, v in model.state_dict().items()}
+    for step in range(1, 7):
+        model(torch.randn(8, 4)).sum().backward()
+        opt.step()
+        opt.zero_grad()
+        if step % 2 == 0:
+            decay = min(0.5, (1 + step // 2) / (10 + step // 2))
+            for key, val in model.state_dict().items():
+                expected[key] = decay * expected[key] + (1 - decay) * val \
+                    if val.is_floating_point() else val.clone()
+    assert ema.updates == 3
+    avg = ema.model_state()
+    assert avg['1.num_batches_tracked'].item() == 6  # copied, not averaged
+    assert not torch.allclose(avg['0.weight'], model.state_dict()['0.weight'])
+    for key, val in expected.items():
+        assert torch.allclose(avg[key], val, atol=1e-6)
+
+    # selectable from checkpoints
+    path = tmp_path / 'model_006.pkl'
+    torch.save(dict(model_state=model.state_dict(), ema_state=ema.state_dict()), path)
+    ema_state = BaseExperiment._checkpt_to_model_state(path, map_location='cpu', ema=True)
+    assert torch.equal(ema_state['0.weight'], avg['0.weight'])
+    state = BaseExperiment._checkpt_to_model_state(path, map_location='cpu')
+    assert torch.equal(state['0.weight'], model.state_dict()['0.weight'])
+
+    resumed = WeightsEMA(model, decay=0.5, interval=2)
+    resumed.load_state_dict(torch.load(path)['ema_state'])
+    assert resumed.updates == 3
+    assert torch.equal(resumed.model_state()['0.weight'], avg['0.weight'])
+
+
+def test_checkpt_to_model_state_without_mmap(tmp_path, monkeypatch):
+    path = tmp_path / 'model_001.pkl'
+    torch.save(dict(model_state=dict(w=torch.ones(3)), optim_state={}), path)
+    load = torch.load
+
+    def old_load(*args, **kwargs):  # torch < 2.1 doesnt know mmap
+        if 'mmap' in kwargs:
+            raise TypeError("load() got an unexpected keyword argument 'mmap'")
+        return load(*args, **kwargs)
+
+    monkeypatch.setattr(torch, 'load', old_load)
+    state = BaseExperiment._checkpt_to_model_state(path, map_location='cpu', mmap=True)
+    assert torch.equal(state['w'], torch.ones(3))
+    assert torch.equal(BaseExperiment.average_states([path, path])['w'].cpu(), torch.ones(3))